@@ -0,0 +1,68 @@
+"""
+Caching for API responses that only change when crime data is rebuilt.
+
+Responses are kept in Django's cache under an ETag made from the request's
+index, year or months, precision and geohash cell and the version of the stored
+summaries and averages. Nearby points share an entry, and rebuilding or
+updating the data gives every response a new ETag. ETag and Last-Modified
+headers let clients revalidate with conditional requests and get a 304.
+"""
+import hashlib
+
+from django.conf import settings
+from django.core.cache import cache
+from django.utils.http import http_date, parse_etags, parse_http_date_safe, quote_etag
+from rest_framework import status
+from rest_framework.response import Response
+
+from crime_stats import timing
+
+
+def make_etag(averager, *key):
+    """Return an ETag for a response about ``key`` from ``averager``'s data."""
+    crimes = averager.crimes
+    parts = (crimes.index, averager.period, crimes.precision) + key + averager.version()
+    return hashlib.md5(':'.join(str(part) for part in parts).encode()).hexdigest()
+
+
+def is_not_modified(request, etag, last_modified):
+    """Return whether the conditional headers of ``request`` show the client
+    already has the response with ``etag``."""
+    if_none_match = request.META.get('HTTP_IF_NONE_MATCH')
+    if if_none_match:
+        etags = parse_etags(if_none_match)
+        return etag in etags or '*' in etags
+
+    if_modified_since = parse_http_date_safe(request.META.get('HTTP_IF_MODIFIED_SINCE'))
+    return if_modified_since is not None and int(last_modified) <= if_modified_since
+
+
+def cached_response(request, averager, key, build):
+    """Return a response with the data ``build()`` returns for ``key``.
+
+    The data is cached for API_CACHE_TIMEOUT seconds or until ``averager``'s
+    summaries or averages change. Returns a 304 if the client's copy is
+    current.
+    """
+    etag = make_etag(averager, *key)
+    last_modified = averager.last_modified()
+
+    if is_not_modified(request, etag, last_modified):
+        response = Response(status=status.HTTP_304_NOT_MODIFIED)
+    else:
+        cache_key = 'api:{}'.format(etag)
+        with timing.timed('cache'):
+            data = cache.get(cache_key)
+        if data is None:
+            timing.add('response_cache_misses')
+            data = build()
+            cache.set(cache_key, data, settings.API_CACHE_TIMEOUT)
+        else:
+            timing.add('response_cache_hits')
+        response = Response(data, status=status.HTTP_200_OK)
+
+    response['ETag'] = quote_etag(etag)
+    response['Last-Modified'] = http_date(last_modified)
+    # Responses need a login, so only the client may store them.
+    response['Cache-Control'] = 'private, max-age={}'.format(settings.API_CACHE_MAX_AGE)
+    return response
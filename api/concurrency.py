@@ -0,0 +1,59 @@
+"""
+Running the independent parts of a request at the same time.
+
+Each process keeps a pool of API_THREADS threads. ``concurrently`` runs all
+but the first of a request's calls in it while the request's own thread runs
+the first, so a cell lookup that has to search Elasticsearch overlaps with
+loading the averages instead of waiting for it.
+"""
+import concurrent.futures
+import os
+import threading
+
+from django.conf import settings
+
+from crime_stats import timing
+
+
+_lock = threading.Lock()
+_executor = None
+_executor_pid = None
+
+
+def get_executor():
+    """Return the thread pool for this process.
+
+    The pool is created on first use. Threads don't survive a fork, so a
+    gunicorn worker forked after the pool was created gets one of its own.
+    """
+    global _executor, _executor_pid
+
+    pid = os.getpid()
+    if _executor is not None and _executor_pid == pid:
+        return _executor
+
+    with _lock:
+        if _executor is None or _executor_pid != pid:
+            _executor = concurrent.futures.ThreadPoolExecutor(settings.API_THREADS)
+            _executor_pid = pid
+    return _executor
+
+
+def concurrently(*calls):
+    """Call each function in ``calls`` at the same time and return their
+    results in the same order.
+
+    Phases the calls time are recorded against the current request. If any
+    call raises, the exception is raised here once the others finish. With
+    API_THREADS below 2 the calls are made one after another.
+    """
+    if len(calls) < 2 or settings.API_THREADS < 2:
+        return [call() for call in calls]
+
+    executor = get_executor()
+    futures = [executor.submit(timing.bind(call)) for call in calls[1:]]
+    try:
+        first = calls[0]()
+    finally:
+        concurrent.futures.wait(futures)
+    return [first] + [future.result() for future in futures]
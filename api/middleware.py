@@ -0,0 +1,52 @@
+import json
+import logging
+
+from crime_stats import timing
+
+
+log = logging.getLogger(__name__)
+
+
+class TimingMiddleware(object):
+    """Time each request and the phases recorded with ``crime_stats.timing``.
+
+    Durations are sent in a ``Server-Timing`` header, logged as JSON and
+    added to the histograms served by the metrics API.
+    """
+    def process_request(self, request):
+        timing.start()
+
+    def process_template_response(self, request, response):
+        timings = timing.current()
+        if timings is not None:
+            timings.begin('render')
+            response.add_post_render_callback(lambda response: timings.end('render'))
+        return response
+
+    def process_response(self, request, response):
+        timings = timing.finish()
+        if timings is None:
+            return response
+
+        total = timings.total
+        match = getattr(request, 'resolver_match', None)
+        view = getattr(match.func, '__name__', 'unknown') if match else 'unknown'
+
+        timing.observe('{}.total'.format(view), total)
+        for name, ms in timings.durations.items():
+            timing.observe('{}.{}'.format(view, name), ms)
+
+        response['Server-Timing'] = ', '.join(
+            '{};dur={:.1f}'.format(name, ms)
+            for name, ms in list(timings.durations.items()) + [('total', total)])
+
+        log.info(json.dumps({
+            'method': request.method,
+            'path': request.path,
+            'view': view,
+            'status': response.status_code,
+            'total_ms': round(total, 1),
+            'phases_ms': {name: round(ms, 1) for name, ms in timings.durations.items()},
+            'counts': timings.counts
+        }, sort_keys=True))
+        return response
@@ -1,15 +1,44 @@
 import json
+import shutil
+import tempfile
+from unittest import mock
 
 from django.contrib.auth import get_user_model
-from django.test import TestCase
+from django.core.cache import cache
+from django.test import SimpleTestCase, TestCase
+from django.test.utils import override_settings
 
 from rest_framework.authtoken.models import Token
 
-from crime_stats.tests import BaseCrimeTestCase
+from crime_stats import crime_averager, timing
+from crime_stats.tests import BaseCrimeTestCase, TEST_INDEX
 
+from .concurrency import concurrently
 
-class TestCompareLocation(BaseCrimeTestCase):
+
+class BaseAPITestCase(BaseCrimeTestCase):
+    """Serves the test crimes from the API, building their summaries and
+    averages in a temporary directory as requests need them."""
+    def setUp(self):
+        cache.clear()
+        crime_averager.cache.clear()
+        self.root_dir = tempfile.mkdtemp()
+        self.settings = override_settings(DATA_DIR=self.root_dir, CRIME_INDEX=TEST_INDEX,
+                                          CRIME_BACKEND=self.backend,
+                                          CRIME_DATA_FILES=[self.data_file],
+                                          CELERY_ALWAYS_EAGER=True)
+        self.settings.enable()
+
+    def tearDown(self):
+        self.settings.disable()
+        shutil.rmtree(self.root_dir)
+        cache.clear()
+        crime_averager.cache.clear()
+
+
+class TestCompareLocation(BaseAPITestCase):
     def setUp(self):
+        super().setUp()
         self.mock_response = {}
         User = get_user_model()
         self.user = User.objects.create_user(username="test",
@@ -124,6 +153,187 @@ class TestCompareLocation(BaseCrimeTestCase):
                          sorted(data['crime_types']))
 
 
+class TestLocalCompareLocation(TestCompareLocation):
+    backend = 'local'
+
+
+class TestCompareLocations(BaseAPITestCase):
+    def setUp(self):
+        super().setUp()
+        User = get_user_model()
+        User.objects.create_user(username="test", email="test@example.com",
+                                 password="secret")
+        self.client.login(username="test", password="secret")
+        self.url = '/api/v1.0/crimes/compare/to/city-average/'
+
+    def post(self, data):
+        return self.client.post(self.url, json.dumps(data),
+                                content_type='application/json')
+
+    def test_matches_compare_location(self):
+        """Comparing several locations should match comparing each one"""
+        locations = [[-122.64788229999999, 45.476296999999995],
+                     {'lon': -122.674417, 'lat': 45.523813},
+                     [-122.64788229999999, 45.476296999999995]]
+        resp = self.post({'locations': locations})
+        self.assertEqual(200, resp.status_code)
+        data = json.loads(resp.content.decode())
+
+        single = '/api/v1.0/crimes/compare/{}/{}/to/city-average/'
+        expected = json.loads(self.client.get(
+            single.format(-122.64788229999999, 45.476296999999995)).content.decode())
+        self.assertEqual(expected['city_averages'], data['city_averages'])
+        self.assertEqual(expected['crime_types'], data['crime_types'])
+        self.assertEqual(3, len(data['locations']))
+        self.assertEqual(expected['location_sums'], data['locations'][0]['location_sums'])
+        self.assertEqual(expected['location_sums'], data['locations'][2]['location_sums'])
+        self.assertEqual(-122.674417, data['locations'][1]['lon'])
+
+    def test_rejects_invalid_locations(self):
+        """Missing or malformed locations should be rejected with 400"""
+        self.assertEqual(400, self.post({}).status_code)
+        self.assertEqual(400, self.post({'locations': [[-122.6]]}).status_code)
+        self.assertEqual(400, self.post({'locations': [{'lon': 'west'}]}).status_code)
+
+    def test_rejects_locations_out_of_range(self):
+        """Coordinates that aren't finite or fall off the globe should be rejected with 400"""
+        for location in ([-122.6, 91], [-181, 45.5], ['nan', 45.5], [-122.6, 'inf']):
+            self.assertEqual(400, self.post({'locations': [location]}).status_code)
+
+
+class TestLocalCompareLocations(TestCompareLocations):
+    backend = 'local'
+
+
+class TestCityAverages(BaseAPITestCase):
+    def setUp(self):
+        super().setUp()
+        User = get_user_model()
+        User.objects.create_user(username="test", email="test@example.com",
+                                 password="secret")
+        self.client.login(username="test", password="secret")
+
+    def test_revalidates_with_etag(self):
+        """The city averages API should return 304 when the client's ETag is current"""
+        url = '/api/v1.0/crimes/city_averages/'
+        resp = self.client.get(url)
+        self.assertEqual(200, resp.status_code)
+        self.assertIn('Last-Modified', resp)
+        self.assertIn('max-age', resp['Cache-Control'])
+
+        resp = self.client.get(url, HTTP_IF_NONE_MATCH=resp['ETag'])
+        self.assertEqual(304, resp.status_code)
+        resp = self.client.get(url, HTTP_IF_NONE_MATCH='"stale"')
+        self.assertEqual(200, resp.status_code)
+
+    def test_nearby_locations_share_etag(self):
+        """Locations in the same geohash cell should get the same cached response"""
+        url = '/api/v1.0/crimes/at_location/{}/{}/'
+        first = self.client.get(url.format(-122.674417, 45.523813))
+        second = self.client.get(url.format(-122.674410, 45.523810))
+        elsewhere = self.client.get(url.format(-122.6478823, 45.476297))
+        self.assertEqual(first['ETag'], second['ETag'])
+        self.assertNotEqual(first['ETag'], elsewhere['ETag'])
+        self.assertEqual(first.content, second.content)
+
+    def test_smoothed_location_sums(self):
+        """Smoothed sums should average the location's cell and its neighbours"""
+        url = '/api/v1.0/crimes/at_location/{}/{}/'.format(-122.674417, 45.523813)
+        cell = self.client.get(url)
+        neighbours = self.client.get(url, {'smoothing': 'neighbours'})
+        weighted = self.client.get(url, {'smoothing': 'weighted'})
+        self.assertEqual(200, neighbours.status_code)
+        self.assertEqual(200, weighted.status_code)
+        self.assertEqual(3, len({cell['ETag'], neighbours['ETag'], weighted['ETag']}))
+
+        cell_sums = json.loads(cell.content.decode())['by_type']
+        smoothed = json.loads(neighbours.content.decode())['by_type']
+        self.assertLessEqual(set(cell_sums), set(smoothed))
+
+        compare = self.client.get('/api/v1.0/crimes/compare/{}/{}/to/city-average/'.format(
+            -122.674417, 45.523813), {'smoothing': 'neighbours'})
+        self.assertEqual(smoothed, json.loads(compare.content.decode())['location_sums']['by_type'])
+
+    def test_rejects_unknown_smoothing(self):
+        """Unknown smoothing should be rejected with 400"""
+        url = '/api/v1.0/crimes/at_location/{}/{}/'.format(-122.674417, 45.523813)
+        self.assertEqual(400, self.client.get(url, {'smoothing': 'blur'}).status_code)
+
+    def test_reports_server_timing(self):
+        """API responses should report how long each phase took"""
+        resp = self.client.get('/api/v1.0/crimes/compare/{}/{}/to/city-average/'.format(
+            -122.674417, 45.523813))
+        phases = [entry.split(';')[0] for entry in resp['Server-Timing'].split(', ')]
+        self.assertIn('render', phases)
+        self.assertEqual('total', phases[-1])
+
+    def test_metrics_need_staff(self):
+        """Only staff should see the metrics"""
+        self.client.get('/api/v1.0/crimes/city_averages/')
+        self.assertEqual(403, self.client.get('/api/v1.0/metrics/').status_code)
+
+        get_user_model().objects.create_superuser(username="admin", email="admin@example.com",
+                                                  password="secret")
+        self.client.login(username="admin", password="secret")
+        resp = self.client.get('/api/v1.0/metrics/')
+        self.assertEqual(200, resp.status_code)
+        self.assertIn('CityAverages.total', json.loads(resp.content.decode()))
+
+    @mock.patch('crime_stats.tasks.queue_warm')
+    def test_rejects_unknown_years_and_precisions(self, queue_warm):
+        """Years and precisions that aren't configured should be rejected with 400"""
+        url = '/api/v1.0/crimes/city_averages/'
+        self.assertEqual(400, self.client.get(url, {'year': 1999}).status_code)
+        self.assertEqual(400, self.client.get(url, {'year': 'last'}).status_code)
+        self.assertEqual(400, self.client.get(url, {'precision': 12}).status_code)
+        self.assertEqual(400, self.client.get(url, {'start': '1999-01'}).status_code)
+        self.assertFalse(queue_warm.called)
+
+    def test_averages_for_months(self):
+        """The city averages API should average the months from start to end"""
+        url = '/api/v1.0/crimes/city_averages/'
+        year = self.client.get(url)
+        months = self.client.get(url, {'start': '2013-01', 'end': '2013-12'})
+        self.assertEqual(200, months.status_code)
+        self.assertEqual(json.loads(year.content.decode()), json.loads(months.content.decode()))
+
+        summer = self.client.get(url, {'start': '2013-06', 'end': '2013-08'})
+        self.assertEqual(200, summer.status_code)
+        self.assertNotEqual(months['ETag'], summer['ETag'])
+
+    def test_rejects_invalid_months(self):
+        """Malformed or backwards months should be rejected with 400"""
+        url = '/api/v1.0/crimes/city_averages/'
+        self.assertEqual(400, self.client.get(url, {'start': 'June'}).status_code)
+        self.assertEqual(400, self.client.get(url, {'start': '2013-13'}).status_code)
+        self.assertEqual(400, self.client.get(url, {'start': '2013-06-01'}).status_code)
+        self.assertEqual(400, self.client.get(url, {'start': '2013-06', 'end': '2013-01'}).status_code)
+
+
+class TestLocalCityAverages(TestCityAverages):
+    backend = 'local'
+
+
+class TestConcurrently(SimpleTestCase):
+    def tearDown(self):
+        timing.finish()
+
+    def test_returns_results_in_order(self):
+        """Results should come back in the order of the calls, timed against the request"""
+        timings = timing.start()
+        calls = [lambda i=i: timing.add('calls') or i for i in range(3)]
+        self.assertEqual([0, 1, 2], concurrently(*calls))
+        self.assertEqual(3, timings.counts['calls'])
+
+    def test_raises_errors(self):
+        """An error in any call should be raised to the caller"""
+        def fail():
+            raise ValueError('failed')
+
+        with self.assertRaises(ValueError):
+            concurrently(lambda: 1, fail)
+
+
 class TestCreateAuthTokenSignal(TestCase):
     def test_new_user_gets_token(self):
         """A new Django User should receive an API auth token"""
@@ -1,4 +1,4 @@
-from api.views import CompareLocation, CrimesNearLocation, CityAverages
+from api.views import CompareLocation, CompareLocations, CrimesNearLocation, CityAverages, Metrics
 from django.conf.urls import *
 
 coordinates = '(?P<{}>(\-?\d+(\.\d+)?))/(?P<{}>(\-?\d+(\.\d+)?))'
@@ -6,6 +6,8 @@ lon_lat = coordinates.format('lon', 'lat')
 
 urlpatterns = patterns('',
                        url(r'^v1.0/crimes/compare/{}/to/city-average/$'.format(lon_lat), CompareLocation.as_view(), name='compare_location'),
+                       url(r'^v1.0/crimes/compare/to/city-average/$', CompareLocations.as_view(), name='compare_locations'),
                        url(r'^v1.0/crimes/at_location/{}/$'.format(lon_lat), CrimesNearLocation.as_view(), name='crimes'),
-                       url(r'^v1.0/crimes/city_averages/$', CityAverages.as_view(), name='crimes')
+                       url(r'^v1.0/crimes/city_averages/$', CityAverages.as_view(), name='crimes'),
+                       url(r'^v1.0/metrics/$', Metrics.as_view(), name='metrics')
 )
@@ -1,76 +1,289 @@
-from django.conf import settings
+import re
 
-from rest_framework.permissions import IsAuthenticated
+from django.conf import settings
+from rest_framework.permissions import IsAdminUser, IsAuthenticated
 from rest_framework.views import APIView
 from rest_framework.response import Response
 from rest_framework import status
 
-from elasticsearch import Elasticsearch
+from crime_stats import crime_averager, tasks, timing
+
+from .caching import cached_response
+from .concurrency import concurrently
+
+
+# Seconds clients are asked to wait while crime averages are calculated.
+RETRY_AFTER = 30
+
+# Most locations that can be compared in one request.
+MAX_LOCATIONS = 100
+
+# Most calendar years the months from ``start`` to ``end`` may touch.
+MAX_WINDOW_YEARS = 10
+
+# Values of the ``smoothing`` query parameter: sums for the location's cell
+# alone, or means over it and its 8 neighbours, optionally weighted by
+# distance.
+SMOOTHING = ('none', 'neighbours', 'weighted')
+
+MONTH = re.compile(r'^(\d{4})-(\d\d)$')
+
+
+def parse_month(value):
+    """Return the (year, month) of a YYYY-MM month.
+
+    Raises ValueError if ``value`` is anything else.
+    """
+    match = MONTH.match(value)
+    if not match or not 1 <= int(match.group(2)) <= 12:
+        raise ValueError('Expected a YYYY-MM month, not {!r}'.format(value))
+    return int(match.group(1)), int(match.group(2))
+
+
+def parse_choice(request, name, default, choices):
+    """Return the integer query parameter ``name``, or ``default`` if it is
+    missing.
+
+    Raises ValueError if it is not one of ``choices``.
+    """
+    try:
+        value = int(request.GET.get(name, default))
+    except ValueError:
+        value = None
+    if value not in choices:
+        raise ValueError('{} must be one of {}'.format(name, ', '.join(str(c) for c in choices)))
+    return value
+
+
+def get_averager(request):
+    """Return an averager for the ``year`` and ``precision`` query
+    parameters, or for the months ``start`` to ``end`` (YYYY-MM, both
+    included) if either is given.
+
+    Raises ValueError if the year isn't in CRIME_YEARS, the precision isn't
+    in CRIME_PRECISIONS, or the months are invalid or fall outside
+    CRIME_WINDOW_YEARS.
+    """
+    precision = parse_choice(request, 'precision', 6, settings.CRIME_PRECISIONS)
+    start = request.GET.get('start')
+    end = request.GET.get('end')
+    if start or end:
+        start = parse_month(start or end)
+        end = parse_month(end or start)
+        first, last = settings.CRIME_WINDOW_YEARS
+        if start[0] < first or end[0] > last:
+            raise ValueError('Months must fall from {} to {}'.format(first, last))
+        if end[0] - start[0] >= MAX_WINDOW_YEARS:
+            raise ValueError('Months can span at most {} years'.format(MAX_WINDOW_YEARS))
+        return tasks.get_window_averager(start, end, precision)
+
+    year = parse_choice(request, 'year', 2013, settings.CRIME_YEARS)
+    return tasks.get_averager(year, precision)
+
+
+def get_smoothing(request):
+    """Return the ``smoothing`` query parameter, one of SMOOTHING.
+
+    Raises ValueError if it is anything else.
+    """
+    smoothing = request.GET.get('smoothing', 'none')
+    if smoothing not in SMOOTHING:
+        raise ValueError('smoothing must be one of {}'.format(', '.join(SMOOTHING)))
+    return smoothing
+
+
+def location_sums(averager, lon, lat, smoothing):
+    """Return crime sums for (lon, lat), smoothed as ``smoothing`` says."""
+    if smoothing == 'none':
+        return averager.get_location_sums(lon, lat)
+    return averager.get_neighbourhood_sums(lon, lat, weighted=smoothing == 'weighted')
+
+
+def location_key(averager, lon, lat, smoothing):
+    """Return the part of a cache key that names the location (lon, lat).
+
+    Points in the same cell share responses, except that weighted sums are
+    shared by points in the same cell one precision finer.
+    """
+    precision = averager.crimes.precision
+    if smoothing == 'weighted':
+        return (smoothing, crime_averager.weighting_cell(lon, lat, precision))
+    if smoothing == 'neighbours':
+        return (smoothing, averager.crimes.get_cell_hash(lon, lat))
+    return (averager.crimes.get_cell_hash(lon, lat),)
 
-from crime_stats import models, crime_averager, util
+
+def is_ready(averager):
+    """Return whether ``averager``'s summaries and averages are built, queuing
+    them to be built in the background if not.
+
+    Calculating them takes too long to do within a request.
+    """
+    if averager.is_built():
+        return True
+    if isinstance(averager, crime_averager.WindowAverager):
+        for year in averager.missing_years():
+            tasks.queue_warm(year, averager.crimes.precision, monthly=True)
+    else:
+        tasks.queue_warm(averager.year, averager.crimes.precision)
+    # Tasks run in this process when CELERY_ALWAYS_EAGER is set.
+    return averager.is_built()
+
+
+def bad_request(error):
+    return Response({'detail': str(error)}, status=status.HTTP_400_BAD_REQUEST)
+
+
+def calculating_response():
+    response = Response({'detail': 'Crime averages are being calculated. Try again shortly.'},
+                        status=status.HTTP_202_ACCEPTED)
+    response['Retry-After'] = RETRY_AFTER
+    return response
+
+
+def city_averages_data(averager):
+    return {
+        'city_averages': averager.averages,
+        'city_averages_by_hour': averager.hourly_averages,
+        'city_averages_by_day': averager.daily_averages,
+        'crime_types': sorted(averager.averages.keys())
+    }
+
+
+def parse_locations(data):
+    """Return (lon, lat) pairs from the ``locations`` list in a request body,
+    each given as [lon, lat] or {"lon": lon, "lat": lat}.
+
+    Raises ValueError if the locations are missing or malformed, or any
+    coordinate isn't a finite longitude from -180 to 180 or latitude from
+    -90 to 90.
+    """
+    locations = data.get('locations') if hasattr(data, 'get') else None
+    if not isinstance(locations, list) or not locations:
+        raise ValueError('Expected a non-empty list of locations')
+    if len(locations) > MAX_LOCATIONS:
+        raise ValueError('At most {} locations can be compared at once'.format(MAX_LOCATIONS))
+
+    coordinates = []
+    for location in locations:
+        try:
+            if isinstance(location, dict):
+                lon, lat = location['lon'], location['lat']
+            else:
+                lon, lat = location
+            lon, lat = float(lon), float(lat)
+        except (KeyError, TypeError, ValueError):
+            raise ValueError('Invalid location: {!r}'.format(location))
+        # NaN fails both comparisons, and geohash can't encode any of these.
+        if not (-180 <= lon <= 180 and -90 <= lat <= 90):
+            raise ValueError('Location out of range: {!r}'.format(location))
+        coordinates.append((lon, lat))
+    return coordinates
 
 
 class CompareLocation(APIView):
+    """Compare a location to the city averages.
+
+    Pass ``smoothing=neighbours`` or ``smoothing=weighted`` to compare the
+    mean of the location's cell and its 8 neighbours instead of the one
+    cell; see ``CachingCrimeAverager.get_neighbourhood_sums``.
+    """
     permission_classes = (IsAuthenticated,)
 
     def get(self, request, *args, **kwargs):
         lat = float(kwargs['lat'])
         lon = float(kwargs['lon'])
-        year = request.GET.get('year', 2013)
-        precision = request.GET.get('precision', 6)
-        es = Elasticsearch()
-        crimes = models.Crimes(es, index=settings.CRIME_INDEX,
-                               precision=precision)
-
-        found_crimes = crimes.get_crimes_near_coordinate(lon, lat, year=year)
-        crime_sums = util.get_crime_sums(found_crimes)
-
-        # TODO: Average by hour and by day, since we have that data too.
-        averager = crime_averager.CachingCrimeAverager(crimes=crimes,
-                                                       root_dir=settings.DATA_DIR,
-                                                       year=year)
-        data = {
-            'city_averages': averager.averages,
-            'location_sums': crime_sums,
-            'crime_types': sorted(averager.averages.keys())
-        }
+        try:
+            averager = get_averager(request)
+            smoothing = get_smoothing(request)
+        except ValueError as e:
+            return bad_request(e)
+        if not is_ready(averager):
+            return calculating_response()
+
+        def build():
+            data, sums = concurrently(
+                lambda: city_averages_data(averager),
+                lambda: location_sums(averager, lon, lat, smoothing))
+            data['location_sums'] = sums
+            return data
+
+        key = ('compare',) + location_key(averager, lon, lat, smoothing)
+        return cached_response(request, averager, key, build)
+
+
+class CompareLocations(APIView):
+    """Compare up to MAX_LOCATIONS locations to the city averages at once.
+
+    POST ``{"locations": [[lon, lat], ...]}``. The response has the same city
+    averages as ``CompareLocation`` and a ``locations`` list with the
+    ``location_sums`` of each location, in the order they were given.
+    """
+    permission_classes = (IsAuthenticated,)
+
+    def post(self, request, *args, **kwargs):
+        try:
+            coordinates = parse_locations(request.DATA)
+        except ValueError as e:
+            return bad_request(e)
+
+        try:
+            averager = get_averager(request)
+        except ValueError as e:
+            return bad_request(e)
+        if not is_ready(averager):
+            return calculating_response()
+
+        data, locations_sums = concurrently(
+            lambda: city_averages_data(averager),
+            lambda: averager.get_locations_sums(coordinates))
+        data['locations'] = [
+            {'lon': lon, 'lat': lat, 'location_sums': crime_sums}
+            for (lon, lat), crime_sums in zip(coordinates, locations_sums)
+        ]
 
         return Response(data, status=status.HTTP_200_OK)
 
 
 class CrimesNearLocation(APIView):
+    """Crime sums for a location, smoothed as in ``CompareLocation``."""
     permission_classes = (IsAuthenticated,)
 
     def get(self, request, *args, **kwargs):
         lat = float(kwargs['lat'])
         lon = float(kwargs['lon'])
-        year = request.GET.get('year', 2013)
-        precision = request.GET.get('precision', 6)
-
-        es = Elasticsearch()
-
-        crimes = models.Crimes(es, index=settings.CRIME_INDEX,
-                               precision=precision)
+        try:
+            averager = get_averager(request)
+            smoothing = get_smoothing(request)
+        except ValueError as e:
+            return bad_request(e)
+        if not is_ready(averager):
+            return calculating_response()
 
-        crimes = crimes.get_crimes_near_coordinate(lon, lat, year=year)
-        crime_sums = util.get_crime_sums(crimes)
-
-        return Response(crime_sums, status=status.HTTP_200_OK)
+        key = ('near',) + location_key(averager, lon, lat, smoothing)
+        return cached_response(request, averager, key,
+                               lambda: location_sums(averager, lon, lat, smoothing))
 
 
 class CityAverages(APIView):
     permission_classes = (IsAuthenticated,)
 
     def get(self, request, *args, **kwargs):
-        year = request.GET.get('year', 2013)
-        precision = request.GET.get('precision', 6)
-        es = Elasticsearch()
-        crimes = models.Crimes(es, index=settings.CRIME_INDEX,
-                               precision=precision)
+        try:
+            averager = get_averager(request)
+        except ValueError as e:
+            return bad_request(e)
+        if not is_ready(averager):
+            return calculating_response()
+
+        return cached_response(request, averager, ('averages',),
+                               lambda: averager.averages)
 
-        averager = crime_averager.CachingCrimeAverager(crimes=crimes,
-                                                       root_dir=settings.DATA_DIR,
-                                                       year=year)
 
-        return Response(averager.averages, status=status.HTTP_200_OK)
+class Metrics(APIView):
+    """Histograms of request and phase durations in this process, in
+    milliseconds. See ``api.middleware.TimingMiddleware``."""
+    permission_classes = (IsAdminUser,)
 
+    def get(self, request, *args, **kwargs):
+        return Response(timing.snapshot(), status=status.HTTP_200_OK)
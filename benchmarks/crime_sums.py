@@ -0,0 +1,73 @@
+"""
+Compare ways of summing crimes by type, hour and day.
+
+Usage: python -m benchmarks.crime_sums [crimes GeoJSON file] [repeat]
+
+Defaults to the 2013 crime data in data/crimes_2013.json.
+"""
+import json
+import os
+import sys
+import timeit
+
+import dateutil.parser
+
+from crime_stats import util
+
+
+DEFAULT_FILENAME = os.path.join(os.path.dirname(os.path.dirname(__file__)),
+                                'data', 'crimes_2013.json')
+
+
+def get_crime_sums_with_dateutil(crimes):
+    """``util.get_crime_sums`` as it was before report times had a fast path."""
+    summary = util.empty_crime_sums()
+
+    for crime in crimes:
+        crime_type = crime['properties']['crimeType']
+        report_time = dateutil.parser.parse(crime['properties']['reportTime'])
+        day = report_time.weekday()
+        hour = report_time.hour
+        summary['by_type'][crime_type] = summary['by_type'].get(crime_type, 0) + 1
+        by_day = summary['types_by_day'][day]
+        by_day[crime_type] = by_day.get(crime_type, 0) + 1
+        by_hour = summary['types_by_hour'][hour]
+        by_hour[crime_type] = by_hour.get(crime_type, 0) + 1
+
+    return summary
+
+
+CANDIDATES = [
+    ('dateutil', get_crime_sums_with_dateutil),
+    ('get_crime_sums', util.get_crime_sums),
+    ('get_crime_sums_batch', util.get_crime_sums_batch),
+]
+
+
+def run(crimes, repeat=3):
+    """Time each candidate over ``crimes`` and return (name, seconds) pairs,
+    using the best of ``repeat`` runs."""
+    expected = util.get_crime_sums(crimes)
+    results = []
+
+    for name, func in CANDIDATES:
+        if func(crimes) != expected:
+            raise AssertionError('{} returned different sums'.format(name))
+        seconds = min(timeit.repeat(lambda: func(crimes), number=1, repeat=repeat))
+        results.append((name, seconds))
+
+    return results
+
+
+if __name__ == '__main__':
+    filename = sys.argv[1] if len(sys.argv) > 1 else DEFAULT_FILENAME
+    repeat = int(sys.argv[2]) if len(sys.argv) > 2 else 3
+
+    with open(filename, 'r') as f:
+        crimes = json.load(f)['features']
+
+    results = run(crimes, repeat=repeat)
+    baseline = results[0][1]
+    print('Summing {} crimes (best of {})'.format(len(crimes), repeat))
+    for name, seconds in results:
+        print('{:<40} {:>8.3f}s {:>7.1f}x'.format(name, seconds, baseline / seconds))
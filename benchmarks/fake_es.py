@@ -0,0 +1,426 @@
+"""
+An in-process stand-in for the parts of Elasticsearch this project uses.
+
+``FakeElasticsearch`` implements the search, scroll, msearch, bulk and index
+management calls made by ``crime_stats.models``, ``crime_stats.load_crimes``
+and ``crime_stats.index``, so benchmarks can run without an ES server and
+without its network and JVM noise.
+
+Documents are stored by column: every leaf field is kept as an array of codes
+into a list of the field's distinct values, and point coordinates as two
+float arrays. Filters and terms aggregations run over those arrays with
+NumPy, so millions of crimes fit in memory and aggregate in seconds. Time
+spent inside the fake is added up in ``seconds`` so benchmarks can separate
+it from the time spent in the code under test.
+"""
+import array
+import fnmatch
+import itertools
+import json
+import time
+
+import numpy
+from elasticsearch import NotFoundError, TransportError
+
+
+COORDINATES = 'geometry.coordinates'
+
+# Hits returned by a search that doesn't say how many it wants.
+DEFAULT_SIZE = 10
+
+
+_COMPARISONS = {
+    'gt': lambda value, bound: value > bound,
+    'gte': lambda value, bound: value >= bound,
+    'lt': lambda value, bound: value < bound,
+    'lte': lambda value, bound: value <= bound,
+}
+
+
+def _in_range(value, bounds):
+    """Return whether ``value`` is within the bounds of a range filter."""
+    for name, bound in bounds.items():
+        if name not in _COMPARISONS:
+            raise NotImplementedError('Unsupported range bound: {}'.format(name))
+        if not _COMPARISONS[name](value, bound):
+            return False
+    return True
+
+
+class _Column(object):
+    """One field's values, stored as codes into a list of distinct values.
+
+    Documents without the field get the code -1.
+    """
+    def __init__(self, count=0):
+        self.values = []
+        self._codes = {}
+        self.pending = array.array('i', [-1] * count)
+        self.codes = numpy.zeros(0, dtype=numpy.int32)
+
+    def append(self, value):
+        code = self._codes.get(value)
+        if code is None:
+            code = self._codes[value] = len(self.values)
+            self.values.append(value)
+        self.pending.append(code)
+
+    def code(self, value):
+        return self._codes.get(value, -2)
+
+    def refresh(self):
+        self.codes = numpy.array(self.pending, dtype=numpy.int32)
+
+
+class _Index(object):
+    def __init__(self, settings=None):
+        self.settings = settings or {}
+        self.columns = {}
+        self.lons = array.array('d')
+        self.lats = array.array('d')
+        self.pending = 0
+        self.count = 0
+        self.lon = numpy.zeros(0)
+        self.lat = numpy.zeros(0)
+        # Masks of filters run since the last refresh, keyed by their JSON.
+        self._masks = {}
+
+    def _flatten(self, prefix, value, fields):
+        if isinstance(value, dict):
+            for key, child in value.items():
+                self._flatten('{}.{}'.format(prefix, key) if prefix else key, child, fields)
+        else:
+            fields[prefix] = value
+
+    def add(self, doc):
+        fields = {}
+        self._flatten('', doc, fields)
+        lon, lat = fields.pop(COORDINATES, (numpy.nan, numpy.nan))
+        self.lons.append(lon)
+        self.lats.append(lat)
+
+        for name, value in fields.items():
+            column = self.columns.get(name)
+            if column is None:
+                column = self.columns[name] = _Column(self.pending)
+            column.append(value)
+        self.pending += 1
+        for column in self.columns.values():
+            if len(column.pending) < self.pending:
+                column.pending.append(-1)
+
+    def refresh(self):
+        for column in self.columns.values():
+            column.refresh()
+        self.lon = numpy.array(self.lons)
+        self.lat = numpy.array(self.lats)
+        self.count = self.pending
+        self._masks = {}
+
+    def source(self, doc_id, fields=None):
+        """Rebuild document ``doc_id``, keeping only ``fields`` if given."""
+        names = fields if fields is not None else list(self.columns) + [COORDINATES]
+        doc = {}
+        for name in names:
+            if name == COORDINATES:
+                if numpy.isnan(self.lon[doc_id]):
+                    continue
+                value = [float(self.lon[doc_id]), float(self.lat[doc_id])]
+            else:
+                column = self.columns.get(name)
+                if column is None or column.codes[doc_id] < 0:
+                    continue
+                value = column.values[column.codes[doc_id]]
+
+            parent = doc
+            keys = name.split('.')
+            for key in keys[:-1]:
+                parent = parent.setdefault(key, {})
+            parent[keys[-1]] = value
+        return doc
+
+    def filter_mask(self, f):
+        """Return a read-only boolean array of the documents matching filter
+        ``f``.
+
+        Masks are cached until the next refresh, since filter aggregations
+        run the same filter once for every bucket they are nested in.
+        """
+        key = json.dumps(f, sort_keys=True)
+        mask = self._masks.get(key)
+        if mask is None:
+            mask = self._masks[key] = self._filter_mask(f)
+            mask.flags.writeable = False
+        return mask
+
+    def _filter_mask(self, f):
+        (kind, spec), = f.items()
+        if kind == 'and':
+            filters = spec['filters'] if isinstance(spec, dict) else spec
+            mask = numpy.ones(self.count, dtype=bool)
+            for child in filters:
+                mask &= self.filter_mask(child)
+            return mask
+        if kind == 'term':
+            (field, value), = spec.items()
+            column = self.columns.get(field)
+            if column is None:
+                return numpy.zeros(self.count, dtype=bool)
+            return column.codes == column.code(value)
+        if kind == 'range':
+            (field, bounds), = spec.items()
+            column = self.columns.get(field)
+            if column is None:
+                return numpy.zeros(self.count, dtype=bool)
+            # Values are compared as stored, which orders ISO 8601 dates.
+            matches = numpy.array([_in_range(value, bounds) for value in column.values] + [False],
+                                  dtype=bool)
+            return matches[column.codes]
+        if kind == 'geo_bounding_box':
+            box = spec[COORDINATES]
+            return ((self.lon >= box['top_left']['lon']) &
+                    (self.lon <= box['bottom_right']['lon']) &
+                    (self.lat >= box['bottom_right']['lat']) &
+                    (self.lat <= box['top_left']['lat']))
+        if kind == 'match_all':
+            return numpy.ones(self.count, dtype=bool)
+        raise NotImplementedError('Unsupported filter: {}'.format(kind))
+
+    def query_ids(self, query):
+        """Return the ids of the documents matching ``query``."""
+        if not query or 'match_all' in query:
+            return numpy.arange(self.count)
+        if 'filtered' in query:
+            filtered = query['filtered']
+            inner = self.query_ids(filtered.get('query'))
+            if 'filter' not in filtered:
+                return inner
+            mask = self.filter_mask(filtered['filter'])
+            return inner[mask[inner]]
+        raise NotImplementedError('Unsupported query: {}'.format(list(query)))
+
+    def aggregate(self, aggregations, ids):
+        return {name: self._aggregation(spec, ids) for name, spec in aggregations.items()}
+
+    def _aggregation(self, spec, ids):
+        children = spec.get('aggregations', spec.get('aggs', {}))
+        if 'filter' in spec:
+            mask = self.filter_mask(spec['filter'])
+            matched = ids[mask[ids]]
+            result = self.aggregate(children, matched)
+            result['doc_count'] = len(matched)
+            return result
+        if 'terms' in spec:
+            return {'buckets': self._terms(spec['terms'], children, ids)}
+        raise NotImplementedError('Unsupported aggregation: {}'.format(list(spec)))
+
+    def _terms(self, terms, children, ids):
+        column = self.columns.get(terms['field'])
+        if column is None or not len(ids):
+            return []
+        codes = column.codes[ids]
+        present = codes >= 0
+        ids = ids[present]
+        codes = codes[present]
+
+        unique, inverse, counts = numpy.unique(codes, return_inverse=True, return_counts=True)
+        keys = [column.values[code] for code in unique]
+        # Like ES: biggest buckets first, ties broken by key.
+        order = sorted(range(len(unique)), key=lambda i: (-counts[i], keys[i]))
+        size = terms.get('size', 10)
+        if size:
+            order = order[:size]
+
+        if children:
+            by_bucket = ids[numpy.argsort(inverse, kind='mergesort')]
+            ends = numpy.cumsum(counts)
+            starts = ends - counts
+
+        buckets = []
+        for i in order:
+            bucket = {'key': keys[i], 'doc_count': int(counts[i])}
+            if children:
+                bucket.update(self.aggregate(children, by_bucket[starts[i]:ends[i]]))
+            buckets.append(bucket)
+        return buckets
+
+
+class _Indices(object):
+    """The ``es.indices`` half of ``FakeElasticsearch``."""
+    def __init__(self, es):
+        self.es = es
+
+    def create(self, index, body=None, **kwargs):
+        if index in self.es.indexes or index in self.es.aliases:
+            raise TransportError(400, 'IndexAlreadyExistsException[[{}] already exists]'.format(index))
+        self.es.indexes[index] = _Index((body or {}).get('settings'))
+        return {'acknowledged': True}
+
+    def delete(self, index, **kwargs):
+        if index not in self.es.indexes:
+            raise NotFoundError(404, 'IndexMissingException[[{}] missing]'.format(index))
+        del self.es.indexes[index]
+        for indexes in self.es.aliases.values():
+            indexes.discard(index)
+        return {'acknowledged': True}
+
+    def exists(self, index, **kwargs):
+        return index in self.es.indexes or bool(self.es.aliases.get(index))
+
+    def exists_alias(self, name, **kwargs):
+        return bool(self.es.aliases.get(name))
+
+    def get_alias(self, name, **kwargs):
+        if not self.es.aliases.get(name):
+            raise NotFoundError(404, 'alias [{}] missing'.format(name))
+        return {index: {'aliases': {name: {}}} for index in self.es.aliases[name]}
+
+    def get_aliases(self, index='*', **kwargs):
+        return {name: {'aliases': {alias: {} for alias, indexes in self.es.aliases.items()
+                                   if name in indexes}}
+                for name in self.es.indexes if fnmatch.fnmatchcase(name, index)}
+
+    def update_aliases(self, body, **kwargs):
+        for action in body['actions']:
+            (kind, spec), = action.items()
+            indexes = self.es.aliases.setdefault(spec['alias'], set())
+            if kind == 'add':
+                indexes.add(spec['index'])
+            else:
+                indexes.discard(spec['index'])
+        return {'acknowledged': True}
+
+    def refresh(self, index=None, **kwargs):
+        start = time.perf_counter()
+        for name in self.es.resolve(index):
+            self.es.indexes[name].refresh()
+        self.es.seconds += time.perf_counter() - start
+
+    def put_settings(self, body, index=None, **kwargs):
+        for name in self.es.resolve(index):
+            self.es.indexes[name].settings.update(body.get('index', body))
+        return {'acknowledged': True}
+
+    def optimize(self, index=None, **kwargs):
+        return {'_shards': {'failed': 0}}
+
+
+class FakeElasticsearch(object):
+    """An in-memory, single-shard stand-in for an ``Elasticsearch`` client."""
+    def __init__(self):
+        self.indexes = {}
+        self.aliases = {}
+        self.indices = _Indices(self)
+        self.seconds = 0.0
+        self.requests = 0
+        self._scrolls = {}
+        self._scroll_ids = itertools.count(1)
+
+    def resolve(self, name):
+        """Return the names of the indexes ``name`` refers to."""
+        if name is None or name == '_all':
+            return list(self.indexes)
+        if name in self.indexes:
+            return [name]
+        if self.aliases.get(name):
+            return sorted(self.aliases[name])
+        raise NotFoundError(404, 'IndexMissingException[[{}] missing]'.format(name))
+
+    def _index(self, name):
+        names = self.resolve(name)
+        if len(names) != 1:
+            raise NotImplementedError('Searching several indexes at once is not supported')
+        return self.indexes[names[0]]
+
+    def _timed(self, func, *args, **kwargs):
+        start = time.perf_counter()
+        self.requests += 1
+        try:
+            return func(*args, **kwargs)
+        finally:
+            self.seconds += time.perf_counter() - start
+
+    def search(self, index=None, body=None, search_type=None, scroll=None, size=None, **kwargs):
+        return self._timed(self._search, index, body or {}, search_type, size)
+
+    def _search(self, index, body, search_type, size):
+        start = time.perf_counter()
+        idx = self._index(index)
+        ids = idx.query_ids(body.get('query'))
+        res = {
+            'timed_out': False,
+            '_shards': {'total': 1, 'successful': 1, 'failed': 0},
+            'hits': {'total': len(ids), 'max_score': None, 'hits': []}
+        }
+
+        if search_type == 'scan':
+            size = size or body.get('size', DEFAULT_SIZE)
+            scroll_id = str(next(self._scroll_ids))
+            self._scrolls[scroll_id] = (idx, ids, 0, size, body.get('_source'))
+            res['_scroll_id'] = scroll_id
+        elif search_type != 'count':
+            size = size if size is not None else body.get('size', DEFAULT_SIZE)
+            res['hits']['hits'] = [self._hit(idx, doc_id, body.get('_source'))
+                                   for doc_id in ids[:size]]
+
+        aggregations = body.get('aggregations', body.get('aggs'))
+        if aggregations:
+            res['aggregations'] = idx.aggregate(aggregations, ids)
+
+        res['took'] = int((time.perf_counter() - start) * 1000)
+        return res
+
+    @staticmethod
+    def _hit(idx, doc_id, source):
+        return {'_id': str(doc_id), '_score': None, '_source': idx.source(doc_id, source)}
+
+    def scroll(self, scroll_id, scroll=None, **kwargs):
+        return self._timed(self._scroll, scroll_id)
+
+    def _scroll(self, scroll_id):
+        if scroll_id not in self._scrolls:
+            raise NotFoundError(404, 'SearchContextMissingException[No search context found]')
+        idx, ids, position, size, source = self._scrolls[scroll_id]
+        page = ids[position:position + size]
+        self._scrolls[scroll_id] = (idx, ids, position + size, size, source)
+        return {
+            '_scroll_id': scroll_id,
+            'took': 0,
+            'hits': {'total': len(ids),
+                     'hits': [self._hit(idx, doc_id, source) for doc_id in page]}
+        }
+
+    def clear_scroll(self, scroll_id=None, **kwargs):
+        self._scrolls.pop(scroll_id, None)
+        return {}
+
+    def msearch(self, body, index=None, **kwargs):
+        if isinstance(body, str):
+            body = [json.loads(line) for line in body.splitlines() if line.strip()]
+
+        responses = []
+        for header, search in zip(body[::2], body[1::2]):
+            try:
+                responses.append(self.search(index=header.get('index', index), body=search,
+                                             search_type=header.get('search_type')))
+            except (NotFoundError, NotImplementedError) as e:
+                responses.append({'error': str(e)})
+        return {'responses': responses}
+
+    def bulk(self, body, **kwargs):
+        return self._timed(self._bulk, body)
+
+    def _bulk(self, body):
+        start = time.perf_counter()
+        lines = body.splitlines() if isinstance(body, str) else body
+        items = []
+        for action_line, doc_line in zip(lines[::2], lines[1::2]):
+            action = json.loads(action_line) if isinstance(action_line, str) else action_line
+            meta = action['index']
+            name = meta['_index']
+            if name not in self.indexes and not self.aliases.get(name):
+                self.indices.create(name)
+            doc = json.loads(doc_line) if isinstance(doc_line, str) else doc_line
+            self._index(name).add(doc)
+            items.append({'index': {'_index': name, '_type': meta.get('_type'), 'status': 201}})
+        return {'took': int((time.perf_counter() - start) * 1000), 'errors': False, 'items': items}
@@ -0,0 +1,325 @@
+"""
+Benchmark loading, summarising and serving crimes against an in-process
+stand-in for Elasticsearch.
+
+Usage: python -m benchmarks.suite [--sizes N [N ...]] [--repeat N]
+                                  [--output FILE] [--compare COMMIT]
+
+For each size, that many synthetic crimes are bulk loaded into a
+``FakeElasticsearch`` and the suite measures summing crimes, building cell
+summaries, calculating averages, resolving cells, loading summaries, monthly
+summaries for a window of months and the compare API. Times spent inside the
+fake are reported separately where they are part of a measurement, as
+``es_seconds``.
+
+Each run is appended to ``--output`` as a JSON line tagged with the current
+commit. ``--compare`` prints how this run differs from the last run of that
+commit.
+"""
+import argparse
+import collections
+import datetime
+import json
+import os
+import platform
+import random
+import shutil
+import subprocess
+import tempfile
+import time
+import timeit
+
+from crime_stats import connections, crime_averager, load_crimes, models, summaries, util
+
+from .fake_es import FakeElasticsearch
+from .synthetic import NORTH, SOUTH, EAST, WEST, generate_crimes
+
+
+DEFAULT_SIZES = (10000, 100000)
+DEFAULT_OUTPUT = os.path.join(os.path.dirname(__file__), 'results.jsonl')
+
+INDEX = 'crimes_benchmark'
+YEAR = 2013
+PRECISION = 6
+
+# Most crimes summed by the get_crime_sums benchmark.
+MAX_SUMMED = 200000
+
+LOOKUPS = 10000
+API_REQUESTS = 500
+
+# Changes smaller than this fraction are not flagged by --compare.
+THRESHOLD = 0.1
+
+
+def best_of(func, repeat):
+    """Return the fastest of ``repeat`` calls to ``func``, in seconds."""
+    return min(timeit.repeat(func, number=1, repeat=repeat))
+
+
+def random_points(count, seed=1):
+    rng = random.Random(seed)
+    return [(rng.uniform(WEST, EAST), rng.uniform(SOUTH, NORTH)) for _ in range(count)]
+
+
+def bench_load(es, size):
+    crimes = (load_crimes.add_derived_fields(crime) for crime in generate_crimes(size))
+    es_seconds = es.seconds
+    loader = load_crimes.BulkLoader(es, index_name=INDEX).load(crimes)
+    return {
+        'seconds': loader.seconds,
+        'es_seconds': es.seconds - es_seconds,
+        'docs_per_second': loader.docs_per_second
+    }
+
+
+def bench_get_crime_sums(size, repeat):
+    crimes = list(generate_crimes(min(size, MAX_SUMMED)))
+    seconds = best_of(lambda: util.get_crime_sums(crimes), repeat)
+    batch_seconds = best_of(lambda: util.get_crime_sums_batch(crimes), repeat)
+    return {
+        'crimes': len(crimes),
+        'seconds': seconds,
+        'crimes_per_second': len(crimes) / seconds,
+        'batch_seconds': batch_seconds
+    }
+
+
+def bench_get_cell_sums(es, crimes):
+    es_seconds = es.seconds
+    start = time.perf_counter()
+    cell_sums = crimes.get_cell_sums(YEAR)
+    seconds = time.perf_counter() - start
+    start = time.perf_counter()
+    cell_summaries = summaries.CellSummaries.from_summaries(cell_sums)
+    return cell_summaries, {
+        'cells': len(cell_sums),
+        'seconds': seconds,
+        'es_seconds': es.seconds - es_seconds,
+        'from_summaries_seconds': time.perf_counter() - start
+    }
+
+
+def bench_window(crimes, root_dir, repeat):
+    """Time building a year's monthly summaries, which takes one search per
+    month, and summing and averaging a window of months from them."""
+    window = crime_averager.WindowAverager(crimes, root_dir, (YEAR, 3), (YEAR, 8))
+    start = time.perf_counter()
+    window.get_monthly_sums(YEAR)
+    build_seconds = time.perf_counter() - start
+
+    def average():
+        crime_averager.cache.clear()
+        crime_averager.WindowAverager(crimes, root_dir, (YEAR, 3), (YEAR, 8)).averages
+
+    return {
+        'build_seconds': build_seconds,
+        'averages_seconds': best_of(average, repeat)
+    }
+
+
+def bench_averages(averager, cell_summaries, repeat):
+    return {
+        'seconds': best_of(lambda: averager.calculate_averages_for_cells(cell_summaries), repeat),
+        'hourly_seconds': best_of(
+            lambda: averager.calculate_hourly_averages_for_cells(cell_summaries), repeat),
+        'daily_seconds': best_of(
+            lambda: averager.calculate_daily_averages_for_cells(cell_summaries), repeat)
+    }
+
+
+def bench_cell_resolution(crimes, repeat):
+    points = random_points(LOOKUPS)
+    crimes.get_populated_cells()
+
+    def locate():
+        for lon, lat in points:
+            crimes.locate_cell(lon, lat)
+
+    seconds = best_of(locate, repeat)
+    return {'lookups': LOOKUPS, 'seconds': seconds,
+            'lookups_per_second': LOOKUPS / seconds}
+
+
+def bench_summary_loading(averager, cell_summaries, repeat):
+    cell_summaries.save(averager.summaries_path)
+
+    def load_cached():
+        crime_averager.CachingCrimeAverager(
+            averager.crimes, averager.root_dir, averager.year).get_cell_sums()
+
+    def load():
+        crime_averager.cache.clear()
+        load_cached()
+
+    return {
+        'load_seconds': best_of(load, repeat),
+        'cached_seconds': best_of(load_cached, repeat)
+    }
+
+
+def _percentile(ordered, fraction):
+    return ordered[min(int(len(ordered) * fraction), len(ordered) - 1)]
+
+
+def bench_api(es, root_dir):
+    """Time CompareLocation for random points, first with an empty response
+    cache and then with a warm one, serving summaries and averages from
+    ``root_dir``. Needs Django and the radar settings."""
+    os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'radar.settings')
+    import django
+    from django.conf import settings
+    from django.contrib.auth.models import User
+    from django.core.cache import cache
+    from rest_framework.test import APIRequestFactory, force_authenticate
+
+    from api.views import CompareLocation
+
+    django.setup()
+    settings.CRIME_INDEX = INDEX
+    settings.DATA_DIR = root_dir
+    cache.clear()
+
+    factory = APIRequestFactory()
+    view = CompareLocation.as_view()
+    user = User(username='benchmark')
+    points = random_points(API_REQUESTS, seed=2)
+
+    results = {}
+    for name in ('cold', 'warm'):
+        latencies = []
+        es_seconds = es.seconds
+        start = time.perf_counter()
+        for lon, lat in points:
+            request = factory.get('/api/v1.0/crimes/compare/{}/{}/to/city-average/'.format(lon, lat))
+            force_authenticate(request, user=user)
+            request_start = time.perf_counter()
+            response = view(request, lon=str(lon), lat=str(lat))
+            response.render()
+            latencies.append((time.perf_counter() - request_start) * 1000)
+            if response.status_code != 200:
+                raise AssertionError('CompareLocation returned {}'.format(response.status_code))
+        seconds = time.perf_counter() - start
+
+        latencies.sort()
+        results[name] = {
+            'p50_ms': _percentile(latencies, 0.5),
+            'p95_ms': _percentile(latencies, 0.95),
+            'p99_ms': _percentile(latencies, 0.99),
+            'requests_per_second': len(points) / seconds,
+            'es_seconds': es.seconds - es_seconds
+        }
+    return results
+
+
+def run(size, repeat=3, api=True):
+    """Run every benchmark against ``size`` synthetic crimes and return the
+    results, keyed by benchmark."""
+    es = FakeElasticsearch()
+    connections.set_elasticsearch(es)
+    models.clear_populated_cells()
+    crime_averager.cache.clear()
+    root_dir = tempfile.mkdtemp()
+
+    try:
+        results = collections.OrderedDict()
+        results['load'] = bench_load(es, size)
+        results['get_crime_sums'] = bench_get_crime_sums(size, repeat)
+
+        crimes = models.Crimes(es, index=INDEX, precision=PRECISION)
+        averager = crime_averager.CachingCrimeAverager(crimes, root_dir, YEAR)
+        cell_summaries, results['get_cell_sums'] = bench_get_cell_sums(es, crimes)
+        results['calculate_averages_for_cells'] = bench_averages(averager, cell_summaries, repeat)
+        results['cell_resolution'] = bench_cell_resolution(crimes, repeat)
+        results['summary_loading'] = bench_summary_loading(averager, cell_summaries, repeat)
+        results['window'] = bench_window(crimes, root_dir, repeat)
+
+        if api:
+            util.write_pickled_file(averager.calculate_averages_for_cells(cell_summaries),
+                                    averager.averages_path)
+            results['api'] = bench_api(es, root_dir)
+    finally:
+        shutil.rmtree(root_dir)
+        connections.reset()
+
+    return results
+
+
+def current_commit():
+    try:
+        return subprocess.check_output(['git', 'rev-parse', '--short', 'HEAD'],
+                                       universal_newlines=True).strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def load_results(path):
+    if not os.path.exists(path):
+        return []
+    with open(path, 'r') as f:
+        return [json.loads(line) for line in f if line.strip()]
+
+
+def _metrics(results, prefix=''):
+    for name, value in results.items():
+        if isinstance(value, dict):
+            for item in _metrics(value, '{}{}.'.format(prefix, name)):
+                yield item
+        else:
+            yield prefix + name, value
+
+
+def compare(previous, current):
+    """Print each metric of ``current`` beside ``previous``, flagging changes
+    bigger than THRESHOLD."""
+    old = dict(_metrics(previous['results']))
+    for name, value in _metrics(current['results']):
+        if name not in old or not old[name]:
+            continue
+        ratio = value / old[name]
+        faster = ratio > 1 if name.endswith('per_second') else ratio < 1
+        flag = ''
+        if abs(ratio - 1) > THRESHOLD:
+            flag = 'better' if faster else 'WORSE'
+        print('  {:<50} {:>12.4g} {:>12.4g} {:>7.2f}x {}'.format(
+            name, old[name], value, ratio, flag))
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Benchmark crime_stats against a fake Elasticsearch.')
+    parser.add_argument('--sizes', type=int, nargs='+', default=DEFAULT_SIZES,
+                        help='Numbers of synthetic crimes to load, e.g. 10000 up to 10000000')
+    parser.add_argument('--repeat', type=int, default=3,
+                        help='Runs of each timing to take the best of')
+    parser.add_argument('--output', default=DEFAULT_OUTPUT,
+                        help='File to append results to')
+    parser.add_argument('--compare', metavar='COMMIT',
+                        help='Compare with the last results recorded for COMMIT')
+    parser.add_argument('--no-api', action='store_true',
+                        help="Skip the API benchmark, which needs Django's settings")
+    args = parser.parse_args()
+
+    history = load_results(args.output)
+    commit = current_commit()
+    for size in args.sizes:
+        record = {
+            'commit': commit,
+            'date': datetime.datetime.utcnow().isoformat(),
+            'python': platform.python_version(),
+            'size': size,
+            'repeat': args.repeat,
+            'results': run(size, repeat=args.repeat, api=not args.no_api)
+        }
+        with open(args.output, 'a') as f:
+            f.write(json.dumps(record) + '\n')
+
+        print('{} crimes'.format(size))
+        print(json.dumps(record['results'], indent=2))
+        if args.compare:
+            previous = [r for r in history
+                        if r['size'] == size and (r['commit'] or '').startswith(args.compare)]
+            if previous:
+                print('Compared with {}:'.format(args.compare))
+                compare(previous[-1], record)
+            else:
+                print('No results for {} at size {}'.format(args.compare, size))
@@ -0,0 +1,104 @@
+"""
+Generate synthetic Portland crimes for benchmarks.
+
+Usage: python -m benchmarks.synthetic <count> [seed] > crimes.json
+
+Crimes are GeoJSON features like those in data/crimes_*.json. Most cluster
+around a few dozen hotspots and the rest are spread across the city, so
+cells have the uneven counts real data has. The same count and seed always
+give the same crimes.
+"""
+import bisect
+import datetime
+import itertools
+import json
+import random
+import sys
+
+
+# Roughly the bounds of Portland.
+SOUTH, NORTH = 45.43, 45.65
+WEST, EAST = -122.84, -122.47
+
+HOTSPOTS = 40
+HOTSPOT_SHARE = 0.7
+HOTSPOT_SPREAD = 0.01  # degrees
+
+# Crime types and their rough share of reports.
+CRIME_TYPES = [
+    ('Larceny', 30), ('Vandalism', 10), ('Motor Vehicle Theft', 8),
+    ('Burglary', 8), ('Assault, Simple', 7), ('Drugs', 5), ('Fraud', 4),
+    ('Disorderly Conduct', 4), ('Trespass', 3), ('Liquor Laws', 3),
+    ('DUII', 3), ('Robbery', 2), ('Aggravated Assault', 2), ('Forgery', 2),
+    ('Stolen Property', 1), ('Weapons', 1), ('Runaway', 1), ('Prostitution', 1),
+    ('Sex Offenses', 1), ('Rape', 0.5), ('Arson', 0.5), ('Embezzlement', 0.5),
+    ('Offenses Against Family', 0.5), ('Kidnap', 0.2), ('Curfew', 0.2),
+    ('Gambling', 0.1), ('Homicide', 0.1),
+]
+
+# Relative number of reports in each hour of the day.
+HOUR_WEIGHTS = [4, 3, 3, 2, 1, 1, 2, 3, 4, 5, 5, 5, 6, 5, 5, 5, 6, 6, 6, 6, 6, 6, 5, 5]
+
+
+class _WeightedChoice(object):
+    def __init__(self, choices, weights):
+        self.choices = list(choices)
+        self.cumulative = list(itertools.accumulate(weights))
+
+    def __call__(self, rng):
+        i = bisect.bisect(self.cumulative, rng.random() * self.cumulative[-1])
+        return self.choices[min(i, len(self.choices) - 1)]
+
+
+def generate_crimes(count, year=2013, seed=0):
+    """Yield ``count`` synthetic crime features reported during ``year``."""
+    rng = random.Random(seed)
+    hotspots = [(rng.uniform(SOUTH, NORTH), rng.uniform(WEST, EAST))
+                for _ in range(HOTSPOTS)]
+    choose_type = _WeightedChoice(*zip(*CRIME_TYPES))
+    choose_hour = _WeightedChoice(range(24), HOUR_WEIGHTS)
+    start = datetime.datetime(year, 1, 1)
+    days = (datetime.datetime(year + 1, 1, 1) - start).days
+
+    for i in range(count):
+        if rng.random() < HOTSPOT_SHARE:
+            lat, lon = rng.choice(hotspots)
+            lat = min(max(rng.gauss(lat, HOTSPOT_SPREAD), SOUTH), NORTH)
+            lon = min(max(rng.gauss(lon, HOTSPOT_SPREAD), WEST), EAST)
+        else:
+            lat = rng.uniform(SOUTH, NORTH)
+            lon = rng.uniform(WEST, EAST)
+
+        report_time = start + datetime.timedelta(days=rng.randrange(days),
+                                                 hours=choose_hour(rng),
+                                                 minutes=rng.randrange(60))
+
+        yield {
+            'type': 'Feature',
+            'id': i,
+            'geometry': {'type': 'Point', 'coordinates': [round(lon, 6), round(lat, 6)]},
+            'properties': {
+                'crimeType': choose_type(rng),
+                'reportTime': report_time.strftime('%Y-%m-%dT%H:%M:%S')
+            }
+        }
+
+
+def write_feature_collection(f, crimes):
+    """Write ``crimes`` to ``f`` as a GeoJSON FeatureCollection, one at a
+    time."""
+    f.write('{"type": "FeatureCollection", "features": [\n')
+    for i, crime in enumerate(crimes):
+        if i:
+            f.write(',\n')
+        f.write(json.dumps(crime))
+    f.write('\n]}\n')
+
+
+if __name__ == '__main__':
+    if len(sys.argv) not in (2, 3):
+        print('Usage: python -m benchmarks.synthetic <count> [seed] > crimes.json')
+        exit(1)
+
+    seed = int(sys.argv[2]) if len(sys.argv) > 2 else 0
+    write_feature_collection(sys.stdout, generate_crimes(int(sys.argv[1]), seed=seed))
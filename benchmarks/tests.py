@@ -0,0 +1,92 @@
+import collections
+import os
+import shutil
+import tempfile
+
+import geohash
+from django.test import SimpleTestCase
+
+from crime_stats import crime_averager, index, load_crimes, models, util
+
+from .fake_es import FakeElasticsearch
+from .synthetic import generate_crimes, write_feature_collection
+
+
+class TestFakeElasticsearch(SimpleTestCase):
+    """The fake should give the same answers as summing the crimes directly."""
+    def setUp(self):
+        self.es = FakeElasticsearch()
+        self.crimes = [load_crimes.add_derived_fields(crime)
+                       for crime in generate_crimes(2000)]
+        load_crimes.BulkLoader(self.es, index_name='crimes', chunk_size=300).load(self.crimes)
+        self.models = models.Crimes(self.es, index='crimes', precision=6)
+
+        by_cell = collections.defaultdict(list)
+        for crime in self.crimes:
+            by_cell[crime['properties']['geohash_6']].append(crime)
+        self.expected = {cell_hash: util.get_crime_sums(crimes)
+                         for cell_hash, crimes in by_cell.items()}
+
+    def test_get_cell_sums(self):
+        """Aggregated cell sums should match summing each cell's crimes"""
+        self.assertEqual(self.expected, dict(self.models.get_cell_sums(2013)))
+        other_year = self.models.get_cell_sums(2014)
+        self.assertTrue(all(not summary['by_type'] for summary in other_year.values()))
+
+    def test_get_cell_sums_for_a_month(self):
+        """Cell sums for a month should match summing the crimes reported during it"""
+        march = [crime for crime in self.crimes
+                 if crime['properties']['reportTime'].startswith('2013-03')]
+        expected = util.get_crime_sums(march)['by_type']
+        sums = collections.Counter()
+        for summary in self.models.get_cell_sums(2013, 3).values():
+            sums.update(summary['by_type'])
+        self.assertEqual(expected, dict(sums))
+
+    def test_window_averager(self):
+        """A window's summaries should sum the monthly summaries built from the fake"""
+        root_dir = tempfile.mkdtemp()
+        try:
+            window = crime_averager.WindowAverager(self.models, root_dir, (2013, 2), (2013, 4))
+            spring = [crime for crime in self.crimes
+                      if '2013-02' <= crime['properties']['reportTime'][:7] <= '2013-04']
+            sums = collections.Counter()
+            for summary in window.get_cell_sums().values():
+                sums.update(summary['by_type'])
+            self.assertEqual(util.get_crime_sums(spring)['by_type'], dict(sums))
+            self.assertTrue(window.averages)
+        finally:
+            shutil.rmtree(root_dir)
+
+    def test_get_sums_for_cells(self):
+        """Sums from msearch should match summing each cell's crimes"""
+        cell_hashes = sorted(self.expected)[:10]
+        sums = self.models.get_sums_for_cells(cell_hashes, 2013)
+        self.assertEqual([self.expected[h] for h in cell_hashes], list(sums.values()))
+
+    def test_scroll_through_cell(self):
+        """Scrolling through a cell should return each of its crimes once"""
+        cell_hash = max(self.expected, key=lambda h: sum(self.expected[h]['by_type'].values()))
+        scroll = self.models.get_crimes_within_cell(geohash.bbox(cell_hash), 2013,
+                                                    source=models.SUMMARY_FIELDS,
+                                                    page_size=7)
+        self.assertEqual(self.expected[cell_hash], util.get_crime_sums(scroll))
+        self.assertGreater(scroll.pages, 1)
+        self.assertEqual({}, self.es._scrolls)
+
+    def test_reindex(self):
+        """Reindexing should load a new version behind the alias"""
+        root_dir = tempfile.mkdtemp()
+        try:
+            filename = os.path.join(root_dir, 'crimes.json')
+            with open(filename, 'w') as f:
+                write_feature_collection(f, generate_crimes(50))
+            es = FakeElasticsearch()
+            load_crimes.reindex(filename, es=es, alias='crimes')
+            load_crimes.reindex(filename, es=es, alias='crimes')
+        finally:
+            shutil.rmtree(root_dir)
+
+        self.assertEqual(['crimes_v2'], index.get_aliased_indexes(es, 'crimes'))
+        res = es.search(index='crimes', search_type='count', body={})
+        self.assertEqual(50, res['hits']['total'])
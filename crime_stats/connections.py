@@ -0,0 +1,78 @@
+"""
+A process-wide Elasticsearch client shared by views, loaders and scripts.
+"""
+import os
+import threading
+
+from django.conf import settings
+from django.core.exceptions import ImproperlyConfigured
+from elasticsearch import ConnectionError, Elasticsearch
+
+
+# The status ES gives requests and bulk items it rejected because it is busy.
+TOO_MANY_REQUESTS = 429
+
+_lock = threading.Lock()
+_client = None
+_client_pid = None
+
+
+def get_options():
+    """Return keyword arguments for ``Elasticsearch`` from Django settings.
+
+    Falls back to the client's defaults when run outside of Django, e.g. from
+    ``python -m crime_stats.load_crimes``.
+    """
+    try:
+        options = getattr(settings, 'ELASTICSEARCH', {})
+    except ImproperlyConfigured:
+        options = {}
+    return dict(options)
+
+
+def is_retryable(error):
+    """Return whether the ``TransportError`` ``error`` is worth retrying:
+    ES was unreachable or rejected the request because it is busy."""
+    return isinstance(error, ConnectionError) or error.status_code == TOO_MANY_REQUESTS
+
+
+def get_elasticsearch():
+    """Return the Elasticsearch client for this process.
+
+    The client (and its connection pool) is created on first use and reused
+    afterward. Sockets must not be shared between a parent process and its
+    forks, so a gunicorn worker forked after the client was created gets a
+    fresh one of its own.
+    """
+    global _client, _client_pid
+
+    pid = os.getpid()
+    if _client is not None and _client_pid == pid:
+        return _client
+
+    with _lock:
+        if _client is None or _client_pid != pid:
+            options = get_options()
+            hosts = options.pop('hosts', None)
+            _client = Elasticsearch(hosts, **options)
+            _client_pid = pid
+    return _client
+
+
+def set_elasticsearch(client):
+    """Use ``client`` as this process's client, e.g. a stand-in for
+    Elasticsearch in benchmarks."""
+    global _client, _client_pid
+
+    with _lock:
+        _client = client
+        _client_pid = os.getpid()
+
+
+def reset():
+    """Drop the shared client so the next call creates a new one."""
+    global _client, _client_pid
+
+    with _lock:
+        _client = None
+        _client_pid = None
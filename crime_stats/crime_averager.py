@@ -1,78 +1,768 @@
 """
 Code to generate Portland crime averages for a given year.
 """
+import collections
 import os
-import statistics
+import threading
 
-from . import util
+import geohash
+import numpy
+
+from . import index, models, summaries, timing, util
+
+
+# Maximum number of averages and summaries kept in memory by each process.
+CACHE_SIZE = 32
+
+# Summaries are fetched from the crimes at this precision only. Summaries at
+# coarser precisions are rolled up from them, so one search serves the
+# whole pyramid of GEOHASH_PRECISIONS.
+PYRAMID_PRECISION = max(index.GEOHASH_PRECISIONS)
+
+
+def neighbourhood(cell_hash):
+    """Return the geohash ``cell_hash`` followed by its 8 neighbours."""
+    return [cell_hash] + geohash.neighbors(cell_hash)
+
+
+def weighting_cell(lon, lat, precision):
+    """Return the geohash of the cell, one precision finer than
+    ``precision``, whose centre stands in for (lon, lat) when weighting
+    neighbouring cells.
+
+    Points in the same finer cell get the same weights, so their responses
+    can be cached together.
+    """
+    return geohash.encode(lat, lon, precision + 1)
+
+
+def neighbourhood_weights(lon, lat, cell_hashes):
+    """Weight each cell in ``cell_hashes`` as 1 / (1 + d ** 2), where ``d``
+    is the distance from (lon, lat) to its centre in cell widths and heights.
+
+    The cell a point is centred in gets 1 and its neighbours 1/2 or 1/3; a
+    neighbour across a nearby edge gets nearly as much as the point's own
+    cell.
+    """
+    weights = []
+    for cell_hash in cell_hashes:
+        center_lat, center_lon, lat_error, lon_error = geohash.decode_exactly(cell_hash)
+        dx = (lon - center_lon) / (2 * lon_error)
+        dy = (lat - center_lat) / (2 * lat_error)
+        weights.append(1 / (1 + dx ** 2 + dy ** 2))
+    return weights
+
+
+def _columns(counts):
+    """Flatten all but the first (cell) axis of ``counts``."""
+    counts = numpy.asarray(counts)
+    shape = counts.shape[1:]
+    return counts.reshape(counts.shape[0], int(numpy.prod(shape))), shape
+
+
+def nonzero_medians(counts):
+    """Return the median of the non-zero values along the first axis of
+    ``counts``, and how many non-zero values there were.
+
+    Cells without any crimes of a type are left out of its median, and the
+    median of an even number of values is the mean of the middle two, as
+    with ``statistics.median``. Medians of all-zero columns are 0.
+    """
+    flat, shape = _columns(counts)
+    n = (flat > 0).sum(axis=0)
+    if not flat.shape[0]:
+        return numpy.zeros(shape), n.reshape(shape)
+
+    # Zeros sort first, so the non-zero values of each column sit at the end.
+    ordered = numpy.sort(flat, axis=0)
+    zeros = flat.shape[0] - n
+    last = flat.shape[0] - 1
+    low = numpy.minimum(zeros + (n - 1) // 2, last)
+    high = numpy.minimum(zeros + n // 2, last)
+    columns = numpy.arange(flat.shape[1])
+    medians = (ordered[low, columns] + ordered[high, columns]) / 2.0
+    medians[n == 0] = 0
+    return medians.reshape(shape), n.reshape(shape)
+
+
+def nonzero_stats(counts, quantiles=(0.25, 0.75)):
+    """Return statistics of the non-zero values along the first axis of
+    ``counts``.
+
+    Returns a dict of arrays shaped like one cell of ``counts``: ``cells``
+    (how many cells had crimes), ``median``, ``mean``, ``std`` and, for each
+    of ``quantiles``, a linearly interpolated quantile keyed by the quantile.
+    """
+    flat, shape = _columns(counts)
+    medians, n = nonzero_medians(counts)
+    nonzero = flat > 0
+    cells = nonzero.sum(axis=0)
+    divisor = numpy.maximum(cells, 1)
+    mean = flat.sum(axis=0) / divisor
+    variance = numpy.where(nonzero, (flat - mean) ** 2, 0).sum(axis=0) / divisor
+
+    stats = {
+        'cells': n,
+        'median': medians,
+        'mean': mean.reshape(shape),
+        'std': numpy.sqrt(variance).reshape(shape)
+    }
+
+    if flat.shape[0]:
+        ordered = numpy.sort(flat, axis=0)
+        zeros = flat.shape[0] - cells
+        columns = numpy.arange(flat.shape[1])
+        for q in quantiles:
+            position = zeros + q * numpy.maximum(cells - 1, 0)
+            low = numpy.minimum(numpy.floor(position).astype(int), flat.shape[0] - 1)
+            high = numpy.minimum(numpy.ceil(position).astype(int), flat.shape[0] - 1)
+            fraction = position - numpy.floor(position)
+            values = ordered[low, columns] * (1 - fraction) + ordered[high, columns] * fraction
+            values[cells == 0] = 0
+            stats[q] = values.reshape(shape)
+    else:
+        for q in quantiles:
+            stats[q] = numpy.zeros(shape)
+
+    return stats
+
+
+def _median_value(median, n):
+    """Convert a median from ``nonzero_medians`` to the type that
+    ``statistics.median`` would return for integer counts."""
+    if n % 2:
+        return int(median)
+    return float(median)
+
+
+class FileCache(object):
+    """A thread-safe LRU cache of data loaded from files.
+
+    Entries remember the modification time of the file they were loaded from
+    and are reloaded when it changes, so a rebuilt file is picked up without
+    restarting the process.
+    """
+    def __init__(self, maxsize=CACHE_SIZE):
+        self.maxsize = maxsize
+        self._entries = collections.OrderedDict()
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def _mtime(path):
+        try:
+            return os.stat(path).st_mtime
+        except OSError:
+            return None
+
+    def get(self, key, path, load):
+        """Return the cached value for ``key``.
+
+        Calls ``load()`` if there is no entry for ``key`` or ``path`` has
+        changed since it was cached. ``load`` may write ``path`` itself.
+        """
+        mtime = self._mtime(path)
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None and entry[0] == mtime:
+                self._entries.move_to_end(key)
+                timing.add('file_cache_hits')
+                return entry[1]
+
+        timing.add('file_cache_misses')
+        value = load()
+        if mtime is None:
+            mtime = self._mtime(path)
+
+        with self._lock:
+            self._entries[key] = (mtime, value)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.maxsize:
+                self._entries.popitem(last=False)
+        return value
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+
+# Shared by every CachingCrimeAverager in the process.
+cache = FileCache()
 
 
 class CachingCrimeAverager(object):
     """Calculates the median average for crime types.
 
-    Caches the averages in a pickle file at ``averages_path`` and crime sums
-    in ``summaries_path``.
+    Caches the averages in a pickle file at ``averages_path`` and crime sums,
+    keyed by geohash, as ``summaries.CellSummaries`` in ``summaries_path``.
+    Both default to files in ``root_dir`` named for the year and the
+    precision of ``crimes``; the summaries file has a .json suffix, so
+    pickled summaries left by older versions under the same name are ignored
+    and rebuilt. Once loaded, both are also kept in memory in ``cache`` for
+    later requests.
+
+    Summaries at precisions coarser than PYRAMID_PRECISION are rolled up
+    from the summaries at PYRAMID_PRECISION, which are built first if need
+    be, rather than fetched from the crimes.
     """
     def __init__(self, crimes, root_dir, year, averages_path=None, summaries_path=None):
         self.crimes = crimes
         self.root_dir = root_dir
-        self.year = year
+        self.year = int(year)
+        # What the averages cover, as named in API cache keys.
+        self.period = self.year
         self._averages = None
+        self._cell_sums = None
 
         if not averages_path:
-            averages_path = os.path.join(root_dir, 'crime_averages_{}'.format(year))
+            averages_path = os.path.join(root_dir, 'crime_averages_{}_{}'.format(
+                self.year, crimes.precision))
         self.averages_path = averages_path
 
         if not summaries_path:
-            summaries_path = os.path.join(self.root_dir, 'crime_summaries_{}'.format(year))
+            summaries_path = os.path.join(self.root_dir, 'crime_summaries_{}_{}.json'.format(
+                self.year, crimes.precision))
         self.summaries_path = summaries_path
 
+    def at_precision(self, precision):
+        """Return an averager for the same crimes and year at ``precision``,
+        keeping its files in the same directory."""
+        return CachingCrimeAverager(self.crimes.at_precision(precision),
+                                    self.root_dir, self.year)
+
     def get_cell_sums(self):
-        """Returns summaries of all crime activity.
+        """Returns summaries of all crime activity, keyed by geohash.
 
         If the summaries file doesn't exist, calculates summary data for all crimes in the ES
-        store and pickles a dict containing this data to self.summaries_path.
+        store and saves it as ``summaries.CellSummaries`` to self.summaries_path.
+        """
+        if self._cell_sums is None:
+            self._cell_sums = cache.get(self._cache_key(self.summaries_path),
+                                        self.summaries_path,
+                                        self._load_cell_sums)
+        return self._cell_sums
+
+    def _cache_key(self, path):
+        return (self.crimes.index, self.year, self.crimes.precision, path)
+
+    def _load_cell_sums(self):
+        # Summaries change when the crimes do, e.g. after a reindex, and so
+        # may the populated cells.
+        models.clear_populated_cells(self.crimes.index, self.crimes.precision)
+        return self._load_or_build(
+            self.summaries_path,
+            summaries.CellSummaries.load,
+            self._fetch_cell_sums,
+            lambda cell_sums, path: cell_sums.save(path))
+
+    def _fetch_cell_sums(self):
+        """Calculate the summaries, rolling them up from the stored summaries
+        at PYRAMID_PRECISION if this precision is coarser."""
+        if self.crimes.precision < PYRAMID_PRECISION:
+            finest = self.at_precision(PYRAMID_PRECISION).get_cell_sums()
+            return finest.rollup(self.crimes.precision)
+        return summaries.CellSummaries.from_summaries(
+            self.crimes.get_cell_sums(self.year))
+
+    @staticmethod
+    def _load_or_build(path, load=util.load_pickled_file, build=None,
+                       write=util.write_pickled_file):
+        """Load the data at ``path``, or build it with ``build()`` and write
+        it there.
+
+        Only one process builds a missing file at a time; the others wait for
+        it and then load what it wrote.
         """
         try:
-            cell_summaries = util.load_pickled_file(self.summaries_path)
+            return load(path)
         except OSError:
-            cells = self.crimes.get_cells()
-            cell_summaries = self.crimes.sum_crimes_in_cells(cells, self.year)
-            util.write_pickled_file(cell_summaries, self.summaries_path)
-        return cell_summaries
+            pass
+
+        with util.file_lock(path):
+            try:
+                return load(path)
+            except OSError:
+                obj = build()
+                write(obj, path)
+                return obj
+
+    def is_built(self):
+        """Return whether the summaries and averages files exist, so using
+        them won't have to calculate them from ES first."""
+        return os.path.exists(self.summaries_path) and os.path.exists(self.averages_path)
+
+    def version(self):
+        """Return the modification times, in nanoseconds, of the summaries
+        and averages files, which change whenever either is rebuilt or
+        updated."""
+        return (os.stat(self.summaries_path).st_mtime_ns,
+                os.stat(self.averages_path).st_mtime_ns)
+
+    def last_modified(self):
+        """Return when the summaries or averages file last changed, as a
+        timestamp."""
+        return max(self.version()) / 1e9
+
+    def rebuild(self):
+        """Recalculate the summaries and averages from ES and replace the
+        stored files.
+
+        At a precision in the pyramid, the summaries are fetched once at
+        PYRAMID_PRECISION and every level of the pyramid is replaced with
+        summaries and averages rolled up from them. Other processes keep
+        using the old files until the new ones are in place.
+        """
+        precision = self.crimes.precision
+        if precision not in index.GEOHASH_PRECISIONS:
+            self._replace(summaries.CellSummaries.from_summaries(
+                self.crimes.get_cell_sums(self.year)))
+            return
+
+        finest = self if precision == PYRAMID_PRECISION else self.at_precision(PYRAMID_PRECISION)
+        cell_sums = summaries.CellSummaries.from_summaries(
+            finest.crimes.get_cell_sums(self.year))
+        for level in sorted(index.GEOHASH_PRECISIONS, reverse=True):
+            averager = self if level == precision else self.at_precision(level)
+            averager._replace(cell_sums.rollup(level))
+
+    def _replace(self, cell_sums):
+        """Replace the stored summaries with ``cell_sums`` and the stored
+        averages with averages calculated from them."""
+        with util.file_lock(self.summaries_path):
+            cell_sums.save(self.summaries_path)
+
+        averages = self.calculate_averages_for_cells(cell_sums)
+        with util.file_lock(self.averages_path):
+            util.write_pickled_file(averages, self.averages_path)
+
+        self._cell_sums = None
+        self._averages = None
+
+    def apply_deltas(self, cell_sums):
+        """Add ``cell_sums``, crime summaries of newly loaded crimes keyed by
+        geohash, to the stored summaries and averages for this year.
+
+        Only the cells in ``cell_sums`` change, and medians are recalculated
+        only for the crime types they contain. Files that haven't been built
+        yet are left alone, since building them will include the new crimes.
+        """
+        deltas = summaries.CellSummaries.from_summaries(cell_sums)
+
+        with util.file_lock(self.summaries_path):
+            try:
+                cell_sums = summaries.CellSummaries.load(self.summaries_path)
+            except OSError:
+                return
+            cell_sums = cell_sums.add(deltas)
+            cell_sums.save(self.summaries_path)
+        self._cell_sums = None
+
+        with util.file_lock(self.averages_path):
+            try:
+                averages = util.load_pickled_file(self.averages_path)
+            except OSError:
+                return
+            columns = [cell_sums.crime_types.index(crime_type)
+                       for crime_type in deltas.crime_types]
+            averages.update(self._medians_by_type(cell_sums.by_type[:, columns],
+                                                  deltas.crime_types))
+            util.write_pickled_file(averages, self.averages_path)
+        self._averages = None
+
+    def get_location_sums(self, lon, lat):
+        """Return the crime summary for the cell that (lon, lat) falls within.
+
+        The summary comes from the summaries file. ES is only searched if the
+        cell is missing from it.
+        """
+        with timing.timed('cell'):
+            cell_hash = self.crimes.get_cell_hash(lon, lat)
+        with timing.timed('summaries'):
+            cell_sums = self.get_cell_sums()
+            if cell_hash in cell_sums:
+                return cell_sums[cell_hash]
+
+        with timing.timed('search'):
+            crimes = self.crimes.get_crimes_near_coordinate(
+                lon, lat, year=self.year, source=models.SUMMARY_FIELDS)
+            return util.get_crime_sums(crimes)
+
+    def get_locations_sums(self, coordinates):
+        """Return the crime summary for the cell each (lon, lat) pair in
+        ``coordinates`` falls within, in the same order.
+
+        Each cell is only looked up once. Cells missing from the summaries
+        file are searched together in a single ES request.
+        """
+        cell_hashes = [self.crimes.get_cell_hash(lon, lat) for lon, lat in coordinates]
+        cell_sums = self.get_cell_sums()
+        missing = collections.OrderedDict.fromkeys(
+            cell_hash for cell_hash in cell_hashes if cell_hash not in cell_sums)
+        sums = dict(self.crimes.get_sums_for_cells(missing, self.year))
+        for cell_hash in set(cell_hashes) - set(sums):
+            sums[cell_hash] = cell_sums[cell_hash]
+        return [sums[cell_hash] for cell_hash in cell_hashes]
+
+    def get_neighbourhood_sums(self, lon, lat, weighted=False):
+        """Return the mean crime summary of the cell that (lon, lat) falls
+        within and its 8 neighbours, which is less noisy than the one cell's
+        summary for points near its edges.
+
+        With ``weighted``, nearer cells count for more; see
+        ``neighbourhood_weights``. Counts are per cell, like the city
+        averages, and rounded to 2 decimal places.
+        """
+        with timing.timed('cell'):
+            cell_hashes = neighbourhood(self.crimes.get_cell_hash(lon, lat))
+            weights = None
+            if weighted:
+                center_lat, center_lon = geohash.decode(
+                    weighting_cell(lon, lat, self.crimes.precision))
+                weights = neighbourhood_weights(center_lon, center_lat, cell_hashes)
+        return self._summaries_of(cell_hashes).mean(cell_hashes, weights)
+
+    def _summaries_of(self, cell_hashes):
+        """Return ``summaries.CellSummaries`` with every cell in
+        ``cell_hashes`` that has crimes.
+
+        Populated cells missing from the summaries file are searched together
+        in a single request.
+        """
+        with timing.timed('summaries'):
+            cell_sums = self.get_cell_sums()
+            missing = [cell_hash for cell_hash in cell_hashes if cell_hash not in cell_sums]
+        if missing:
+            missing = [cell_hash for cell_hash in missing
+                       if cell_hash in self.crimes.get_populated_cells()]
+        if not missing:
+            return cell_sums
+
+        with timing.timed('search'):
+            searched = self.crimes.get_sums_for_cells(missing, self.year)
+        return cell_sums.select(cell_hashes).add(searched)
+
+    @staticmethod
+    def _as_cell_summaries(cell_sums):
+        if isinstance(cell_sums, summaries.CellSummaries):
+            return cell_sums
+        return summaries.CellSummaries.from_summaries(
+            collections.OrderedDict(enumerate(cell_sums)))
+
+    @staticmethod
+    def _medians_by_type(counts, crime_types):
+        """Map each crime type to the median of its non-zero counts in
+        ``counts``, a (cells x crime types) array, skipping types that no
+        cell had."""
+        medians, n = nonzero_medians(counts)
+        return {crime_type: _median_value(medians[i], n[i])
+                for i, crime_type in enumerate(crime_types) if n[i]}
 
     def calculate_averages_for_cells(self, cell_sums):
-        """Calculate the median average of crimes by type for all geohash cells that we know about."""
-        sums_by_type = {}
-        averages = {}
+        """Calculate the median average of crimes by type for all geohash cells that we know about.
 
-        for sums in cell_sums:
-            by_type = sums['by_type']
+        ``cell_sums`` is a ``summaries.CellSummaries`` or an iterable of
+        crime summaries.
+        """
+        cell_sums = self._as_cell_summaries(cell_sums)
+        return self._medians_by_type(cell_sums.by_type, cell_sums.crime_types)
+
+    def calculate_hourly_averages_for_cells(self, cell_sums):
+        """Calculate the median average of crimes by type for each hour of
+        the day, shaped like ``types_by_hour`` in a crime summary."""
+        cell_sums = self._as_cell_summaries(cell_sums)
+        return {hour: self._medians_by_type(cell_sums.by_hour[:, hour, :],
+                                            cell_sums.crime_types)
+                for hour in range(summaries.HOURS)}
 
-            for crime_type, crime_type_sum in by_type.items():
-                if crime_type in sums_by_type:
-                    sums_by_type[crime_type].append(crime_type_sum)
-                else:
-                    sums_by_type[crime_type] = [crime_type_sum]
+    def calculate_daily_averages_for_cells(self, cell_sums):
+        """Calculate the median average of crimes by type for each day of
+        the week, shaped like ``types_by_day`` in a crime summary."""
+        cell_sums = self._as_cell_summaries(cell_sums)
+        return {day: self._medians_by_type(cell_sums.by_day[:, day, :],
+                                           cell_sums.crime_types)
+                for day in range(summaries.DAYS)}
 
-        for crime_type, crime_sums in sums_by_type.items():
-            averages[crime_type] = statistics.median(crime_sums)
+    def calculate_stats_for_cells(self, cell_sums, quantiles=(0.25, 0.75)):
+        """Calculate statistics of crimes by type across geohash cells.
 
-        return averages
+        Returns a dict mapping each crime type to the values from
+        ``nonzero_stats`` for it.
+        """
+        cell_sums = self._as_cell_summaries(cell_sums)
+        stats = nonzero_stats(cell_sums.by_type, quantiles=quantiles)
+        return {crime_type: {name: values[i].item() for name, values in stats.items()}
+                for i, crime_type in enumerate(cell_sums.crime_types)
+                if stats['cells'][i]}
 
     @property
     def averages(self):
         """Return a dict containing data on crime averages per geohash cell.
 
-        Attempts to load the data from ``path``. If that file does not exist,
-        the data will be calculated for year ``year``.
+        Attempts to load the data from ``averages_path``. If that file does
+        not exist, the data will be calculated for year ``year`` and written
+        there.
+        """
+        if self._averages is None:
+            with timing.timed('averages'):
+                self._averages = cache.get(self._cache_key(self.averages_path),
+                                           self.averages_path,
+                                           self._load_averages)
+        return self._averages
+
+    def _load_averages(self):
+        return self._load_or_build(
+            self.averages_path,
+            build=lambda: self.calculate_averages_for_cells(self.get_cell_sums()))
+
+    @property
+    def hourly_averages(self):
+        """Return median averages of crimes by type for each hour of the day.
+
+        Calculated from the cell summaries and cached in memory with them.
         """
-        if self._averages:
-            return self._averages
+        with timing.timed('averages'):
+            return cache.get(self._cache_key(self.summaries_path + ':hourly'),
+                             self.summaries_path,
+                             lambda: self.calculate_hourly_averages_for_cells(self.get_cell_sums()))
+
+    @property
+    def daily_averages(self):
+        """Return median averages of crimes by type for each day of the week.
+
+        Calculated from the cell summaries and cached in memory with them.
+        """
+        with timing.timed('averages'):
+            return cache.get(self._cache_key(self.summaries_path + ':daily'),
+                             self.summaries_path,
+                             lambda: self.calculate_daily_averages_for_cells(self.get_cell_sums()))
+
+
+class WindowAverager(CachingCrimeAverager):
+    """Calculates the median average for crime types over a run of months,
+    which may span several years.
+
+    ``start`` and ``end`` are (year, month) pairs and both months are
+    included. Summaries of each month of each year are kept as
+    ``summaries.MonthlySummaries`` in files in ``root_dir`` named for the
+    year and precision, and the window's summaries are summed from slices of
+    them. Averages are calculated from those summaries and only kept in
+    memory, in ``cache``.
+    """
+    def __init__(self, crimes, root_dir, start, end):
+        start = (int(start[0]), int(start[1]))
+        end = (int(end[0]), int(end[1]))
+        if not (1 <= start[1] <= summaries.MONTHS and 1 <= end[1] <= summaries.MONTHS) or start > end:
+            raise ValueError('Invalid window from {}-{} to {}-{}'.format(*(start + end)))
+
+        self.crimes = crimes
+        self.root_dir = root_dir
+        self.start = start
+        self.end = end
+        self.year = start[0]
+        self.period = '{:04d}-{:02d}:{:04d}-{:02d}'.format(*(start + end))
+        self._averages = None
+        self._cell_sums = None
+
+    @property
+    def years(self):
+        return range(self.start[0], self.end[0] + 1)
+
+    def monthly_path(self, year):
+        return os.path.join(self.root_dir, 'crime_monthly_summaries_{}_{}.json'.format(
+            year, self.crimes.precision))
+
+    def at_precision(self, precision):
+        return WindowAverager(self.crimes.at_precision(precision), self.root_dir,
+                              self.start, self.end)
+
+    def get_monthly_sums(self, year):
+        """Return the ``summaries.MonthlySummaries`` of ``year``, building
+        and saving them if they don't exist.
+
+        Monthly summaries at precisions coarser than PYRAMID_PRECISION are
+        rolled up from those at PYRAMID_PRECISION.
+        """
+        path = self.monthly_path(year)
+        return cache.get((self.crimes.index, year, self.crimes.precision, path), path,
+                         lambda: self._load_or_build(
+                             path, summaries.MonthlySummaries.load,
+                             lambda: self._fetch_monthly_sums(year),
+                             lambda monthly_sums, path: monthly_sums.save(path)))
+
+    def _fetch_monthly_sums(self, year):
+        if self.crimes.precision < PYRAMID_PRECISION:
+            finest = self.at_precision(PYRAMID_PRECISION).get_monthly_sums(year)
+            return finest.rollup(self.crimes.precision)
+        return self._query_monthly_sums(year)
+
+    def _query_monthly_sums(self, year):
+        return summaries.MonthlySummaries.from_months(
+            summaries.CellSummaries.from_summaries(self.crimes.get_cell_sums(year, month))
+            for month in range(1, summaries.MONTHS + 1))
+
+    def is_built(self):
+        """Return whether the monthly summaries of every year in the window
+        exist."""
+        return not self.missing_years()
+
+    def missing_years(self):
+        """Return the years in the window whose monthly summaries haven't
+        been built."""
+        return [year for year in self.years if not os.path.exists(self.monthly_path(year))]
+
+    def version(self):
+        """Return the modification times, in nanoseconds, of the monthly
+        summaries files of the window's years, or None for files that don't
+        exist."""
+        return tuple(self._mtime_ns(self.monthly_path(year)) for year in self.years)
+
+    @staticmethod
+    def _mtime_ns(path):
         try:
-            averages = util.load_pickled_file(self.averages_path)
+            return os.stat(path).st_mtime_ns
         except OSError:
-            cell_sums = self.get_cell_sums()
-            averages = self.calculate_averages_for_cells(cell_sums)
-        self._averages = averages
-        return averages
+            return None
+
+    def last_modified(self):
+        """Return when any of the monthly summaries files last changed, as a
+        timestamp."""
+        return max(version or 0 for version in self.version()) / 1e9
+
+    def rebuild(self):
+        """Recalculate the monthly summaries of every year in the window and
+        replace the stored files.
+
+        At a precision in the pyramid, every level of it is replaced, as
+        with ``CachingCrimeAverager.rebuild``.
+        """
+        precision = self.crimes.precision
+        for year in self.years:
+            if precision not in index.GEOHASH_PRECISIONS:
+                self._replace_monthly_sums(year, self._query_monthly_sums(year))
+                continue
+
+            finest = self if precision == PYRAMID_PRECISION else self.at_precision(PYRAMID_PRECISION)
+            monthly_sums = finest._query_monthly_sums(year)
+            for level in sorted(index.GEOHASH_PRECISIONS, reverse=True):
+                averager = self if level == precision else self.at_precision(level)
+                averager._replace_monthly_sums(year, monthly_sums.rollup(level))
+
+    def _replace_monthly_sums(self, year, monthly_sums):
+        path = self.monthly_path(year)
+        with util.file_lock(path):
+            monthly_sums.save(path)
+        self._cell_sums = None
+        self._averages = None
+
+    def apply_monthly_deltas(self, year, months):
+        """Add ``months``, crime summaries of newly loaded crimes keyed by
+        month and then by geohash, to the stored monthly summaries of
+        ``year``.
+
+        The file is replaced atomically, so requests keep using the old
+        counts until the new ones are in place. A file that hasn't been
+        built yet is left alone, since building it will include the new
+        crimes.
+        """
+        path = self.monthly_path(year)
+        with util.file_lock(path):
+            try:
+                monthly_sums = summaries.MonthlySummaries.load(path)
+            except OSError:
+                return
+            monthly_sums.add(months).save(path)
+        self._cell_sums = None
+        self._averages = None
+
+    def apply_deltas(self, cell_sums):
+        raise NotImplementedError('Monthly summaries need deltas for each month; '
+                                  'see apply_monthly_deltas')
+
+    def _cached(self, name, calculate):
+        """Return ``calculate()``, cached in memory until the monthly
+        summaries change."""
+        versions = tuple(FileCache._mtime(self.monthly_path(year)) for year in self.years)
+        key = (self.crimes.index, self.period, self.crimes.precision, name, versions)
+        return cache.get(key, self.monthly_path(self.end[0]), calculate)
+
+    def get_cell_sums(self):
+        """Returns summaries of crimes during the window, keyed by geohash,
+        as ``summaries.CellSummaries``."""
+        if self._cell_sums is None:
+            self._cell_sums = self._cached('summaries', self._sum_window)
+        return self._cell_sums
+
+    def _sum_window(self):
+        cell_sums = None
+        for year in self.years:
+            first = self.start[1] if year == self.start[0] else 1
+            last = self.end[1] if year == self.end[0] else summaries.MONTHS
+            window = self.get_monthly_sums(year).window(first, last)
+            cell_sums = window if cell_sums is None else cell_sums.add(window)
+        return cell_sums
+
+    def get_location_sums(self, lon, lat):
+        """Return the crime summary for the cell that (lon, lat) falls within.
+
+        Every cell with crimes when the monthly summaries were built is in
+        them, so cells missing from them get an empty summary without
+        searching.
+        """
+        with timing.timed('cell'):
+            cell_hash = self.crimes.get_cell_hash(lon, lat)
+        with timing.timed('summaries'):
+            return self.get_cell_sums().get(cell_hash, util.empty_crime_sums())
+
+    def _summaries_of(self, cell_hashes):
+        with timing.timed('summaries'):
+            return self.get_cell_sums()
+
+    def get_locations_sums(self, coordinates):
+        """Return the crime summary for the cell each (lon, lat) pair in
+        ``coordinates`` falls within, in the same order."""
+        cell_sums = self.get_cell_sums()
+        return [cell_sums.get(self.crimes.get_cell_hash(lon, lat), util.empty_crime_sums())
+                for lon, lat in coordinates]
+
+    @property
+    def averages(self):
+        """Return median averages of crimes by type over the window.
+
+        Calculated from the window's summaries and cached in memory.
+        """
+        if self._averages is None:
+            with timing.timed('averages'):
+                self._averages = self._cached(
+                    'averages', lambda: self.calculate_averages_for_cells(self.get_cell_sums()))
+        return self._averages
+
+    @property
+    def hourly_averages(self):
+        """Return median averages of crimes by type for each hour of the day
+        over the window."""
+        with timing.timed('averages'):
+            return self._cached(
+                'hourly', lambda: self.calculate_hourly_averages_for_cells(self.get_cell_sums()))
+
+    @property
+    def daily_averages(self):
+        """Return median averages of crimes by type for each day of the week
+        over the window."""
+        with timing.timed('averages'):
+            return self._cached(
+                'daily', lambda: self.calculate_daily_averages_for_cells(self.get_cell_sums()))
+
+
+def apply_deltas(deltas, crimes, root_dir):
+    """Add ``deltas``, a ``summaries.CellDeltas`` filled in by
+    ``load_crimes``, to the summaries and averages in ``root_dir`` for every
+    year and precision it covers.
+
+    ``crimes`` is a ``models.Crimes`` for the index the crimes were loaded
+    into. Monthly summaries of those years are updated in the same way.
+    """
+    for (year, precision), cell_sums in deltas.items():
+        CachingCrimeAverager(crimes.at_precision(precision), root_dir, year).apply_deltas(cell_sums)
+    for (year, precision), months in deltas.monthly_items():
+        window = WindowAverager(crimes.at_precision(precision), root_dir, (year, 1), (year, 12))
+        window.apply_monthly_deltas(year, months)
+    models.clear_populated_cells()
@@ -1,68 +1,221 @@
-from elasticsearch import Elasticsearch
+import re
+
+from . import connections
 
 
 DEFAULT_INDEX_NAME = 'crimes'
 DEFAULT_TYPE = 'crime'
 
+# Index settings for serving queries, restored by finish_ingest.
+DEFAULT_REPLICAS = 1
+DEFAULT_REFRESH_INTERVAL = '1s'
+
+# Precisions at which each crime's geohash is stored, in fields named
+# ``properties.geohash_<precision>``.
+GEOHASH_PRECISIONS = (4, 5, 6, 7)
+
+
+def geohash_field(precision):
+    """Return the name of the field holding crimes' geohashes at
+    ``precision``, or None if it isn't stored."""
+    if precision in GEOHASH_PRECISIONS:
+        return 'properties.geohash_{}'.format(precision)
+    return None
+
 
 def delete_index(es=None, index_name=DEFAULT_INDEX_NAME):
     """Delete an index using the Elasticsearch instance ``es``."""
     if not es:
-        es = Elasticsearch()
+        es = connections.get_elasticsearch()
 
     return es.indices.delete(index_name)
 
 
-def create_index(es=None, index_name=DEFAULT_INDEX_NAME,
-                 type_name=DEFAULT_TYPE):
-    """Create the 'crimes' index using an Elasticsearch instance ``es``."""
-    if not es:
-        es = Elasticsearch()
+def get_mappings(type_name=DEFAULT_TYPE):
+    """Return the mappings for an index of crimes of type ``type_name``."""
+    crime_properties = {
+        'address': {
+            'type': 'string'
+        },
+        'crimeType': {
+            'type': 'string',
+            'index': 'not_analyzed'
+        },
+        'neighborhood': {
+            'type': 'string'
+        },
+        'policeDistrict': {
+            'type': 'long'
+        },
+        'policePrecinct': {
+            'type': 'string'
+        },
+        'reportTime': {
+            'type': 'date',
+            'format': 'dateOptionalTime'
+        },
+        # Derived from reportTime by load_crimes
+        'year': {
+            'type': 'short'
+        },
+        'month': {
+            'type': 'byte'
+        },
+        'weekday': {
+            'type': 'byte'
+        },
+        'hour': {
+            'type': 'byte'
+        },
+    }
+
+    # Derived from the coordinates by load_crimes
+    for precision in GEOHASH_PRECISIONS:
+        crime_properties['geohash_{}'.format(precision)] = {
+            'type': 'string',
+            'index': 'not_analyzed'
+        }
 
-    return es.indices.create(
-        index=index_name,
-        body={
-            'mappings': {
-                type_name: {
+    return {
+        type_name: {
+            'properties': {
+                'geometry': {
                     'properties': {
-                        'geometry': {
-                            'properties': {
-                                'coordinates': {
-                                    'type': 'geo_point',
-                                }
-                            }
-                        },
-                        'id': {
-                            'type': 'long'
-                        },
-                        'properties': {
-                            'properties': {
-                                'address': {
-                                    'type': 'string'
-                                },
-                                'crimeType': {
-                                    'type': 'string'
-                                },
-                                'neighborhood': {
-                                    'type': 'string'
-                                },
-                                'policeDistrict': {
-                                    'type': 'long'
-                                },
-                                'policePrecinct': {
-                                    'type': 'string'
-                                },
-                                'reportTime': {
-                                    'type': 'date',
-                                    'format': 'dateOptionalTime'
-                                }
-                            }
+                        'coordinates': {
+                            'type': 'geo_point',
                         }
-                    },
+                    }
+                },
+                'id': {
+                    'type': 'long'
+                },
+                'properties': {
+                    'properties': crime_properties
                 }
-            }
+            },
         }
-    )
+    }
+
+
+def create_index(es=None, index_name=DEFAULT_INDEX_NAME,
+                 type_name=DEFAULT_TYPE, settings=None):
+    """Create the 'crimes' index using an Elasticsearch instance ``es``."""
+    if not es:
+        es = connections.get_elasticsearch()
+
+    body = {
+        'mappings': get_mappings(type_name)
+    }
+    if settings:
+        body['settings'] = settings
+
+    return es.indices.create(index=index_name, body=body)
+
+
+def versioned_index_name(alias, version):
+    return '{}_v{}'.format(alias, version)
+
+
+def get_versions(es, alias):
+    """Return a dict mapping the version numbers of the indexes behind
+    ``alias`` to their names."""
+    pattern = re.compile(r'^{}_v(\d+)$'.format(re.escape(alias)))
+    indexes = es.indices.get_aliases(index=versioned_index_name(alias, '*'))
+    versions = {}
+    for name in indexes:
+        match = pattern.match(name)
+        if match:
+            versions[int(match.group(1))] = name
+    return versions
+
+
+def get_aliased_indexes(es, alias):
+    """Return the names of the indexes ``alias`` currently points at."""
+    if not es.indices.exists_alias(name=alias):
+        return []
+    return list(es.indices.get_alias(name=alias).keys())
+
+
+def create_versioned_index(es=None, alias=DEFAULT_INDEX_NAME,
+                           type_name=DEFAULT_TYPE):
+    """Create the next ``<alias>_v<n>`` index, set up for bulk loading.
+
+    The new index has no replicas and doesn't refresh until
+    ``finish_ingest`` is called. Returns its name.
+    """
+    if not es:
+        es = connections.get_elasticsearch()
+
+    versions = get_versions(es, alias)
+    index_name = versioned_index_name(alias, max(versions, default=0) + 1)
+    create_index(es, index_name, type_name, settings={
+        'number_of_replicas': 0,
+        'refresh_interval': '-1'
+    })
+    return index_name
+
+
+def finish_ingest(es=None, index_name=DEFAULT_INDEX_NAME,
+                  replicas=DEFAULT_REPLICAS,
+                  refresh_interval=DEFAULT_REFRESH_INTERVAL):
+    """Ready an index loaded by bulk requests for queries.
+
+    Merges it down to one segment, then restores refreshes and replicas.
+    """
+    if not es:
+        es = connections.get_elasticsearch()
+
+    es.indices.optimize(index=index_name, max_num_segments=1)
+    es.indices.put_settings(index=index_name, body={
+        'index': {
+            'number_of_replicas': replicas,
+            'refresh_interval': refresh_interval
+        }
+    })
+    es.indices.refresh(index=index_name)
+
+
+def check_alias(es=None, alias=DEFAULT_INDEX_NAME):
+    """Raise ValueError if ``alias`` is a concrete index rather than an
+    alias or a free name."""
+    if not es:
+        es = connections.get_elasticsearch()
+
+    if es.indices.exists(index=alias) and not es.indices.exists_alias(name=alias):
+        raise ValueError('{} is an index, not an alias; delete it before '
+                         'loading a versioned index'.format(alias))
+
+
+def swap_alias(es=None, alias=DEFAULT_INDEX_NAME, index_name=None):
+    """Atomically point ``alias`` at ``index_name`` alone."""
+    if not es:
+        es = connections.get_elasticsearch()
+
+    check_alias(es, alias)
+    actions = [{'remove': {'index': old, 'alias': alias}}
+               for old in get_aliased_indexes(es, alias)]
+    actions.append({'add': {'index': index_name, 'alias': alias}})
+    return es.indices.update_aliases(body={'actions': actions})
+
+
+def prune_versions(es=None, alias=DEFAULT_INDEX_NAME, keep=2):
+    """Delete all but the newest ``keep`` versions of the indexes behind
+    ``alias``, never deleting one that ``alias`` points at.
+
+    Returns the names of the deleted indexes.
+    """
+    if not es:
+        es = connections.get_elasticsearch()
+
+    live = set(get_aliased_indexes(es, alias))
+    versions = get_versions(es, alias)
+    deleted = []
+    for version in sorted(versions, reverse=True)[keep:]:
+        name = versions[version]
+        if name not in live:
+            delete_index(es, name)
+            deleted.append(name)
+    return deleted
 
 
 if __name__ == '__main__':
@@ -1,34 +1,322 @@
+"""
+Load crimes from a GeoJSON file into Elasticsearch.
+
+Crimes are parsed from the file one feature at a time and sent to ES in
+chunks, so memory use stays flat and no bulk request grows past ES's limits
+regardless of how large the file is.
+"""
+import argparse
+import concurrent.futures
 import json
-import sys
+import logging
+import re
+import threading
+import time
+
+import dateutil.parser
+import geohash
+from elasticsearch import TransportError
+
+from . import connections, crime_averager, index, models, summaries, util
+
+
+log = logging.getLogger(__name__)
+
+DEFAULT_CHUNK_SIZE = 500
+DEFAULT_CHUNK_BYTES = 5 * 1024 * 1024
+DEFAULT_CONCURRENCY = 1
+DEFAULT_MAX_RETRIES = 3
+DEFAULT_BACKOFF = 0.5  # seconds
+
+# Bytes read from the GeoJSON file at a time.
+READ_SIZE = 64 * 1024
+
+FEATURES_START = re.compile(r'"features"\s*:\s*\[')
+SEPARATORS = re.compile(r'[\s,]*')
+
+
+def iter_features(f, read_size=READ_SIZE):
+    """Yield each feature in the GeoJSON FeatureCollection in file ``f``
+    without reading the whole file into memory."""
+    decoder = json.JSONDecoder()
+    buf = ''
+
+    while True:
+        match = FEATURES_START.search(buf)
+        if match:
+            buf = buf[match.end():]
+            break
+        chunk = f.read(read_size)
+        if not chunk:
+            raise ValueError('No "features" array found')
+        # Keep the tail in case the key is split across reads.
+        buf = buf[-32:] + chunk
+
+    pos = 0
+    while True:
+        pos = SEPARATORS.match(buf, pos).end()
+        if pos < len(buf):
+            if buf[pos] == ']':
+                return
+            try:
+                feature, pos = decoder.raw_decode(buf, pos)
+            except ValueError:
+                # Most likely a feature cut off at the end of the buffer.
+                pass
+            else:
+                yield feature
+                continue
+
+        chunk = f.read(read_size)
+        if not chunk:
+            raise ValueError('Unexpected end of features at byte {}'.format(pos))
+        buf = buf[pos:] + chunk
+        pos = 0
+
+
+def add_derived_fields(crime):
+    """Add the fields ``index.get_mappings`` derives from a crime's report
+    time and location, so queries can filter and aggregate on them directly.
+    """
+    properties = crime['properties']
+    report_time = properties['reportTime']
+    properties['weekday'], properties['hour'] = util.parse_report_time(report_time)
+    if util.ISO_8601_PREFIX.match(report_time):
+        properties['year'] = int(report_time[:4])
+    else:
+        properties['year'] = dateutil.parser.parse(report_time).year
+    properties['month'] = util.parse_report_month(report_time)
+
+    lon, lat = crime['geometry']['coordinates']
+    cell_hash = geohash.encode(lat, lon, max(index.GEOHASH_PRECISIONS))
+    for precision in index.GEOHASH_PRECISIONS:
+        properties['geohash_{}'.format(precision)] = cell_hash[:precision]
+
+    return crime
+
 
-from elasticsearch import Elasticsearch
+class BulkLoader(object):
+    """Index crimes into Elasticsearch with bulk requests.
 
-from . import index
+    Crimes are sent in chunks of at most ``chunk_size`` crimes and
+    ``max_chunk_bytes`` bytes, from up to ``concurrency`` threads. Crimes ES
+    rejects because it is busy are retried up to ``max_retries`` times with
+    exponential backoff. ``indexed``, ``failed``, ``chunks``, ``seconds`` and
+    ``docs_per_second`` report how the load went.
+
+    ``on_indexed``, if given, is called with each crime once ES has indexed
+    it, possibly from several threads at once.
+    """
+    def __init__(self, es, index_name=index.DEFAULT_INDEX_NAME,
+                 type_name=index.DEFAULT_TYPE, chunk_size=DEFAULT_CHUNK_SIZE,
+                 max_chunk_bytes=DEFAULT_CHUNK_BYTES,
+                 concurrency=DEFAULT_CONCURRENCY,
+                 max_retries=DEFAULT_MAX_RETRIES, backoff=DEFAULT_BACKOFF,
+                 on_indexed=None):
+        self.es = es
+        self.index_name = index_name
+        self.type_name = type_name
+        self.chunk_size = chunk_size
+        self.max_chunk_bytes = max_chunk_bytes
+        self.concurrency = concurrency
+        self.max_retries = max_retries
+        self.backoff = backoff
+        self.on_indexed = on_indexed
+        self.indexed = 0
+        self.failed = 0
+        self.chunks = 0
+        self.seconds = 0.0
+        self._lock = threading.Lock()
+
+    @property
+    def docs_per_second(self):
+        return self.indexed / self.seconds if self.seconds else 0.0
+
+    def iter_chunks(self, crimes):
+        """Split ``crimes`` into lists of (action, document, crime) tuples,
+        where action and document are JSON lines, small enough for one bulk
+        request."""
+        action = json.dumps({'index': {'_index': self.index_name,
+                                       '_type': self.type_name}})
+        chunk = []
+        size = 0
+
+        for crime in crimes:
+            doc = json.dumps(crime)
+            item_size = len(action) + len(doc) + 2
+            if chunk and (len(chunk) >= self.chunk_size or
+                          size + item_size > self.max_chunk_bytes):
+                yield chunk
+                chunk = []
+                size = 0
+            chunk.append((action, doc, crime))
+            size += item_size
+
+        if chunk:
+            yield chunk
+
+    def _record(self, indexed, failed):
+        with self._lock:
+            self.indexed += indexed
+            self.failed += failed
+
+    def send(self, chunk):
+        """Send one chunk, retrying crimes ES rejects because it is busy."""
+        with self._lock:
+            self.chunks += 1
+
+        attempt = 0
+        while True:
+            body = ''.join('{}\n{}\n'.format(action, doc) for action, doc, _ in chunk)
+            try:
+                res = self.es.bulk(body=body)
+            except TransportError as e:
+                if not connections.is_retryable(e) or attempt >= self.max_retries:
+                    raise
+                rejected = chunk
+            else:
+                rejected = []
+                failed = 0
+                for chunk_item, item in zip(chunk, res['items']):
+                    result = item['index']
+                    if result.get('status') == connections.TOO_MANY_REQUESTS:
+                        rejected.append(chunk_item)
+                    elif result.get('status', 200) >= 300:
+                        failed += 1
+                        log.warning('Failed to index crime: %s', result.get('error'))
+                    elif self.on_indexed:
+                        self.on_indexed(chunk_item[2])
+                self._record(len(chunk) - len(rejected) - failed, failed)
+
+                if not rejected:
+                    return
+                if attempt >= self.max_retries:
+                    log.warning('Gave up on %d crimes after %d retries',
+                                len(rejected), attempt)
+                    self._record(0, len(rejected))
+                    return
+
+            attempt += 1
+            time.sleep(self.backoff * 2 ** (attempt - 1))
+            chunk = rejected
+
+    def load(self, crimes):
+        """Index every crime in the iterable ``crimes`` and refresh the index."""
+        start = time.time()
+
+        if self.concurrency <= 1:
+            for chunk in self.iter_chunks(crimes):
+                self.send(chunk)
+        else:
+            with concurrent.futures.ThreadPoolExecutor(self.concurrency) as executor:
+                pending = set()
+                for chunk in self.iter_chunks(crimes):
+                    # Don't read ahead of the senders by more than a chunk
+                    # or two each.
+                    if len(pending) >= self.concurrency * 2:
+                        done, pending = concurrent.futures.wait(
+                            pending, return_when=concurrent.futures.FIRST_COMPLETED)
+                        for future in done:
+                            future.result()
+                    pending.add(executor.submit(self.send, chunk))
+                for future in concurrent.futures.as_completed(pending):
+                    future.result()
+
+        self.es.indices.refresh(index=self.index_name)
+        self.seconds = time.time() - start
+        log.info('Indexed %d crimes (%d failed) in %d chunks in %.1fs (%.0f docs/sec)',
+                 self.indexed, self.failed, self.chunks, self.seconds,
+                 self.docs_per_second)
+        return self
 
 
 def load_crimes(filename, es=None, index_name=index.DEFAULT_INDEX_NAME,
-                type_name=index.DEFAULT_TYPE):
+                type_name=index.DEFAULT_TYPE, deltas=None, **options):
+    """Load the crimes in the GeoJSON file ``filename`` into ``index_name``.
+
+    If ``deltas`` (a ``summaries.CellDeltas``) is given, every crime indexed
+    is added to it. ``options`` are passed to ``BulkLoader``, which is
+    returned.
+    """
     if not es:
-        es = Elasticsearch()
+        es = connections.get_elasticsearch()
 
+    if deltas is not None:
+        options['on_indexed'] = deltas.add
+    loader = BulkLoader(es, index_name=index_name, type_name=type_name, **options)
     with open(filename, 'r') as f:
-        data = f.read()
+        crimes = (add_derived_fields(crime) for crime in iter_features(f))
+        return loader.load(crimes)
+
 
-    body = []
-    crimes = json.loads(data)
+def reindex(filename, es=None, alias=index.DEFAULT_INDEX_NAME,
+            type_name=index.DEFAULT_TYPE, keep=2,
+            replicas=index.DEFAULT_REPLICAS, **options):
+    """Load the crimes in ``filename`` into a new version of the index behind
+    ``alias`` and switch ``alias`` to it without downtime.
 
-    for c in crimes['features']:
-        body.append({"index": {"_index": index_name, "_type": type_name}})
-        body.append(c)
+    Queries keep using the old index until the new one is loaded and
+    optimized. If any crime fails to load, the new index is deleted and
+    ``alias`` left as it was. Afterwards only the newest ``keep`` versions
+    are kept. ``options`` are passed to ``BulkLoader``, which is returned.
+    """
+    if not es:
+        es = connections.get_elasticsearch()
 
-    return es.bulk(body)
+    index.check_alias(es, alias)
+    index_name = index.create_versioned_index(es, alias, type_name)
+    try:
+        loader = load_crimes(filename, es=es, index_name=index_name,
+                             type_name=type_name, **options)
+        if loader.failed:
+            raise ValueError('{} crimes failed to load into {}'.format(loader.failed, index_name))
+        index.finish_ingest(es, index_name, replicas=replicas)
+        index.swap_alias(es, alias, index_name)
+    except Exception:
+        index.delete_index(es, index_name)
+        raise
+    deleted = index.prune_versions(es, alias, keep=keep)
+    log.info('Switched %s to %s and deleted %s', alias, index_name, deleted)
+    return loader
 
 
 if __name__ == '__main__':
-    if not sys.argv[1]:
-        print('Usage: python load_crimes.py <filename>')
-        exit(1)
-
-    response = load_crimes(sys.argv[1])
-    print("Loaded {} items into the index".format(len(response['items'])))
+    parser = argparse.ArgumentParser(description='Load crimes from a GeoJSON file into Elasticsearch.')
+    parser.add_argument('filename')
+    parser.add_argument('--index', default=index.DEFAULT_INDEX_NAME,
+                        help='Index to load, or alias to switch with --reindex')
+    parser.add_argument('--reindex', action='store_true',
+                        help='Load a new version of the index and switch the alias to it')
+    parser.add_argument('--keep', type=int, default=2,
+                        help='Versions of the index to keep with --reindex')
+    parser.add_argument('--chunk-size', type=int, default=DEFAULT_CHUNK_SIZE,
+                        help='Maximum crimes per bulk request')
+    parser.add_argument('--chunk-bytes', type=int, default=DEFAULT_CHUNK_BYTES,
+                        help='Maximum bytes per bulk request')
+    parser.add_argument('--concurrency', type=int, default=DEFAULT_CONCURRENCY,
+                        help='Number of bulk requests to send at once')
+    parser.add_argument('--max-retries', type=int, default=DEFAULT_MAX_RETRIES,
+                        help='Times to retry crimes rejected by a busy ES')
+    parser.add_argument('--summaries-dir',
+                        help='Add the loaded crimes to the summaries and averages in this directory')
+    args = parser.parse_args()
+    if args.reindex and args.summaries_dir:
+        parser.error('--reindex replaces every crime; rebuild the summaries instead')
 
+    options = {
+        'chunk_size': args.chunk_size,
+        'max_chunk_bytes': args.chunk_bytes,
+        'concurrency': args.concurrency,
+        'max_retries': args.max_retries
+    }
+    if args.reindex:
+        loader = reindex(args.filename, alias=args.index, keep=args.keep, **options)
+    elif args.summaries_dir:
+        deltas = summaries.CellDeltas()
+        loader = load_crimes(args.filename, index_name=args.index, deltas=deltas, **options)
+        crime_averager.apply_deltas(deltas, models.Crimes(loader.es, index=args.index),
+                                    args.summaries_dir)
+    else:
+        loader = load_crimes(args.filename, index_name=args.index, **options)
+    print("Loaded {} items into the index in {:.1f}s ({:.0f} docs/sec, {} failed)".format(
+        loader.indexed, loader.seconds, loader.docs_per_second, loader.failed))
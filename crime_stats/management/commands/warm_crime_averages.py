@@ -0,0 +1,28 @@
+from optparse import make_option
+
+from django.core.management.base import BaseCommand
+
+from crime_stats import tasks
+
+
+class Command(BaseCommand):
+    help = ('Build crime summaries and averages for every year in CRIME_YEARS '
+            'at every precision in CRIME_PRECISIONS.')
+
+    option_list = BaseCommand.option_list + (
+        make_option('--rebuild', action='store_true', default=False,
+                    help='Recalculate summaries and averages that already exist'),
+        make_option('--queue', action='store_true', default=False,
+                    help='Queue the work for Celery workers instead of doing it here'),
+    )
+
+    def handle(self, *args, **options):
+        if options['queue']:
+            tasks.warm_all.delay(rebuild=options['rebuild'])
+            self.stdout.write('Queued crime averages for warming')
+            return
+
+        for year, precision, rebuild, monthly in tasks.iter_warm_jobs(options['rebuild']):
+            tasks.warm(year, precision, rebuild=rebuild, monthly=monthly)
+            self.stdout.write('Warmed crime {} for {} at precision {}'.format(
+                'monthly summaries' if monthly else 'averages', year, precision))
@@ -1,20 +1,318 @@
 """
 An interface to help retrieve crime data from an ElasticSearch index.
 """
+import collections
+import concurrent.futures
+import logging
+import threading
+import time
+
 import geohash
+from elasticsearch import TransportError
+
+from . import connections, index as crimes_index, timing, util
+
+
+log = logging.getLogger(__name__)
+
+# Number of hits each shard returns per scroll request.
+DEFAULT_PAGE_SIZE = 500
+
+# Times a cell's search is retried when ES is unreachable or busy, and the
+# seconds waited before the first retry (doubled for each one after).
+DEFAULT_MAX_RETRIES = 2
+DEFAULT_BACKOFF = 0.5
+
+# The only fields ``util.get_crime_sums`` reads from a crime.
+SUMMARY_FIELDS = ['properties.crimeType', 'properties.reportTime']
+
+# Geohashes of the cells that contain crimes, keyed by (index, precision) and
+# shared by every ``Crimes`` instance in the process.
+_populated_cells = {}
+_populated_cells_lock = threading.Lock()
+
+
+# Counts crimes by type, and each type by hour of day and day of week: all
+# that a crime summary holds.
+TYPES_AGGREGATION = {
+    'terms': {
+        'field': 'properties.crimeType',
+        'size': 0
+    },
+    'aggregations': {
+        'hours': {
+            'terms': {
+                'field': 'properties.hour',
+                'size': 24
+            }
+        },
+        'days': {
+            'terms': {
+                'field': 'properties.weekday',
+                'size': 7
+            }
+        }
+    }
+}
+
+
+class CellError(Exception):
+    """Raised when the crimes in a cell couldn't be searched."""
+    def __init__(self, cell, error):
+        super().__init__('Failed to sum crimes in cell {}: {}'.format(cell, error))
+        self.cell = cell
+        self.error = error
+
+
+def clear_populated_cells(index=None, precision=None):
+    """Forget the populated cells cached by ``Crimes.get_populated_cells``,
+    or only those of ``index`` at ``precision`` if given."""
+    with _populated_cells_lock:
+        if index is None:
+            _populated_cells.clear()
+        else:
+            _populated_cells.pop((index, int(precision)), None)
+
+
+def year_filter(year):
+    """Return an ES filter matching crimes reported during ``year``."""
+    return {'term': {'properties.year': int(year)}}
+
+
+def month_filter(year, month):
+    """Return an ES filter matching crimes reported during ``month`` (1 to
+    12) of ``year``.
+
+    Filters on the year and month ``load_crimes`` derives, rather than a
+    range of report times, which ES would compare in UTC and so disagree
+    with the year about crimes reported near midnight with an offset.
+    """
+    return {'and': [year_filter(year), {'term': {'properties.month': int(month)}}]}
+
+
+def period_filter(year, month=None):
+    """Return an ES filter matching crimes reported during ``year``, or only
+    during ``month`` of it if given."""
+    if month is None:
+        return year_filter(year)
+    return month_filter(year, month)
+
+
+def bbox_filter(cell):
+    """Return an ES filter matching crimes within the bounding box ``cell``."""
+    return {
+        "geo_bounding_box": {
+            "geometry.coordinates": {
+                "top_left": {
+                    "lon": cell['w'],
+                    "lat": cell['n']
+                },
+                "bottom_right": {
+                    "lon": cell['e'],
+                    "lat": cell['s'],
+                },
+            }
+        },
+    }
+
+
+class CrimeScroll(object):
+    """Lazily page through every hit for ``query`` using a scan/scroll search.
+
+    Only one page of hits is held in memory at a time. ``page_size`` is the
+    number of hits fetched from each shard per page, and ``source`` limits the
+    fields returned for each hit. After (or during) iteration, ``pages`` and
+    ``hits`` report how much was fetched.
+    """
+    def __init__(self, es, index, query, page_size=DEFAULT_PAGE_SIZE,
+                 source=None, scroll='1m'):
+        self.es = es
+        self.index = index
+        self.query = query
+        self.page_size = page_size
+        self.source = source
+        self.scroll = scroll
+        self.pages = 0
+        self.hits = 0
+
+    def __iter__(self):
+        body = {'query': self.query}
+        if self.source is not None:
+            body['_source'] = self.source
+
+        res = self.es.search(index=self.index, body=body, search_type='scan',
+                             scroll=self.scroll, size=self.page_size)
+        timing.record_search(res)
+        scroll_id = res['_scroll_id']
+
+        try:
+            while True:
+                res = self.es.scroll(scroll_id=scroll_id, scroll=self.scroll)
+                timing.record_scroll(res)
+                scroll_id = res['_scroll_id']
+                hits = res['hits']['hits']
+                if not hits:
+                    break
+                self.pages += 1
+                self.hits += len(hits)
+                for hit in hits:
+                    yield hit['_source']
+        finally:
+            self.es.clear_scroll(scroll_id=scroll_id)
+            log.debug('Scrolled %d hits in %d pages from %s',
+                      self.hits, self.pages, self.index)
+
+
+class BaseCrimes(object):
+    """Crimes at one geohash precision, whichever backend holds them.
+
+    Subclasses implement ``get_cell``, ``get_crimes_within_cell``,
+    ``get_cell_hashes``, ``get_cell_sums``, ``get_sums_for_cells`` and
+    ``at_precision``; everything else is built on those.
+    """
+    def __init__(self, index, precision):
+        """
+        ``index``: names the crimes, keeping caches of different crimes apart
+        ``precision``: geohash precision of the cells crimes are grouped in
+        """
+        self.index = index
+        self.precision = int(precision)
+
+    def at_precision(self, precision):
+        """Return the same crimes grouped into cells at ``precision``."""
+        raise NotImplementedError
+
+    def get_cell(self, lon, lat):
+        raise NotImplementedError
+
+    def get_crimes_within_cell(self, cell, year, source=None, page_size=None):
+        raise NotImplementedError
+
+    def get_cell_hashes(self):
+        raise NotImplementedError
+
+    def get_cell_sums(self, year, month=None):
+        raise NotImplementedError
+
+    def get_sums_for_cells(self, cell_hashes, year):
+        raise NotImplementedError
+
+    def get_cell_hash(self, lon, lat):
+        """Get the geohash of the cell that (lon, lat) falls within."""
+        return geohash.encode(lat, lon, self.precision)
+
+    def locate_cell(self, lon, lat, populated_only=True):
+        """Get the cell that a coordinate pair (lon, lat) falls within
+        without searching the crimes.
+
+        The geohash is computed locally at the chosen precision. With
+        ``populated_only``, cells that contain no crimes are treated as
+        outside the city and None is returned, as with ``get_cell``.
+        """
+        cell_hash = self.get_cell_hash(lon, lat)
+        if populated_only and cell_hash not in self.get_populated_cells():
+            return None
+        return geohash.bbox(cell_hash)
+
+    def get_populated_cells(self):
+        """Return the set of geohashes of cells that contain crimes.
+
+        The set is fetched from the backend once per process for each index
+        and precision; see ``clear_populated_cells``. ``CachingCrimeAverager``
+        clears it whenever it loads changed summaries, so a process picks up
+        the cells of a reindexed alias along with the rebuilt summaries.
+        """
+        key = (self.index, self.precision)
+        cells = _populated_cells.get(key)
+        if cells is None:
+            cells = frozenset(self.get_cell_hashes())
+            with _populated_cells_lock:
+                _populated_cells[key] = cells
+        return cells
+
+    def get_crimes_near_coordinate(self, lon, lat, year, source=None):
+        """Find all of the crimes within the geohash cell calculated for
+        the location (lon, lat) during the year ``year``.
+        """
+        cell = self.locate_cell(lon, lat)
+        if cell is None:
+            return []
+        return self.get_crimes_within_cell(cell, year=year, source=source)
+
+    def get_cells(self):
+        """Get a mesh of geohash cells for all crimes at the chosen
+        precision.
+        """
+        return (geohash.bbox(h) for h in self.get_cell_hashes())
+
+    def sum_crimes_in_cell(self, cell, year, max_retries=DEFAULT_MAX_RETRIES,
+                           backoff=DEFAULT_BACKOFF):
+        """Calculate sums of crime data for the geohash bounding box ``cell``
+        during year ``year``.
+
+        If ES is unreachable or busy, the cell is searched again up to
+        ``max_retries`` times, waiting longer each time. Raises ``CellError``
+        if it still fails.
+        """
+        attempt = 0
+        while True:
+            try:
+                crimes = self.get_crimes_within_cell(cell, year=year,
+                                                     source=SUMMARY_FIELDS)
+                return util.get_crime_sums(crimes)
+            except TransportError as e:
+                if not connections.is_retryable(e) or attempt >= max_retries:
+                    raise CellError(cell, e)
+                log.warning('Retrying cell %s after error: %s', cell, e)
+
+            attempt += 1
+            time.sleep(backoff * 2 ** (attempt - 1))
+
+    def sum_crimes_in_cells(self, cells, year, concurrency=1, **options):
+        """Calculate sums of crime data for each geohash bounding box in ``cells``
+        during year ``year``.
+
+        With ``concurrency`` above 1, that many cells are searched at once
+        from a pool of threads; keep it within the client's connection pool
+        size. Sums are returned in the order of ``cells`` either way.
+        ``options`` are passed to ``sum_crimes_in_cell``.
+        """
+        if concurrency <= 1:
+            return [self.sum_crimes_in_cell(cell, year, **options) for cell in cells]
+
+        futures = []
+        with concurrent.futures.ThreadPoolExecutor(concurrency) as executor:
+            pending = set()
+            for cell in cells:
+                # Don't queue more than a cell or two per thread ahead.
+                if len(pending) >= concurrency * 2:
+                    done, pending = concurrent.futures.wait(
+                        pending, return_when=concurrent.futures.FIRST_COMPLETED)
+                    for future in done:
+                        future.result()
+                future = executor.submit(self.sum_crimes_in_cell, cell, year, **options)
+                futures.append(future)
+                pending.add(future)
 
-from . import util
+        return [future.result() for future in futures]
 
 
-class Crimes(object):
+class Crimes(BaseCrimes):
     """Wrapper around an Elasticsearch instance that stores crime data."""
-    def __init__(self, es, index="crimes", precision=6):
+    def __init__(self, es, index="crimes", precision=6,
+                 page_size=DEFAULT_PAGE_SIZE):
         """
         ``es``: an Elasticsearch instance
+        ``page_size``: hits fetched per shard for each page of a scroll
         """
+        super().__init__(index, precision)
         self.es = es
-        self.index = index
-        self.precision = precision
+        self.page_size = page_size
+        self.geohash_field = crimes_index.geohash_field(self.precision)
+
+    def at_precision(self, precision):
+        return Crimes(self.es, index=self.index, precision=precision,
+                      page_size=self.page_size)
 
     def get_cell(self, lon, lat):
         """Get the cell that a coordinate pair (lat, lon) falls within."""
@@ -42,6 +340,7 @@ class Crimes(object):
             }
         )
 
+        timing.record_search(res)
         buckets = res['aggregations']['grid']['buckets']
 
         if buckets:
@@ -52,92 +351,166 @@ class Crimes(object):
 
         return cell
 
-    def get_crimes_within_cell(self, cell, year):
-        """Return all crimes that occurred within the geohash ``cell``."""
+    def get_crimes_within_cell(self, cell, year, source=None, page_size=None):
+        """Return all crimes that occurred within the geohash ``cell``.
+
+        Crimes are streamed from ES a page at a time through a
+        ``CrimeScroll``. Pass ``source`` (e.g. ``SUMMARY_FIELDS``) to fetch
+        only some fields of each crime.
+        """
+        query = {
+            "filtered": {
+                "query": {
+                    "match_all": {},
+                },
+                "filter": {
+                    'and': [
+                        self.cell_filter(cell),
+                        year_filter(year)
+                    ]
+                },
+            },
+        }
+        return CrimeScroll(self.es, self.index, query,
+                           page_size=page_size or self.page_size,
+                           source=source)
+
+    def cell_filter(self, cell):
+        """Return an ES filter matching crimes within the geohash ``cell``.
+
+        Uses a term filter on the crimes' stored geohash when the index has
+        one at this precision, and a bounding box filter otherwise.
+        """
+        if self.geohash_field:
+            center_lat = (cell['n'] + cell['s']) / 2
+            center_lon = (cell['e'] + cell['w']) / 2
+            cell_hash = geohash.encode(center_lat, center_lon, self.precision)
+            return {'term': {self.geohash_field: cell_hash}}
+        return bbox_filter(cell)
+
+    def grid_aggregation(self):
+        """Return an ES aggregation that buckets crimes by geohash cell,
+        keyed by geohash."""
+        if self.geohash_field:
+            return {
+                'terms': {
+                    'field': self.geohash_field,
+                    'size': 0
+                }
+            }
+        return {
+            'geohash_grid': {
+                'field': 'geometry.coordinates',
+                'precision': self.precision
+            }
+        }
+
+    def get_cell_hashes(self):
+        """Get the geohashes of all cells containing crimes in ElasticSearch
+        at the chosen precision.
+        """
         res = self.es.search(
             index=self.index,
+            search_type='count',
             body={
-                "from": 0,
-                "size": 5000,
-                "query": {
-                    "filtered": {
-                        "query": {
-                            "match_all": {},
-                        },
-                        "filter": {
-                            'and': [
-                                {
-                                    "geo_bounding_box": {
-                                        "geometry.coordinates": {
-                                            "top_left": {
-                                                "lon": cell['w'],
-                                                "lat": cell['n']
-                                            },
-                                            "bottom_right": {
-                                                "lon": cell['e'],
-                                                "lat": cell['s'],
-                                            },
-                                        }
-                                    },
-                                },
-                                {
-                                    "range": {
-                                        'properties.reportTime': {
-                                            "from": "{}-01-01T00:00:00".format(year),
-                                            "to": "{}-01-01T00:00:00".format(year + 1)
-                                        }
-                                    }
-                                }
-                            ]
-                        },
-                    },
+                'aggregations': {
+                    'grid': self.grid_aggregation()
                 }
             }
         )
-        return (c['_source'] for c in res['hits']['hits'])
+        timing.record_search(res)
 
-    def get_crimes_near_coordinate(self, lon, lat, year):
-        """Find all of the crimes within the geohash cell calculated for
-        the location (lon, lat) during the year ``year``.
-        """
-        cell = self.get_cell(lon, lat)
-        return self.get_crimes_within_cell(cell, year=year)
+        return [bucket['key'] for bucket in res['aggregations']['grid']['buckets']]
 
-    def get_cells(self):
-        """Get a mesh of geohash cells for all crimes in ElasticSearch at the
-        chosen precision.
+    def get_cell_sums(self, year, month=None):
+        """Get sums of crimes committed for all known geohash cells, keyed by
+        each cell's geohash.
+
+        Unlike ``sum_crimes_in_cells``, this runs a single search: crimes are
+        bucketed by geohash cell, then by crime type, then by hour of day and
+        day of week, and the summaries are rebuilt from the buckets. The
+        result has the same shape as ``util.get_crime_sums`` for each cell.
+        With ``month`` (1 to 12), only crimes from that month of ``year`` are
+        summed.
         """
         res = self.es.search(
             index=self.index,
+            search_type='count',
             body={
                 'aggregations': {
-                    'grid': {
-                        'geohash_grid': {
-                            'field': 'geometry.coordinates',
-                            'precision': self.precision
+                    'grid': dict(self.grid_aggregation(), aggregations={
+                        'year': {
+                            'filter': period_filter(year, month),
+                            'aggregations': {
+                                'types': TYPES_AGGREGATION
+                            }
                         }
-                    }
+                    })
                 }
             }
         )
 
-        hashes = (bucket['key'] for bucket in res['aggregations']['grid']['buckets'])
-        return (geohash.bbox(h) for h in hashes)
+        timing.record_search(res)
+        buckets = res['aggregations']['grid']['buckets']
+        return collections.OrderedDict(
+            (bucket['key'], self._summary_from_types(bucket['year']['types']))
+            for bucket in buckets)
 
-    def sum_crimes_in_cells(self, cells, year):
-        """Calculate sums of crime data for each geohash bounding box in ``cells``
-        during year ``year``.
+    def get_sums_for_cells(self, cell_hashes, year):
+        """Get sums of crimes committed during ``year`` in each of the cells
+        with geohashes ``cell_hashes``, keyed by geohash.
+
+        All of the cells are searched in one ``msearch`` request. Raises
+        ``CellError`` for the first cell whose search failed.
         """
-        cell_summaries = []
+        cell_hashes = list(cell_hashes)
+        if not cell_hashes:
+            return collections.OrderedDict()
+
+        header = {'index': self.index, 'search_type': 'count'}
+        body = []
+        for cell_hash in cell_hashes:
+            body.append(header)
+            body.append({
+                'query': {
+                    'filtered': {
+                        'filter': {
+                            'and': [
+                                self.cell_filter(geohash.bbox(cell_hash)),
+                                year_filter(year)
+                            ]
+                        }
+                    }
+                },
+                'aggregations': {
+                    'types': TYPES_AGGREGATION
+                }
+            })
+
+        res = self.es.msearch(body=body)
+        sums = collections.OrderedDict()
+        for cell_hash, response in zip(cell_hashes, res['responses']):
+            if 'error' in response:
+                raise CellError(cell_hash, response['error'])
+            timing.record_search(response)
+            sums[cell_hash] = self._summary_from_types(response['aggregations']['types'])
+        return sums
+
+    @staticmethod
+    def _summary_from_types(types):
+        """Convert the buckets of a ``TYPES_AGGREGATION`` into a summary."""
+        summary = util.empty_crime_sums()
+
+        for type_bucket in types['buckets']:
+            crime_type = type_bucket['key']
+            summary['by_type'][crime_type] = type_bucket['doc_count']
 
-        for cell in cells:
-            crimes = self.get_crimes_within_cell(cell, year=year)
-            summary = util.get_crime_sums(crimes)
-            cell_summaries.append(summary)
+            for hour_bucket in type_bucket['hours']['buckets']:
+                hour = int(hour_bucket['key'])
+                summary['types_by_hour'][hour][crime_type] = hour_bucket['doc_count']
 
-        return cell_summaries
+            for day_bucket in type_bucket['days']['buckets']:
+                day = int(day_bucket['key'])
+                summary['types_by_day'][day][crime_type] = day_bucket['doc_count']
 
-    def get_cell_sums(self, year):
-        """Get sums of crimes committed for all known geohash cells."""
-        cells = self.get_cells()
-        return self.sum_crimes_in_cells(cells, year)
+        return summary
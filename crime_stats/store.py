@@ -0,0 +1,425 @@
+"""
+An in-process crime store held in NumPy arrays, as an alternative backend to
+searching Elasticsearch.
+
+Crimes are loaded from the same GeoJSON files ``load_crimes`` indexes and
+kept as one array per field, sorted by geohash and then by report time. The
+crimes in a geohash cell of any precision are a contiguous run of the arrays
+found by binary search on the geohash prefix, and the crimes of one year are
+found within each full-length geohash by binary search on report time.
+
+``LocalCrimes`` answers the same questions as ``models.Crimes`` from a
+``CrimeStore``.
+"""
+import collections
+import datetime
+import math
+import threading
+
+import dateutil.parser
+import geohash
+import numpy
+
+from . import index, load_crimes, models, util
+
+
+GEOHASH_LENGTH = max(index.GEOHASH_PRECISIONS)
+
+# Crimes within this distance of a coordinate decide its cell in
+# ``LocalCrimes.get_cell``, as with ``Crimes.get_cell``.
+NEAR_KM = 0.1
+EARTH_RADIUS_KM = 6371.0
+
+# Geohash precision whose cells are larger than NEAR_KM across, so a cell and
+# its neighbours cover every crime near a point inside it.
+NEAR_PRECISION = 6
+
+EPOCH = datetime.datetime(1970, 1, 1)
+
+# Report times are stored in ``CrimeStore.keys`` below each geohash's number,
+# shifted this many bits.
+TIME_BITS = 40
+
+# Stores loaded by ``get_store``, keyed by their files.
+_stores = {}
+_stores_lock = threading.Lock()
+
+
+def report_seconds(report_time):
+    """Return ``report_time`` as seconds since 1970.
+
+    Any time zone is ignored, so times order and fall into years the same
+    way as the hours and weekdays ``load_crimes.add_derived_fields`` derives.
+    """
+    if util.ISO_8601_PREFIX.match(report_time) and report_time[16:17] == ':':
+        parsed = datetime.datetime(int(report_time[0:4]), int(report_time[5:7]),
+                                   int(report_time[8:10]), int(report_time[11:13]),
+                                   int(report_time[14:16]), int(report_time[17:19]))
+    else:
+        parsed = dateutil.parser.parse(report_time).replace(tzinfo=None)
+    return int((parsed - EPOCH).total_seconds())
+
+
+def year_seconds(year):
+    """Return the seconds since 1970 at which ``year`` starts and ends."""
+    year = int(year)
+    return (int((datetime.datetime(year, 1, 1) - EPOCH).total_seconds()),
+            int((datetime.datetime(year + 1, 1, 1) - EPOCH).total_seconds()))
+
+
+def _ranges(starts, stops):
+    """Return the indices in every range [start, stop) in one array."""
+    lengths = stops - starts
+    keep = lengths > 0
+    starts, lengths = starts[keep], lengths[keep]
+    if not len(starts):
+        return numpy.zeros(0, dtype=numpy.int64)
+    # Step by one everywhere except at the start of each range, which jumps
+    # from the end of the previous range.
+    steps = numpy.ones(lengths.sum(), dtype=numpy.int64)
+    offsets = numpy.cumsum(lengths)[:-1]
+    steps[0] = starts[0]
+    steps[offsets] = starts[1:] - (starts[:-1] + lengths[:-1] - 1)
+    return numpy.cumsum(steps)
+
+
+def _select(doc, source):
+    """Return the fields of ``doc`` named by the dotted paths in ``source``,
+    as ES does for a search's ``_source``."""
+    selected = {}
+    for path in source:
+        keys = path.split('.')
+        value = doc
+        for key in keys:
+            if not isinstance(value, dict) or key not in value:
+                break
+            value = value[key]
+        else:
+            target = selected
+            for key in keys[:-1]:
+                target = target.setdefault(key, {})
+            target[keys[-1]] = value
+    return selected
+
+
+class CrimeStore(object):
+    """Crimes held in memory as arrays, sorted by geohash and then by report
+    time.
+
+    ``crimes`` must have the fields ``load_crimes.add_derived_fields`` adds.
+    Stores are read-only once built, so one can be shared by every thread.
+    """
+    def __init__(self, crimes):
+        geohashes = []
+        seconds = []
+        crime_types = []
+        weekdays = []
+        hours = []
+        years = []
+        months = []
+        coordinates = []
+        report_times = []
+        ids = []
+        extras = []
+
+        derived = {'crimeType', 'reportTime', 'weekday', 'hour', 'year', 'month'}
+        derived.update('geohash_{}'.format(precision) for precision in index.GEOHASH_PRECISIONS)
+
+        for crime in crimes:
+            properties = crime['properties']
+            geohashes.append(properties['geohash_{}'.format(GEOHASH_LENGTH)])
+            seconds.append(report_seconds(properties['reportTime']))
+            crime_types.append(properties['crimeType'])
+            weekdays.append(properties['weekday'])
+            hours.append(properties['hour'])
+            years.append(properties['year'])
+            months.append(properties['month'])
+            coordinates.append(crime['geometry']['coordinates'])
+            report_times.append(properties['reportTime'])
+            ids.append(crime.get('id'))
+            extra = {key: value for key, value in properties.items() if key not in derived}
+            extras.append(extra or None)
+
+        self.crime_types = sorted(set(crime_types))
+        type_index = {crime_type: i for i, crime_type in enumerate(self.crime_types)}
+
+        geohashes = numpy.array(geohashes, dtype='S{}'.format(GEOHASH_LENGTH))
+        seconds = numpy.array(seconds, dtype=numpy.int64)
+        order = numpy.lexsort((seconds, geohashes))
+
+        self.geohashes = geohashes[order]
+        self.seconds = seconds[order]
+        self.types = numpy.array([type_index[crime_type] for crime_type in crime_types],
+                                 dtype=numpy.int16)[order]
+        self.weekdays = numpy.array(weekdays, dtype=numpy.int8)[order]
+        self.hours = numpy.array(hours, dtype=numpy.int8)[order]
+        self.years = numpy.array(years, dtype=numpy.int16)[order]
+        self.months = numpy.array(months, dtype=numpy.int8)[order]
+        coordinates = numpy.array(coordinates, dtype=numpy.float64).reshape(-1, 2)[order]
+        self.lons = coordinates[:, 0]
+        self.lats = coordinates[:, 1]
+        self.report_times = numpy.array(report_times, dtype=object)[order]
+        self.ids = numpy.array(ids, dtype=object)[order]
+        self.extras = numpy.array(extras, dtype=object)[order]
+
+        # Crimes of each full-length geohash start at ``starts``. ``keys``
+        # holds each crime's geohash number and report time in one sortable
+        # integer, so a binary search finds a time within every geohash at
+        # once.
+        self.starts = self._run_starts(self.geohashes)
+        cell_numbers = numpy.zeros(len(self), dtype=numpy.int64)
+        cell_numbers[self.starts[1:]] = 1
+        self.min_seconds = int(self.seconds.min()) if len(self) else 0
+        self.keys = (numpy.cumsum(cell_numbers) << TIME_BITS) + (self.seconds - self.min_seconds)
+
+        self._cells = {}
+        self._cells_lock = threading.Lock()
+
+    @classmethod
+    def load(cls, filenames):
+        """Build a store from the crimes in the GeoJSON files ``filenames``."""
+        def iter_crimes():
+            for filename in filenames:
+                with open(filename, 'r') as f:
+                    for crime in load_crimes.iter_features(f):
+                        yield load_crimes.add_derived_fields(crime)
+        return cls(iter_crimes())
+
+    def __len__(self):
+        return len(self.geohashes)
+
+    @staticmethod
+    def _run_starts(values):
+        """Return where each run of equal, sorted ``values`` starts."""
+        if not len(values):
+            return numpy.zeros(0, dtype=numpy.int64)
+        return numpy.flatnonzero(numpy.concatenate(([True], values[1:] != values[:-1])))
+
+    def cells(self, precision):
+        """Return the geohashes of every cell at ``precision`` holding crimes,
+        where the crimes of each start, and how many there are."""
+        cells = self._cells.get(precision)
+        if cells is None:
+            prefixes = self.geohashes.astype('S{}'.format(precision))
+            starts = self._run_starts(prefixes)
+            counts = numpy.diff(numpy.append(starts, len(self)))
+            cells = (prefixes[starts], starts, counts)
+            with self._cells_lock:
+                self._cells[precision] = cells
+        return cells
+
+    def prefix_range(self, cell_hash):
+        """Return the range [start, stop) of crimes whose geohash starts with
+        ``cell_hash``."""
+        prefix = cell_hash.encode('ascii')[:GEOHASH_LENGTH]
+        last = prefix + b'\xff' * (GEOHASH_LENGTH - len(prefix))
+        return (int(numpy.searchsorted(self.geohashes, prefix, side='left')),
+                int(numpy.searchsorted(self.geohashes, last, side='right')))
+
+    def find(self, cell_hash, year=None):
+        """Return the indices of the crimes in the cell ``cell_hash``,
+        reported during ``year`` if given."""
+        start, stop = self.prefix_range(cell_hash)
+        if year is None or start == stop:
+            return numpy.arange(start, stop)
+
+        first = numpy.searchsorted(self.starts, start)
+        last = numpy.searchsorted(self.starts, stop)
+        cell_numbers = numpy.arange(first, last, dtype=numpy.int64) << TIME_BITS
+        begin, end = (numpy.clip(seconds - self.min_seconds, 0, 1 << TIME_BITS)
+                      for seconds in year_seconds(year))
+        return _ranges(numpy.searchsorted(self.keys, cell_numbers + begin),
+                       numpy.searchsorted(self.keys, cell_numbers + end))
+
+    def find_year(self, year, month=None):
+        """Return the indices of every crime reported during ``year``, or
+        only during ``month`` (1 to 12) of it if given."""
+        matches = self.years == int(year)
+        if month is not None:
+            matches &= self.months == int(month)
+        return numpy.flatnonzero(matches)
+
+    def find_near(self, lon, lat, km):
+        """Return the indices of the crimes within ``km`` of (lon, lat), which
+        must be less than a NEAR_PRECISION cell across."""
+        cell_hash = geohash.encode(lat, lon, NEAR_PRECISION)
+        ranges = [self.prefix_range(h) for h in [cell_hash] + geohash.neighbors(cell_hash)]
+        indices = _ranges(numpy.array([start for start, _ in ranges], dtype=numpy.int64),
+                          numpy.array([stop for _, stop in ranges], dtype=numpy.int64))
+
+        lons = numpy.radians(self.lons[indices])
+        lats = numpy.radians(self.lats[indices])
+        lon, lat = math.radians(lon), math.radians(lat)
+        a = (numpy.sin((lats - lat) / 2) ** 2 +
+             numpy.cos(lat) * numpy.cos(lats) * numpy.sin((lons - lon) / 2) ** 2)
+        distances = 2 * EARTH_RADIUS_KM * numpy.arcsin(numpy.sqrt(a))
+        return indices[distances <= km]
+
+    def crime(self, i):
+        """Return the crime at index ``i`` as a GeoJSON feature, like the
+        documents in the crimes index."""
+        geohash_full = self.geohashes[i].decode('ascii')
+        properties = dict(self.extras[i] or {})
+        properties.update({
+            'crimeType': self.crime_types[self.types[i]],
+            'reportTime': self.report_times[i],
+            'weekday': int(self.weekdays[i]),
+            'hour': int(self.hours[i]),
+            'year': int(self.years[i]),
+            'month': int(self.months[i])
+        })
+        for precision in index.GEOHASH_PRECISIONS:
+            properties['geohash_{}'.format(precision)] = geohash_full[:precision]
+
+        crime = {
+            'type': 'Feature',
+            'geometry': {'type': 'Point',
+                         'coordinates': [float(self.lons[i]), float(self.lats[i])]},
+            'properties': properties
+        }
+        if self.ids[i] is not None:
+            crime['id'] = self.ids[i]
+        return crime
+
+    def iter_crimes(self, indices, source=None):
+        """Yield the crimes at ``indices``, limited to the dotted field paths
+        in ``source`` if given."""
+        for i in indices:
+            crime = self.crime(i)
+            yield crime if source is None else _select(crime, source)
+
+    def summarize(self, indices, groups, count):
+        """Return ``count`` crime summaries, shaped like the output of
+        ``util.get_crime_sums``, of the crimes at ``indices`` where ``groups``
+        numbers the summary each crime belongs in."""
+        sums = [util.empty_crime_sums() for _ in range(count)]
+        n_types = len(self.crime_types)
+        types = self.types[indices].astype(numpy.int64)
+        groups = numpy.asarray(groups, dtype=numpy.int64)
+
+        keys, counts = numpy.unique(groups * n_types + types, return_counts=True)
+        for key, n in zip(keys.tolist(), counts.tolist()):
+            group, crime_type = divmod(key, n_types)
+            sums[group]['by_type'][self.crime_types[crime_type]] = n
+
+        for field, values, size in (('types_by_hour', self.hours, 24),
+                                    ('types_by_day', self.weekdays, 7)):
+            values = values[indices].astype(numpy.int64)
+            keys, counts = numpy.unique((groups * size + values) * n_types + types,
+                                        return_counts=True)
+            for key, n in zip(keys.tolist(), counts.tolist()):
+                rest, crime_type = divmod(key, n_types)
+                group, value = divmod(rest, size)
+                sums[group][field][value][self.crime_types[crime_type]] = n
+
+        return sums
+
+
+def get_store(filenames):
+    """Return a ``CrimeStore`` of the crimes in ``filenames``, loaded once per
+    process.
+
+    Load the store before forking workers so they share its pages.
+    """
+    key = tuple(filenames)
+    store = _stores.get(key)
+    if store is None:
+        with _stores_lock:
+            store = _stores.get(key)
+            if store is None:
+                store = _stores[key] = CrimeStore.load(key)
+    return store
+
+
+def clear_stores():
+    """Forget the stores loaded by ``get_store``."""
+    with _stores_lock:
+        _stores.clear()
+
+
+class LocalCrimes(models.BaseCrimes):
+    """Crimes held in a ``CrimeStore``, answering the same questions as
+    ``models.Crimes`` without Elasticsearch."""
+    def __init__(self, store, index='local', precision=6):
+        """
+        ``store``: a ``CrimeStore``
+        """
+        super().__init__(index, precision)
+        if not 1 <= self.precision <= GEOHASH_LENGTH:
+            raise ValueError('Crimes are stored at geohash precisions 1 to {}'.format(
+                GEOHASH_LENGTH))
+        self.store = store
+
+    def at_precision(self, precision):
+        return LocalCrimes(self.store, index=self.index, precision=precision)
+
+    def _cell_hash(self, cell):
+        center_lat = (cell['n'] + cell['s']) / 2
+        center_lon = (cell['e'] + cell['w']) / 2
+        return geohash.encode(center_lat, center_lon, self.precision)
+
+    def get_cell(self, lon, lat):
+        """Get the cell holding the most crimes within NEAR_KM of (lon, lat)."""
+        indices = self.store.find_near(lon, lat, NEAR_KM)
+        if not len(indices):
+            return None
+
+        prefixes = self.store.geohashes[indices].astype('S{}'.format(self.precision))
+        cell_hashes, counts = numpy.unique(prefixes, return_counts=True)
+        return geohash.bbox(cell_hashes[numpy.argmax(counts)].decode('ascii'))
+
+    def get_crimes_within_cell(self, cell, year, source=None, page_size=None):
+        """Return all crimes that occurred within the geohash ``cell``.
+
+        Crimes are built as they are iterated. Pass ``source`` (e.g.
+        ``SUMMARY_FIELDS``) to get only some fields of each crime.
+        ``page_size`` is ignored.
+        """
+        indices = self.store.find(self._cell_hash(cell), year)
+        return self.store.iter_crimes(indices, source)
+
+    def sum_crimes_in_cell(self, cell, year, **options):
+        """Calculate sums of crime data for the geohash bounding box ``cell``
+        during year ``year``, straight from the store's arrays."""
+        indices = self.store.find(self._cell_hash(cell), year)
+        return self.store.summarize(indices, numpy.zeros(len(indices)), 1)[0]
+
+    def _ordered_cells(self):
+        """Return the store's cells at this precision, most crimes first as ES
+        orders buckets, and the number of each cell."""
+        cell_hashes, _, counts = self.store.cells(self.precision)
+        order = numpy.argsort(-counts, kind='mergesort')
+        return [cell_hashes[i].decode('ascii') for i in order], order
+
+    def get_cell_hashes(self):
+        """Get the geohashes of all cells containing crimes at the chosen
+        precision."""
+        return self._ordered_cells()[0]
+
+    def get_cell_sums(self, year, month=None):
+        """Get sums of crimes committed for all known geohash cells, keyed by
+        each cell's geohash.
+
+        Crimes reported during ``year``, or only during ``month`` of it, are
+        summed by cell in one pass over the arrays. Cells with crimes at
+        other times only get empty summaries, as from
+        ``Crimes.get_cell_sums``.
+        """
+        cell_hashes, order = self._ordered_cells()
+        _, starts, counts = self.store.cells(self.precision)
+        cell_numbers = numpy.repeat(numpy.arange(len(starts)), counts)
+
+        indices = self.store.find_year(year, month)
+        sums = self.store.summarize(indices, cell_numbers[indices], len(starts))
+        return collections.OrderedDict(
+            (cell_hash, sums[i]) for cell_hash, i in zip(cell_hashes, order))
+
+    def get_sums_for_cells(self, cell_hashes, year):
+        """Get sums of crimes committed during ``year`` in each of the cells
+        with geohashes ``cell_hashes``, keyed by geohash."""
+        cell_hashes = list(cell_hashes)
+        found = [self.store.find(cell_hash, year) for cell_hash in cell_hashes]
+        indices = numpy.concatenate(found) if found else numpy.zeros(0, dtype=numpy.int64)
+        groups = numpy.repeat(numpy.arange(len(found)), [len(f) for f in found])
+        sums = self.store.summarize(indices, groups, len(cell_hashes))
+        return collections.OrderedDict(zip(cell_hashes, sums))
@@ -0,0 +1,415 @@
+"""
+Compact storage for crime summaries of every geohash cell in the city.
+
+Summaries are kept as one NumPy array of counts shaped (cells x slots x crime
+types), where the first slot holds counts by type, the next 24 counts by hour
+of day and the last 7 counts by day of week. The array is saved as an .npy
+file and memory-mapped when loaded, so loading is near-instant and worker
+processes share the same pages through the page cache.
+
+A small JSON file at the summaries path lists the cells and crime types and
+names the .npy file holding the counts. Each save writes a new .npy file and
+then atomically replaces the JSON file, so readers always see a complete set
+of counts.
+
+``MonthlySummaries`` keep the same counts for each month of a year, each
+summed with those of the months before it, so summaries of any run of months
+are the difference of two of them.
+"""
+import collections
+import glob
+import json
+import os
+import threading
+import uuid
+
+import numpy
+
+from . import index, util
+
+
+HOURS = 24
+DAYS = 7
+MONTHS = 12
+
+# Positions along the second axis of the counts array.
+BY_TYPE = 0
+BY_HOUR = slice(1, 1 + HOURS)
+BY_DAY = slice(1 + HOURS, 1 + HOURS + DAYS)
+SLOTS = 1 + HOURS + DAYS
+
+COUNTS_DTYPE = numpy.int32
+
+
+class CellSummaries(object):
+    """Crime summaries for geohash cells, backed by a NumPy count array.
+
+    Behaves like a read-only dict mapping each cell's geohash to a summary
+    shaped like the output of ``util.get_crime_sums``.
+    """
+    def __init__(self, cells, crime_types, counts):
+        self.cells = list(cells)
+        self.crime_types = list(crime_types)
+        self.counts = counts
+        self._cell_index = {cell: i for i, cell in enumerate(self.cells)}
+
+    @property
+    def by_type(self):
+        """Counts shaped (cells x crime types)."""
+        return self.counts[:, BY_TYPE, :]
+
+    @property
+    def by_hour(self):
+        """Counts shaped (cells x 24 x crime types)."""
+        return self.counts[:, BY_HOUR, :]
+
+    @property
+    def by_day(self):
+        """Counts shaped (cells x 7 x crime types)."""
+        return self.counts[:, BY_DAY, :]
+
+    @classmethod
+    def from_summaries(cls, summaries):
+        """Build from a dict mapping geohashes to crime summaries."""
+        crime_types = sorted({crime_type for summary in summaries.values()
+                              for crime_type in summary['by_type']})
+        type_index = {crime_type: i for i, crime_type in enumerate(crime_types)}
+        counts = numpy.zeros((len(summaries), SLOTS, len(crime_types)),
+                             dtype=COUNTS_DTYPE)
+
+        for i, summary in enumerate(summaries.values()):
+            for crime_type, count in summary['by_type'].items():
+                counts[i, BY_TYPE, type_index[crime_type]] = count
+            for hour, by_type in summary['types_by_hour'].items():
+                for crime_type, count in by_type.items():
+                    counts[i, BY_HOUR.start + hour, type_index[crime_type]] = count
+            for day, by_type in summary['types_by_day'].items():
+                for crime_type, count in by_type.items():
+                    counts[i, BY_DAY.start + day, type_index[crime_type]] = count
+
+        return cls(summaries.keys(), crime_types, counts)
+
+    def _by_type(self, counts):
+        return {self.crime_types[i]: int(counts[i]) for i in numpy.flatnonzero(counts)}
+
+    def _summary(self, i):
+        return self._summarize(self.counts[i], self._by_type)
+
+    @staticmethod
+    def _summarize(counts, by_type):
+        """Shape one cell's (slots x crime types) ``counts`` like a crime
+        summary, mapping each slot's counts to a dict with ``by_type``."""
+        return {
+            'by_type': by_type(counts[BY_TYPE]),
+            'types_by_hour': {hour: by_type(counts[BY_HOUR.start + hour])
+                              for hour in range(HOURS)},
+            'types_by_day': {day: by_type(counts[BY_DAY.start + day])
+                             for day in range(DAYS)}
+        }
+
+    def __len__(self):
+        return len(self.cells)
+
+    def __contains__(self, cell):
+        return cell in self._cell_index
+
+    def __getitem__(self, cell):
+        return self._summary(self._cell_index[cell])
+
+    def __iter__(self):
+        return iter(self.cells)
+
+    def get(self, cell, default=None):
+        if cell in self._cell_index:
+            return self[cell]
+        return default
+
+    def keys(self):
+        return list(self.cells)
+
+    def values(self):
+        return (self._summary(i) for i in range(len(self.cells)))
+
+    def items(self):
+        return zip(self.cells, self.values())
+
+    def add(self, other):
+        """Return new summaries with the counts in ``other`` added to these.
+
+        ``other`` is a ``CellSummaries`` or a dict mapping geohashes to crime
+        summaries. Cells and crime types missing from these summaries are
+        added; other cells keep their counts.
+        """
+        if not isinstance(other, CellSummaries):
+            other = CellSummaries.from_summaries(other)
+
+        cells = self.cells + [cell for cell in other.cells if cell not in self._cell_index]
+        crime_types = sorted(set(self.crime_types) | set(other.crime_types))
+        type_index = {crime_type: i for i, crime_type in enumerate(crime_types)}
+        counts = numpy.zeros((len(cells), SLOTS, len(crime_types)), dtype=COUNTS_DTYPE)
+
+        columns = [type_index[crime_type] for crime_type in self.crime_types]
+        counts[:len(self.cells), :, columns] = self.counts
+
+        cell_index = {cell: i for i, cell in enumerate(cells)}
+        rows = [cell_index[cell] for cell in other.cells]
+        columns = [type_index[crime_type] for crime_type in other.crime_types]
+        counts[numpy.ix_(rows, range(SLOTS), columns)] += other.counts
+
+        return CellSummaries(cells, crime_types, counts)
+
+    def select(self, cells):
+        """Return summaries of just those ``cells`` that these summaries have."""
+        cells = [cell for cell in cells if cell in self._cell_index]
+        rows = [self._cell_index[cell] for cell in cells]
+        return CellSummaries(cells, self.crime_types, self.counts[rows])
+
+    def mean(self, cells, weights=None, decimals=2):
+        """Return a crime summary of the mean counts of ``cells``, weighted
+        by ``weights`` if given, with counts rounded to ``decimals``.
+
+        Cells missing from these summaries are left out, as the city
+        averages leave out cells without crimes, so the mean is over
+        populated cells only.
+        """
+        weights = numpy.ones(len(cells)) if weights is None else numpy.asarray(weights, dtype=float)
+        present = [i for i, cell in enumerate(cells) if cell in self._cell_index]
+        rows = [self._cell_index[cells[i]] for i in present]
+        counts = numpy.tensordot(weights[present], self.counts[rows], axes=1)
+        if present:
+            counts = counts / weights[present].sum()
+
+        def by_type(counts):
+            return {self.crime_types[i]: round(float(counts[i]), decimals)
+                    for i in numpy.flatnonzero(counts)}
+
+        return self._summarize(counts, by_type)
+
+    def rollup(self, precision):
+        """Return summaries of the cells at the coarser geohash ``precision``,
+        each the sum of the cells whose geohashes start with its own.
+
+        Parents are ordered by where their first child appears.
+        """
+        parents = [cell[:precision] for cell in self.cells]
+        parent_cells = list(collections.OrderedDict.fromkeys(parents))
+        parent_index = {cell: i for i, cell in enumerate(parent_cells)}
+        counts = numpy.zeros((len(parent_cells), SLOTS, len(self.crime_types)),
+                             dtype=COUNTS_DTYPE)
+        numpy.add.at(counts, [parent_index[cell] for cell in parents], self.counts)
+        return CellSummaries(parent_cells, self.crime_types, counts)
+
+    def save(self, path):
+        """Save the summaries to ``path`` and a new .npy file beside it.
+
+        Counts files from all but the previous save are removed, leaving
+        readers that loaded the old JSON file time to map its counts.
+        """
+        _save_counts(path, self.cells, self.crime_types, self.counts)
+
+    @classmethod
+    def load(cls, path):
+        """Load summaries saved at ``path``, memory-mapping the counts.
+
+        Raises OSError if there are no summaries at ``path``.
+        """
+        return cls(*_load_counts(path))
+
+
+class MonthlySummaries(object):
+    """Crime summaries for geohash cells in each month of a year, backed by
+    a NumPy count array shaped (12 x cells x slots x crime types).
+
+    Each month's counts include those of every month before it, so
+    summaries for any run of months are the difference of two slices of the
+    array, taking the same time and memory however long the run is.
+    """
+    def __init__(self, cells, crime_types, counts):
+        self.cells = list(cells)
+        self.crime_types = list(crime_types)
+        self.counts = counts
+
+    @classmethod
+    def from_months(cls, months):
+        """Build from 12 ``CellSummaries``, one for each month in order."""
+        months = list(months)
+        if len(months) != MONTHS:
+            raise ValueError('Expected {} months of summaries'.format(MONTHS))
+
+        cells = list(collections.OrderedDict.fromkeys(
+            cell for month in months for cell in month.cells))
+        crime_types = sorted({crime_type for month in months for crime_type in month.crime_types})
+        cell_index = {cell: i for i, cell in enumerate(cells)}
+        type_index = {crime_type: i for i, crime_type in enumerate(crime_types)}
+        counts = numpy.zeros((MONTHS, len(cells), SLOTS, len(crime_types)), dtype=COUNTS_DTYPE)
+
+        for i, month in enumerate(months):
+            rows = [cell_index[cell] for cell in month.cells]
+            columns = [type_index[crime_type] for crime_type in month.crime_types]
+            counts[i][numpy.ix_(rows, range(SLOTS), columns)] = month.counts
+
+        numpy.cumsum(counts, axis=0, out=counts)
+        return cls(cells, crime_types, counts)
+
+    def month(self, month):
+        """Return the ``CellSummaries`` of ``month``, from 1 to 12."""
+        return self.window(month, month)
+
+    def window(self, first, last):
+        """Return ``CellSummaries`` of the months ``first`` to ``last``
+        inclusive, from 1 to 12."""
+        if not 1 <= first <= last <= MONTHS:
+            raise ValueError('Invalid months {} to {}'.format(first, last))
+        counts = self.counts[last - 1]
+        if first > 1:
+            counts = counts - self.counts[first - 2]
+        return CellSummaries(self.cells, self.crime_types, counts)
+
+    def add(self, months):
+        """Return new monthly summaries with counts added to these.
+
+        ``months`` maps months, from 1 to 12, to the counts to add to each,
+        as ``CellSummaries`` or dicts of crime summaries keyed by geohash;
+        see ``CellSummaries.add``. The counts are copied once and each
+        month's added to it and every later month.
+        """
+        added = {month: other if isinstance(other, CellSummaries)
+                 else CellSummaries.from_summaries(other)
+                 for month, other in months.items()}
+
+        cell_index = {cell: i for i, cell in enumerate(self.cells)}
+        cells = list(self.cells)
+        crime_types = set(self.crime_types)
+        for other in added.values():
+            for cell in other.cells:
+                if cell not in cell_index:
+                    cell_index[cell] = len(cells)
+                    cells.append(cell)
+            crime_types.update(other.crime_types)
+        crime_types = sorted(crime_types)
+        type_index = {crime_type: i for i, crime_type in enumerate(crime_types)}
+
+        counts = numpy.zeros((MONTHS, len(cells), SLOTS, len(crime_types)), dtype=COUNTS_DTYPE)
+        columns = [type_index[crime_type] for crime_type in self.crime_types]
+        counts[:, :len(self.cells), :, columns] = self.counts
+
+        for month, other in added.items():
+            rows = [cell_index[cell] for cell in other.cells]
+            columns = [type_index[crime_type] for crime_type in other.crime_types]
+            for later in counts[month - 1:]:
+                later[numpy.ix_(rows, range(SLOTS), columns)] += other.counts
+
+        return MonthlySummaries(cells, crime_types, counts)
+
+    def rollup(self, precision):
+        """Return monthly summaries of the cells at the coarser geohash
+        ``precision``; see ``CellSummaries.rollup``."""
+        parents = [cell[:precision] for cell in self.cells]
+        parent_cells = list(collections.OrderedDict.fromkeys(parents))
+        parent_index = {cell: i for i, cell in enumerate(parent_cells)}
+        counts = numpy.zeros((MONTHS, len(parent_cells), SLOTS, len(self.crime_types)),
+                             dtype=COUNTS_DTYPE)
+        numpy.add.at(counts, (slice(None), [parent_index[cell] for cell in parents]),
+                     self.counts)
+        return MonthlySummaries(parent_cells, self.crime_types, counts)
+
+    def save(self, path):
+        """Save the summaries to ``path`` and a new .npy file beside it, as
+        ``CellSummaries.save`` does."""
+        _save_counts(path, self.cells, self.crime_types, self.counts)
+
+    @classmethod
+    def load(cls, path):
+        """Load summaries saved at ``path``, memory-mapping the counts.
+
+        Raises OSError if there are no summaries at ``path``.
+        """
+        return cls(*_load_counts(path))
+
+
+class CellDeltas(object):
+    """Crime summaries of newly loaded crimes, for adding to stored ones.
+
+    Summaries are keyed by (year, precision) and then by geohash, and kept
+    for each month of the year as well. Crimes must have the fields
+    ``load_crimes.add_derived_fields`` adds.
+    """
+    def __init__(self, precisions=index.GEOHASH_PRECISIONS):
+        self.precisions = precisions
+        self._summaries = {}
+        self._monthly = {}
+        self._lock = threading.Lock()
+
+    def add(self, crime):
+        properties = crime['properties']
+        crime_type = properties['crimeType']
+        day = properties['weekday']
+        hour = properties['hour']
+        month = properties['month']
+
+        with self._lock:
+            for precision in self.precisions:
+                key = (properties['year'], precision)
+                cell = properties['geohash_{}'.format(precision)]
+                for cells in (self._summaries.setdefault(key, {}),
+                              self._monthly.setdefault(key, {}).setdefault(month, {})):
+                    if cell not in cells:
+                        cells[cell] = util.empty_crime_sums()
+                    util.add_to_crime_sums(cells[cell], crime_type, day, hour)
+
+    def items(self):
+        """Return ((year, precision), summaries keyed by geohash) pairs."""
+        with self._lock:
+            return list(self._summaries.items())
+
+    def monthly_items(self):
+        """Return ((year, precision), months) pairs, where ``months`` maps
+        each month with new crimes to their summaries keyed by geohash."""
+        with self._lock:
+            return list(self._monthly.items())
+
+
+def _read_index(path):
+    """Read the JSON index at ``path``.
+
+    Raises OSError if there is no index there, including when the file holds
+    something else, such as the pickled summaries older versions kept.
+    """
+    try:
+        with open(path, 'r') as f:
+            index = json.load(f)
+    except ValueError as e:
+        raise OSError('{} is not a summaries index: {}'.format(path, e))
+    if not isinstance(index, dict) or 'counts' not in index:
+        raise OSError('{} is not a summaries index'.format(path))
+    return index
+
+
+def _save_counts(path, cells, crime_types, counts):
+    counts_path = '{}.{}.npy'.format(path, uuid.uuid4().hex)
+    with util.atomic_write(counts_path) as f:
+        numpy.save(f, numpy.ascontiguousarray(counts, dtype=COUNTS_DTYPE))
+
+    try:
+        previous = _read_index(path)['counts']
+    except OSError:
+        previous = None
+    index = {
+        'cells': cells,
+        'crime_types': crime_types,
+        'counts': os.path.basename(counts_path)
+    }
+    with util.atomic_write(path, 'w') as f:
+        json.dump(index, f)
+
+    keep = {os.path.basename(counts_path), previous}
+    for old_path in glob.glob('{}.*.npy'.format(glob.escape(path))):
+        if os.path.basename(old_path) not in keep:
+            os.unlink(old_path)
+
+
+def _load_counts(path):
+    index = _read_index(path)
+    counts_path = os.path.join(os.path.dirname(path), index['counts'])
+    return index['cells'], index['crime_types'], numpy.load(counts_path, mmap_mode='r')
+
@@ -0,0 +1,122 @@
+"""
+Celery tasks that build crime summaries and averages ahead of requests.
+"""
+import logging
+
+from celery import shared_task
+from django.conf import settings
+from django.core.cache import cache
+from django.core.exceptions import ImproperlyConfigured
+
+from . import connections, crime_averager, index, models, store
+
+
+log = logging.getLogger(__name__)
+
+# Seconds before another warm can be queued for the same year and precision.
+QUEUE_TIMEOUT = 10 * 60
+
+
+def get_crimes(precision):
+    """Return the configured crimes at ``precision``.
+
+    With CRIME_BACKEND 'local', crimes are read from a ``store.CrimeStore``
+    of CRIME_DATA_FILES loaded into this process; otherwise they are
+    searched in CRIME_INDEX.
+    """
+    backend = getattr(settings, 'CRIME_BACKEND', 'elasticsearch')
+    if backend == 'local':
+        return store.LocalCrimes(store.get_store(settings.CRIME_DATA_FILES),
+                                 index='local', precision=precision)
+    if backend != 'elasticsearch':
+        raise ImproperlyConfigured('Unknown CRIME_BACKEND {!r}'.format(backend))
+    return models.Crimes(connections.get_elasticsearch(),
+                         index=settings.CRIME_INDEX, precision=precision)
+
+
+def get_averager(year, precision):
+    """Return a ``CachingCrimeAverager`` for the configured crimes."""
+    crimes = get_crimes(precision)
+    return crime_averager.CachingCrimeAverager(crimes=crimes,
+                                               root_dir=settings.DATA_DIR,
+                                               year=year)
+
+
+def get_window_averager(start, end, precision):
+    """Return a ``WindowAverager`` for the configured crimes over the months
+    ``start`` to ``end``, (year, month) pairs."""
+    return crime_averager.WindowAverager(crimes=get_crimes(precision),
+                                         root_dir=settings.DATA_DIR,
+                                         start=start, end=end)
+
+
+def _queued_key(year, precision, monthly=False):
+    return 'crime_stats.tasks.warm:{}:{}{}'.format(int(year), int(precision),
+                                                   ':monthly' if monthly else '')
+
+
+def queue_warm(year, precision, monthly=False):
+    """Queue ``warm`` for ``year`` and ``precision`` unless it was already
+    queued in the last QUEUE_TIMEOUT seconds.
+
+    Queued warms are tracked in Django's cache, so with a cache shared by
+    every process only one is queued at a time.
+    """
+    if cache.add(_queued_key(year, precision, monthly), True, QUEUE_TIMEOUT):
+        warm.delay(year, precision, monthly=monthly)
+
+
+@shared_task(ignore_result=True)
+def warm(year, precision, rebuild=False, monthly=False):
+    """Build the summaries and averages for ``year`` and ``precision`` if
+    they don't exist, or recalculate them from ES if ``rebuild`` is true.
+    With ``monthly``, build the year's monthly summaries instead.
+
+    See ``CachingCrimeAverager.rebuild`` for which precisions a rebuild
+    replaces."""
+    try:
+        if monthly:
+            averager = get_window_averager((year, 1), (year, 12), precision)
+            if rebuild:
+                averager.rebuild()
+            else:
+                averager.get_monthly_sums(year)
+        else:
+            averager = get_averager(year, precision)
+            if rebuild:
+                averager.rebuild()
+            else:
+                averager.averages
+    finally:
+        cache.delete(_queued_key(year, precision, monthly))
+    log.info('Warmed crime %s for %s at precision %s',
+             'monthly summaries' if monthly else 'averages', year, precision)
+
+
+def iter_warm_jobs(rebuild=False):
+    """Yield the (year, precision, rebuild, monthly) arguments of the
+    ``warm`` calls that cover every year in CRIME_YEARS at every precision
+    in CRIME_PRECISIONS.
+
+    Rebuilding one precision in the pyramid rebuilds them all, so when
+    rebuilding, each year is rebuilt once at
+    ``crime_averager.PYRAMID_PRECISION`` and only the other precisions are
+    warmed separately. Its monthly summaries are rebuilt the same way.
+    """
+    for year in settings.CRIME_YEARS:
+        precisions = list(settings.CRIME_PRECISIONS)
+        if rebuild:
+            yield year, crime_averager.PYRAMID_PRECISION, True, False
+            yield year, crime_averager.PYRAMID_PRECISION, True, True
+            precisions = [precision for precision in precisions
+                          if precision not in index.GEOHASH_PRECISIONS]
+        for precision in precisions:
+            yield year, precision, rebuild, False
+
+
+@shared_task(ignore_result=True)
+def warm_all(rebuild=False):
+    """Queue ``warm`` for every year in CRIME_YEARS at every precision in
+    CRIME_PRECISIONS."""
+    for year, precision, rebuild_precision, monthly in iter_warm_jobs(rebuild):
+        warm.delay(year, precision, rebuild=rebuild_precision, monthly=monthly)
@@ -2,32 +2,52 @@ import os
 
 from django.conf import settings
 from django.test import TestCase
-from elasticsearch import Elasticsearch, NotFoundError
+from elasticsearch import NotFoundError
 
 
-from crime_stats import index, load_crimes
+from crime_stats import connections, index, load_crimes, models, store
 
 
 TEST_INDEX = 'crimes_test'
 
 
 class BaseCrimeTestCase(TestCase):
-    """A base class for testing crimes that loads a test index with 2013 crime data"""
+    """A base class for testing crimes that loads a test index with 2013 crime data
+
+    Subclasses with ``backend`` set to 'local' load the crimes into a
+    ``store.CrimeStore`` instead, and ``make_crimes`` reads from it.
+    """
+    backend = 'elasticsearch'
+
     @classmethod
     def setUpClass(cls):
-        cls.elasticsearch = Elasticsearch()
+        models.clear_populated_cells()
+        cls.data_year = 2013
+        cls.data_file = os.path.join(settings.DATA_DIR, 'crimes_2013.json')
+        if cls.backend == 'local':
+            cls.elasticsearch = None
+            cls.store = store.CrimeStore.load([cls.data_file])
+            return
+
+        cls.elasticsearch = connections.get_elasticsearch()
         # Delete the index if a prior test run failed and didn't clean up.
         try:
             index.delete_index(cls.elasticsearch, TEST_INDEX)
         except NotFoundError:
             # That's ok
             pass
-        cls.data_year = 2013
         index.create_index(cls.elasticsearch, TEST_INDEX)
-        filename = os.path.join(settings.DATA_DIR, 'crimes_2013.json')
-        load_crimes.load_crimes(filename, es=cls.elasticsearch,
+        load_crimes.load_crimes(cls.data_file, es=cls.elasticsearch,
                                 index_name=TEST_INDEX)
 
     @classmethod
     def tearDownClass(cls):
-        index.delete_index(cls.elasticsearch, TEST_INDEX)
+        if cls.backend != 'local':
+            index.delete_index(cls.elasticsearch, TEST_INDEX)
+
+    def make_crimes(self, precision=6):
+        """Return the test crimes from this test case's backend."""
+        if self.backend == 'local':
+            return store.LocalCrimes(self.store, precision=precision)
+        return models.Crimes(self.elasticsearch, precision=precision,
+                             index=TEST_INDEX)
@@ -0,0 +1,36 @@
+from unittest import mock
+
+from django.test import SimpleTestCase
+from django.test.utils import override_settings
+
+from crime_stats import connections
+
+
+class TestGetElasticsearch(SimpleTestCase):
+    def setUp(self):
+        connections.reset()
+
+    def tearDown(self):
+        connections.reset()
+
+    def test_returns_the_same_client_within_a_process(self):
+        """The shared client should be created once per process"""
+        self.assertIs(connections.get_elasticsearch(),
+                      connections.get_elasticsearch())
+
+    def test_returns_a_new_client_after_fork(self):
+        """A forked worker should not reuse its parent's client"""
+        parent_client = connections.get_elasticsearch()
+
+        with mock.patch('os.getpid', return_value=-1):
+            child_client = connections.get_elasticsearch()
+
+        self.assertIsNot(parent_client, child_client)
+
+    @override_settings(ELASTICSEARCH={'hosts': ['es.example.com:9201'],
+                                      'timeout': 3})
+    def test_uses_options_from_settings(self):
+        """The shared client should be configured from Django settings"""
+        es = connections.get_elasticsearch()
+        hosts = [c.host for c in es.transport.connection_pool.connections]
+        self.assertEqual(['http://es.example.com:9201'], hosts)
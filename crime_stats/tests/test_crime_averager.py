@@ -0,0 +1,447 @@
+import collections
+import os
+import shutil
+import statistics
+import tempfile
+
+import geohash
+from django.test import SimpleTestCase
+
+from crime_stats import crime_averager, index, models, summaries, util
+
+from . import BaseCrimeTestCase
+from .test_store import make_crime
+from .test_summaries import CELL_SUMS, make_summary
+
+
+class TestCachingCrimeAverager(BaseCrimeTestCase):
+    def setUp(self):
+        crime_averager.cache.clear()
+        self.root_dir = tempfile.mkdtemp()
+        self.crimes = self.make_crimes(precision=6)
+        self.averager = crime_averager.CachingCrimeAverager(
+            crimes=self.crimes, root_dir=self.root_dir, year=self.data_year)
+
+    def tearDown(self):
+        shutil.rmtree(self.root_dir)
+
+    def test_summaries_are_keyed_by_year_and_precision(self):
+        """The averager should store cell sums keyed by geohash in a file named for the year and precision"""
+        cell_sums = self.averager.get_cell_sums()
+        path = os.path.join(self.root_dir, 'crime_summaries_2013_6.json')
+        self.assertEqual(path, self.averager.summaries_path)
+        self.assertEqual(dict(cell_sums.items()),
+                         dict(summaries.CellSummaries.load(path).items()))
+        self.assertEqual(set(self.crimes.get_cell_hashes()), set(cell_sums.keys()))
+
+    def test_summaries_match_cell_sums(self):
+        """The averager's stored summaries should match the cell sums from ES"""
+        expected = self.crimes.get_cell_sums(self.data_year)
+        self.assertEqual(dict(expected), dict(self.averager.get_cell_sums().items()))
+
+    def test_location_sums_match_crimes_near_coordinate(self):
+        """The averager should serve location sums from its summaries"""
+        nw_4th_and_nw_couch = (-122.674417, 45.523813)
+        crimes = self.crimes.get_crimes_near_coordinate(*nw_4th_and_nw_couch,
+                                                        year=self.data_year)
+        expected = util.get_crime_sums(crimes)
+        self.assertEqual(expected,
+                         self.averager.get_location_sums(*nw_4th_and_nw_couch))
+
+    def test_location_sums_outside_portland_are_empty(self):
+        """The averager should return empty sums for a location outside of Portland"""
+        far_away = (-122.674417, 48.523813)
+        self.assertEqual(util.empty_crime_sums(),
+                         self.averager.get_location_sums(*far_away))
+
+    def test_locations_sums_match_location_sums(self):
+        """Sums for several locations should match looking each one up"""
+        coordinates = [(-122.674417, 45.523813), (-122.674417, 48.523813),
+                       (-122.6478823, 45.476297), (-122.674417, 45.523813)]
+        expected = [self.averager.get_location_sums(*c) for c in coordinates]
+        self.assertEqual(expected, self.averager.get_locations_sums(coordinates))
+
+    def test_neighbourhood_sums_match_location_sums(self):
+        """Neighbourhood sums should be the mean of the location sums of each cell"""
+        lon, lat = -122.674417, 45.523813
+        cells = crime_averager.neighbourhood(self.crimes.get_cell_hash(lon, lat))
+        cell_sums = self.averager.get_locations_sums(
+            [tuple(reversed(geohash.decode(cell))) for cell in cells])
+        expected = collections.Counter()
+        for sums in cell_sums:
+            expected.update(sums['by_type'])
+        self.assertEqual({crime_type: round(count / 9, 2) for crime_type, count in expected.items()},
+                         self.averager.get_neighbourhood_sums(lon, lat)['by_type'])
+
+    def test_averages_are_cached_across_instances(self):
+        """A new averager should serve averages from the process cache"""
+        expected = self.averager.averages
+        averager = crime_averager.CachingCrimeAverager(
+            crimes=self.crimes, root_dir=self.root_dir, year=self.data_year)
+        self.assertIs(expected, averager.averages)
+
+    def test_averages_are_written_through(self):
+        """The averager should write averages it calculates to averages_path"""
+        expected = self.averager.averages
+        self.assertEqual(expected,
+                         util.load_pickled_file(self.averager.averages_path))
+
+    def test_window_of_a_year_matches_the_year(self):
+        """Summaries summed from each month of a year should match the year's summaries"""
+        window = crime_averager.WindowAverager(self.crimes, self.root_dir,
+                                               (self.data_year, 1), (self.data_year, 12))
+        self.assertEqual(dict(self.averager.get_cell_sums().items()),
+                         dict(window.get_cell_sums().items()))
+        self.assertEqual(self.averager.averages, window.averages)
+
+    def test_coarser_summaries_are_rolled_up(self):
+        """Summaries at coarser precisions should match the crimes' cell sums at that precision"""
+        averager = self.averager.at_precision(4)
+        expected = self.crimes.at_precision(4).get_cell_sums(self.data_year)
+        self.assertEqual(dict(expected), dict(averager.get_cell_sums().items()))
+        self.assertTrue(os.path.exists(os.path.join(self.root_dir, 'crime_summaries_2013_7.json')))
+
+
+class TestLocalCachingCrimeAverager(TestCachingCrimeAverager):
+    backend = 'local'
+
+
+class TestCalculateAverages(SimpleTestCase):
+    def setUp(self):
+        self.averager = crime_averager.CachingCrimeAverager(
+            crimes=models.Crimes(None), root_dir=tempfile.gettempdir(), year=2013)
+        self.cell_sums = [
+            {'by_type': {'Larceny': 1, 'Drugs': 2}},
+            {'by_type': {'Larceny': 4}},
+            {'by_type': {'Larceny': 7, 'Drugs': 3}},
+            {'by_type': {'Larceny': 8, 'Arson': 1}},
+            {'by_type': {}},
+        ]
+        for summary in self.cell_sums:
+            summary['types_by_hour'] = {hour: {} for hour in range(24)}
+            summary['types_by_day'] = {day: {} for day in range(7)}
+
+    def test_matches_statistics_median(self):
+        """Averages should be the median of each type over cells that had that type"""
+        expected = {
+            'Larceny': statistics.median([1, 4, 7, 8]),
+            'Drugs': statistics.median([2, 3]),
+            'Arson': statistics.median([1]),
+        }
+        averages = self.averager.calculate_averages_for_cells(self.cell_sums)
+        self.assertEqual(expected, averages)
+        self.assertEqual({type(v) for v in expected.values()},
+                         {type(v) for v in averages.values()})
+
+    def test_hourly_and_daily_averages(self):
+        """Averages by hour and by day should use each hour's and day's counts"""
+        cell_sums = summaries.CellSummaries.from_summaries(CELL_SUMS)
+        hourly = self.averager.calculate_hourly_averages_for_cells(cell_sums)
+        daily = self.averager.calculate_daily_averages_for_cells(cell_sums)
+        self.assertEqual({'Larceny': 2}, hourly[10])
+        self.assertEqual({'Drugs': 1}, hourly[4])
+        self.assertEqual({}, hourly[0])
+        self.assertEqual({'Larceny': 2}, daily[0])
+        self.assertEqual({'Assault, Simple': 1}, daily[5])
+
+    def test_stats(self):
+        """Statistics should be calculated over cells that had each type"""
+        stats = self.averager.calculate_stats_for_cells(self.cell_sums,
+                                                        quantiles=(0.5,))
+        self.assertEqual(4, stats['Larceny']['cells'])
+        self.assertEqual(5, stats['Larceny']['mean'])
+        self.assertAlmostEqual(statistics.pstdev([1, 4, 7, 8]),
+                               stats['Larceny']['std'])
+        self.assertEqual(statistics.median([1, 4, 7, 8]), stats['Larceny'][0.5])
+
+
+class TestApplyDeltas(SimpleTestCase):
+    def setUp(self):
+        crime_averager.cache.clear()
+        self.root_dir = tempfile.mkdtemp()
+        self.averager = crime_averager.CachingCrimeAverager(
+            crimes=models.Crimes(None), root_dir=self.root_dir, year=2013)
+        self.deltas = {
+            'c20fbr': make_summary([('Drugs', '2013-01-08T10:00:00')]),
+            'c20fbq': make_summary([('Arson', '2013-02-01T01:00:00')]),
+        }
+
+    def tearDown(self):
+        shutil.rmtree(self.root_dir)
+
+    def test_updates_summaries_and_averages(self):
+        """Deltas should give the same summaries and averages as rebuilding"""
+        summaries.CellSummaries.from_summaries(CELL_SUMS).save(self.averager.summaries_path)
+        self.averager.averages
+        self.averager.apply_deltas(self.deltas)
+
+        expected = summaries.CellSummaries.from_summaries(CELL_SUMS).add(self.deltas)
+        self.assertEqual(dict(expected.items()),
+                         dict(self.averager.get_cell_sums().items()))
+        self.assertEqual(self.averager.calculate_averages_for_cells(expected),
+                         self.averager.averages)
+        self.assertEqual({'Arson': 1, 'Assault, Simple': 1, 'Drugs': 1, 'Larceny': 2},
+                         util.load_pickled_file(self.averager.averages_path))
+
+    def test_skips_missing_files(self):
+        """Deltas shouldn't create summaries or averages that haven't been built"""
+        self.averager.apply_deltas(self.deltas)
+        self.assertFalse(os.path.exists(self.averager.summaries_path))
+        self.assertFalse(os.path.exists(self.averager.averages_path))
+
+    def test_updates_monthly_summaries(self):
+        """Deltas should be added to the stored monthly summaries of their months"""
+        window = crime_averager.WindowAverager(self.averager.crimes, self.root_dir,
+                                               (2013, 1), (2013, 2))
+        empty = summaries.CellSummaries.from_summaries({})
+        summaries.MonthlySummaries.from_months(
+            [summaries.CellSummaries.from_summaries(CELL_SUMS)] + [empty] * 11
+        ).save(window.monthly_path(2013))
+        version = window.version()
+
+        deltas = summaries.CellDeltas(precisions=(6,))
+        deltas.add(make_crime(0, -122.674417, 45.523813, '2013-02-01T01:00:00', 'Arson'))
+        deltas.add(make_crime(1, -122.674417, 45.523813, '2014-02-01T01:00:00', 'Arson'))
+        crime_averager.apply_deltas(deltas, self.averager.crimes, self.root_dir)
+
+        self.assertNotEqual(version, window.version())
+        self.assertEqual({'Larceny': 2, 'Assault, Simple': 1, 'Arson': 1},
+                         window.get_cell_sums()['c20fbr']['by_type'])
+        self.assertEqual({'Arson': 1}, window.get_monthly_sums(2013).month(2)['c20fbr']['by_type'])
+        # Years whose monthly summaries weren't built are left alone.
+        self.assertFalse(os.path.exists(window.monthly_path(2014)))
+
+
+class CountingCrimes(models.BaseCrimes):
+    """Serves FINE_SUMS as the cell sums at every precision, and for January
+    and March of each year, counting how often they are fetched."""
+    def __init__(self, precision=6, fetches=None):
+        super().__init__('counting', precision)
+        self.fetches = fetches if fetches is not None else []
+
+    def at_precision(self, precision):
+        return CountingCrimes(precision, self.fetches)
+
+    def get_cell_sums(self, year, month=None):
+        self.fetches.append(self.precision)
+        return FINE_SUMS if month in (None, 1, 3) else {}
+
+    def get_cell_hashes(self):
+        return sorted({cell_hash[:self.precision] for cell_hash in FINE_SUMS})
+
+
+FINE_SUMS = {
+    'c20fbr1': CELL_SUMS['c20fbr'],
+    'c20fbp2': CELL_SUMS['c20fbp'],
+    'c20fbp3': CELL_SUMS['c20fbp'],
+    'c20fbp1': util.empty_crime_sums(),
+}
+
+
+class TestPyramid(SimpleTestCase):
+    def setUp(self):
+        crime_averager.cache.clear()
+        self.root_dir = tempfile.mkdtemp()
+        self.crimes = CountingCrimes()
+        self.averager = crime_averager.CachingCrimeAverager(
+            crimes=self.crimes, root_dir=self.root_dir, year=2013)
+
+    def tearDown(self):
+        shutil.rmtree(self.root_dir)
+
+    def test_coarser_precisions_roll_up_the_finest(self):
+        """Coarser precisions should be summed from the finest summaries, fetched once"""
+        self.assertEqual({'Larceny': 2, 'Assault, Simple': 1},
+                         self.averager.get_cell_sums()['c20fbr']['by_type'])
+        self.assertEqual({'Drugs': 2}, self.averager.get_cell_sums()['c20fbp']['by_type'])
+        self.assertEqual(['c20fb'], self.averager.at_precision(5).get_cell_sums().keys())
+        self.assertEqual([7], self.crimes.fetches)
+
+    def test_ignores_pickled_summaries(self):
+        """Summaries pickled by older versions should be rebuilt rather than loaded"""
+        legacy_path = os.path.join(self.root_dir, 'crime_summaries_2013_7')
+        util.write_pickled_file(CELL_SUMS, legacy_path)
+        averager = self.averager.at_precision(7)
+        self.assertFalse(averager.is_built())
+        self.assertEqual(FINE_SUMS['c20fbr1'], averager.get_cell_sums()['c20fbr1'])
+
+        # Even at the summaries path, a pickle counts as missing summaries.
+        crime_averager.cache.clear()
+        util.write_pickled_file(CELL_SUMS, averager.summaries_path)
+        averager = self.averager.at_precision(7)
+        self.assertEqual(FINE_SUMS['c20fbr1'], averager.get_cell_sums()['c20fbr1'])
+        averager.rebuild()
+        self.assertTrue(averager.is_built())
+
+    def test_rebuild_replaces_every_level(self):
+        """Rebuilding should fetch the finest summaries once and replace every level"""
+        self.averager.rebuild()
+        self.assertEqual([7], self.crimes.fetches)
+        for precision in index.GEOHASH_PRECISIONS:
+            averager = self.averager.at_precision(precision)
+            self.assertTrue(averager.is_built())
+        self.assertEqual({'Larceny': 2, 'Assault, Simple': 1, 'Drugs': 2},
+                         self.averager.at_precision(4).get_cell_sums()['c20f']['by_type'])
+        self.assertEqual([7], self.crimes.fetches)
+
+
+class TestNeighbourhood(SimpleTestCase):
+    def setUp(self):
+        crime_averager.cache.clear()
+        models.clear_populated_cells()
+        self.root_dir = tempfile.mkdtemp()
+        self.averager = crime_averager.CachingCrimeAverager(
+            crimes=CountingCrimes(precision=7), root_dir=self.root_dir, year=2013)
+
+    def tearDown(self):
+        shutil.rmtree(self.root_dir)
+
+    def test_changed_summaries_refresh_populated_cells(self):
+        """Loading changed summaries should forget the populated cells, which may have changed too"""
+        crimes = self.averager.crimes
+        self.averager.get_cell_sums()
+        self.assertEqual(frozenset(FINE_SUMS), crimes.get_populated_cells())
+
+        # As after a reindex: the crimes change and the summaries are rebuilt.
+        crimes.get_cell_hashes = lambda: ['c20fbr1', 'c20fbz1']
+        self.assertEqual(frozenset(FINE_SUMS), crimes.get_populated_cells())
+        self.averager.rebuild()
+        crime_averager.CachingCrimeAverager(crimes, self.root_dir, 2013).get_cell_sums()
+        self.assertEqual({'c20fbr1', 'c20fbz1'}, crimes.get_populated_cells())
+
+    def test_neighbourhood(self):
+        """The neighbourhood should be a cell and the 8 cells around it"""
+        cells = crime_averager.neighbourhood('c20fbp2')
+        self.assertEqual('c20fbp2', cells[0])
+        self.assertEqual(9, len(set(cells)))
+        self.assertIn('c20fbp3', cells)
+
+    def test_neighbourhood_sums_average_the_cells(self):
+        """Neighbourhood sums should be the mean of the cell and its populated neighbours"""
+        lon, lat = reversed(geohash.decode('c20fbp2'))
+        sums = self.averager.get_neighbourhood_sums(lon, lat)
+        self.assertEqual({'Drugs': 0.67}, sums['by_type'])
+        self.assertEqual({'Drugs': 0.67}, sums['types_by_hour'][4])
+
+    def test_weights_favour_nearer_cells(self):
+        """Cells nearer the location should weigh more"""
+        cells = crime_averager.neighbourhood('c20fbp2')
+        lat, lon, lat_error, lon_error = geohash.decode_exactly('c20fbp2')
+        weights = crime_averager.neighbourhood_weights(lon, lat, cells)
+        self.assertEqual(1, weights[0])
+        self.assertEqual([0.5] * 4 + [1 / 3] * 4, sorted(weights[1:], reverse=True))
+
+        # Near the eastern edge, the cell to the east counts almost as much.
+        weights = crime_averager.neighbourhood_weights(lon + lon_error * 0.9, lat, cells)
+        east = cells.index(geohash.encode(lat, lon + lon_error * 2, 7))
+        self.assertGreater(weights[east], 0.9 * weights[0])
+
+        center_lon, center_lat = reversed(geohash.decode('c20fbp2'))
+        weighted = self.averager.get_neighbourhood_sums(center_lon, center_lat, weighted=True)
+        unweighted = self.averager.get_neighbourhood_sums(center_lon, center_lat)
+        self.assertGreater(weighted['by_type']['Drugs'], unweighted['by_type']['Drugs'])
+
+
+class TestWindowAverager(SimpleTestCase):
+    def setUp(self):
+        crime_averager.cache.clear()
+        self.root_dir = tempfile.mkdtemp()
+        self.crimes = CountingCrimes(precision=7)
+
+    def tearDown(self):
+        shutil.rmtree(self.root_dir)
+
+    def window(self, start, end):
+        return crime_averager.WindowAverager(self.crimes, self.root_dir, start, end)
+
+    def test_sums_months_of_one_year(self):
+        """A window should sum the monthly summaries of its months"""
+        self.assertEqual({'Drugs': 1},
+                         self.window((2013, 1), (2013, 2)).get_cell_sums()['c20fbp2']['by_type'])
+        self.assertEqual({'Drugs': 2},
+                         self.window((2013, 1), (2013, 3)).get_cell_sums()['c20fbp2']['by_type'])
+        self.assertEqual({},
+                         self.window((2013, 4), (2013, 12)).get_cell_sums()['c20fbp2']['by_type'])
+        # Each month was fetched once and then served from the stored file.
+        self.assertEqual(12, len(self.crimes.fetches))
+
+    def test_sums_months_across_years(self):
+        """A window spanning years should sum the months of each year"""
+        window = self.window((2012, 3), (2013, 1))
+        self.assertFalse(window.is_built())
+        self.assertEqual({'Drugs': 2}, window.get_cell_sums()['c20fbp2']['by_type'])
+        self.assertTrue(window.is_built())
+        self.assertEqual({'Larceny': 4, 'Assault, Simple': 2}, window.get_location_sums(
+            *reversed(geohash.decode('c20fbr1')))['by_type'])
+
+    def test_missing_cells_are_empty(self):
+        """Locations outside every cell should get empty summaries without searching"""
+        window = self.window((2013, 1), (2013, 12))
+        self.assertEqual(util.empty_crime_sums(), window.get_location_sums(-122.6, 48.5))
+
+    def test_coarser_precisions_roll_up_the_finest(self):
+        """Monthly summaries at coarser precisions should be rolled up from the finest"""
+        window = self.window((2013, 1), (2013, 1)).at_precision(5)
+        self.assertEqual({'Larceny': 2, 'Assault, Simple': 1, 'Drugs': 2},
+                         window.get_cell_sums()['c20fb']['by_type'])
+        self.assertEqual({7}, set(self.crimes.fetches))
+
+    def test_version_of_missing_summaries(self):
+        """Versions should tolerate monthly summaries that don't exist, e.g. while being replaced"""
+        window = self.window((2012, 1), (2013, 1))
+        window.get_monthly_sums(2013)
+        self.assertIsNone(window.version()[0])
+        self.assertIsNotNone(window.version()[1])
+        self.assertGreater(window.last_modified(), 0)
+
+    def test_rejects_backwards_windows(self):
+        """Windows must not end before they start"""
+        with self.assertRaises(ValueError):
+            self.window((2013, 3), (2013, 2))
+        with self.assertRaises(ValueError):
+            self.window((2013, 0), (2013, 2))
+
+
+class TestFileCache(SimpleTestCase):
+    def setUp(self):
+        self.root_dir = tempfile.mkdtemp()
+        self.path = os.path.join(self.root_dir, 'data')
+        self.cache = crime_averager.FileCache(maxsize=2)
+        self.loads = 0
+
+    def tearDown(self):
+        shutil.rmtree(self.root_dir)
+
+    def load(self):
+        self.loads += 1
+        return util.load_pickled_file(self.path)
+
+    def test_loads_once(self):
+        """The cache should only load a file once while it is unchanged"""
+        util.write_pickled_file('a', self.path)
+        self.assertEqual('a', self.cache.get('key', self.path, self.load))
+        self.assertEqual('a', self.cache.get('key', self.path, self.load))
+        self.assertEqual(1, self.loads)
+
+    def test_reloads_changed_file(self):
+        """The cache should reload a file when its modification time changes"""
+        util.write_pickled_file('a', self.path)
+        self.cache.get('key', self.path, self.load)
+        util.write_pickled_file('b', self.path)
+        os.utime(self.path, (0, 0))
+        self.assertEqual('b', self.cache.get('key', self.path, self.load))
+        self.assertEqual(2, self.loads)
+
+    def test_evicts_least_recently_used(self):
+        """The cache should evict the least recently used entry when full"""
+        util.write_pickled_file('a', self.path)
+        self.cache.get('one', self.path, self.load)
+        self.cache.get('two', self.path, self.load)
+        self.cache.get('one', self.path, self.load)
+        self.cache.get('three', self.path, self.load)
+        self.assertEqual(3, self.loads)
+
+        self.cache.get('one', self.path, self.load)
+        self.assertEqual(3, self.loads)
+        self.cache.get('two', self.path, self.load)
+        self.assertEqual(4, self.loads)
@@ -0,0 +1,74 @@
+import json
+import os
+import shutil
+import tempfile
+
+from django.test import TestCase
+
+from crime_stats import connections, index, load_crimes
+
+from .test_load_crimes import FEATURES
+
+
+TEST_ALIAS = 'crimes_alias_test'
+
+
+class TestReindex(TestCase):
+    def setUp(self):
+        self.es = connections.get_elasticsearch()
+        self.root_dir = tempfile.mkdtemp()
+        self.filename = os.path.join(self.root_dir, 'crimes.json')
+        with open(self.filename, 'w') as f:
+            json.dump({'type': 'FeatureCollection', 'features': FEATURES}, f)
+
+    def tearDown(self):
+        shutil.rmtree(self.root_dir)
+        for name in index.get_versions(self.es, TEST_ALIAS).values():
+            index.delete_index(self.es, name)
+
+    def test_reindex_switches_alias_to_new_version(self):
+        """Reindexing should load a new index version and point the alias at it"""
+        load_crimes.reindex(self.filename, es=self.es, alias=TEST_ALIAS)
+        self.assertEqual([TEST_ALIAS + '_v1'],
+                         index.get_aliased_indexes(self.es, TEST_ALIAS))
+
+        load_crimes.reindex(self.filename, es=self.es, alias=TEST_ALIAS)
+        self.assertEqual([TEST_ALIAS + '_v2'],
+                         index.get_aliased_indexes(self.es, TEST_ALIAS))
+        self.assertEqual(len(FEATURES), self.es.count(index=TEST_ALIAS)['count'])
+
+    def test_reindex_restores_settings(self):
+        """A reindexed index should have replicas and refreshes restored"""
+        load_crimes.reindex(self.filename, es=self.es, alias=TEST_ALIAS,
+                            replicas=0)
+        name = TEST_ALIAS + '_v1'
+        settings = self.es.indices.get_settings(index=name)[name]['settings']['index']
+        self.assertEqual('0', settings['number_of_replicas'])
+        self.assertEqual(index.DEFAULT_REFRESH_INTERVAL, settings['refresh_interval'])
+
+    def test_reindex_prunes_old_versions(self):
+        """Reindexing should delete all but the newest versions"""
+        for _ in range(3):
+            load_crimes.reindex(self.filename, es=self.es, alias=TEST_ALIAS,
+                                keep=1)
+        self.assertEqual({3: TEST_ALIAS + '_v3'},
+                         index.get_versions(self.es, TEST_ALIAS))
+
+    def test_reindex_refuses_a_concrete_index(self):
+        """Reindexing onto a name held by an index should fail before creating a version"""
+        index.create_index(self.es, TEST_ALIAS)
+        try:
+            with self.assertRaises(ValueError):
+                load_crimes.reindex(self.filename, es=self.es, alias=TEST_ALIAS)
+            self.assertEqual({}, index.get_versions(self.es, TEST_ALIAS))
+        finally:
+            index.delete_index(self.es, TEST_ALIAS)
+
+    def test_failed_reindex_deletes_new_version(self):
+        """A reindex that fails to load should delete its version and leave the alias alone"""
+        load_crimes.reindex(self.filename, es=self.es, alias=TEST_ALIAS)
+        with self.assertRaises(IOError):
+            load_crimes.reindex(os.path.join(self.root_dir, 'missing.json'),
+                                es=self.es, alias=TEST_ALIAS)
+        self.assertEqual({1: TEST_ALIAS + '_v1'}, index.get_versions(self.es, TEST_ALIAS))
+        self.assertEqual([TEST_ALIAS + '_v1'], index.get_aliased_indexes(self.es, TEST_ALIAS))
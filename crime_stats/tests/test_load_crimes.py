@@ -0,0 +1,145 @@
+import io
+import json
+
+from django.test import SimpleTestCase
+from elasticsearch import ConnectionError
+
+from crime_stats import load_crimes, summaries
+
+
+def make_feature(i):
+    return {
+        'type': 'Feature',
+        'id': i,
+        'geometry': {'type': 'Point', 'coordinates': [-122.674417, 45.523813]},
+        'properties': {'crimeType': 'Larceny', 'reportTime': '2013-01-07T10:15:00'}
+    }
+
+
+FEATURES = [make_feature(i) for i in range(25)]
+
+
+class FakeBulkElasticsearch(object):
+    """Records bulk requests, rejecting the first ``rejections`` crimes it
+    sees with a 429 like a busy ES would."""
+    def __init__(self, rejections=0, connection_errors=0):
+        self.rejections = rejections
+        self.connection_errors = connection_errors
+        self.indexed = []
+        self.requests = 0
+        self.indices = self
+        self.refreshed = []
+
+    def bulk(self, body):
+        self.requests += 1
+        if self.connection_errors:
+            self.connection_errors -= 1
+            raise ConnectionError('N/A', 'Connection refused', None)
+
+        lines = body.splitlines()
+        items = []
+        for doc in lines[1::2]:
+            if self.rejections:
+                self.rejections -= 1
+                items.append({'index': {'status': 429, 'error': 'EsRejectedExecutionException'}})
+            else:
+                self.indexed.append(json.loads(doc))
+                items.append({'index': {'status': 201}})
+        return {'errors': any(i['index']['status'] != 201 for i in items), 'items': items}
+
+    def refresh(self, index):
+        self.refreshed.append(index)
+
+
+class TestIterFeatures(SimpleTestCase):
+    def test_parses_features_across_reads(self):
+        """Features should be parsed incrementally, even when split across reads"""
+        f = io.StringIO(json.dumps({'type': 'FeatureCollection', 'features': FEATURES}, indent=2))
+        self.assertEqual(FEATURES, list(load_crimes.iter_features(f, read_size=7)))
+
+    def test_empty_features(self):
+        """An empty FeatureCollection should yield no features"""
+        f = io.StringIO('{"type": "FeatureCollection", "features": []}')
+        self.assertEqual([], list(load_crimes.iter_features(f)))
+
+    def test_truncated_file(self):
+        """A truncated file should raise ValueError"""
+        f = io.StringIO(json.dumps({'features': FEATURES})[:-40])
+        with self.assertRaises(ValueError):
+            list(load_crimes.iter_features(f, read_size=100))
+
+
+class TestBulkLoader(SimpleTestCase):
+    def test_chunks_by_count_and_size(self):
+        """Bulk requests should be limited by crime count and by bytes"""
+        es = FakeBulkElasticsearch()
+        loader = load_crimes.BulkLoader(es, chunk_size=10)
+        self.assertEqual([10, 10, 5], [len(c) for c in loader.iter_chunks(FEATURES)])
+
+        doc_size = len(json.dumps(FEATURES[0]))
+        loader = load_crimes.BulkLoader(es, max_chunk_bytes=doc_size * 3)
+        self.assertTrue(all(len(c) <= 2 for c in loader.iter_chunks(FEATURES)))
+
+    def test_loads_all_crimes(self):
+        """Every crime should be indexed and the index refreshed"""
+        es = FakeBulkElasticsearch()
+        loader = load_crimes.BulkLoader(es, index_name='test', chunk_size=10).load(FEATURES)
+        self.assertEqual(FEATURES, es.indexed)
+        self.assertEqual(25, loader.indexed)
+        self.assertEqual(3, loader.chunks)
+        self.assertEqual(['test'], es.refreshed)
+
+    def test_loads_in_parallel(self):
+        """Crimes should all be indexed when sent from several threads"""
+        es = FakeBulkElasticsearch()
+        loader = load_crimes.BulkLoader(es, chunk_size=2, concurrency=4).load(FEATURES)
+        self.assertEqual(25, loader.indexed)
+        self.assertEqual(sorted(f['id'] for f in FEATURES),
+                         sorted(f['id'] for f in es.indexed))
+
+    def test_retries_rejected_crimes(self):
+        """Crimes rejected by a busy ES should be retried"""
+        es = FakeBulkElasticsearch(rejections=3, connection_errors=1)
+        loader = load_crimes.BulkLoader(es, chunk_size=10, backoff=0).load(FEATURES)
+        self.assertEqual(25, loader.indexed)
+        self.assertEqual(0, loader.failed)
+        self.assertEqual(5, es.requests)
+
+    def test_gives_up_after_max_retries(self):
+        """Crimes should be counted as failed once retries run out"""
+        es = FakeBulkElasticsearch(rejections=100)
+        loader = load_crimes.BulkLoader(es, chunk_size=10, max_retries=2,
+                                        backoff=0).load(FEATURES)
+        self.assertEqual(0, loader.indexed)
+        self.assertEqual(25, loader.failed)
+
+    def test_reports_indexed_crimes(self):
+        """Only crimes ES indexed should be passed to on_indexed"""
+        es = FakeBulkElasticsearch(rejections=5)
+        deltas = summaries.CellDeltas(precisions=(6,))
+        crimes = [load_crimes.add_derived_fields(make_feature(i)) for i in range(25)]
+        load_crimes.BulkLoader(es, chunk_size=10, max_retries=0,
+                               on_indexed=deltas.add).load(crimes)
+
+        [(key, cell_sums)] = deltas.items()
+        self.assertEqual((2013, 6), key)
+        self.assertEqual(['c20fbr'], list(cell_sums))
+        self.assertEqual({'Larceny': 20}, cell_sums['c20fbr']['by_type'])
+        self.assertEqual({'Larceny': 20}, cell_sums['c20fbr']['types_by_hour'][10])
+        self.assertEqual({'Larceny': 20}, cell_sums['c20fbr']['types_by_day'][0])
+        self.assertEqual([((2013, 6), {1: cell_sums})], deltas.monthly_items())
+
+
+class TestAddDerivedFields(SimpleTestCase):
+    def test_adds_time_and_geohash_fields(self):
+        """Crimes should get their report year, month, weekday and hour and geohashes at each stored precision"""
+        crime = load_crimes.add_derived_fields(make_feature(1))
+        properties = crime['properties']
+        self.assertEqual(2013, properties['year'])
+        self.assertEqual(1, properties['month'])
+        self.assertEqual(0, properties['weekday'])
+        self.assertEqual(10, properties['hour'])
+        self.assertEqual('c20f', properties['geohash_4'])
+        self.assertEqual('c20fb', properties['geohash_5'])
+        self.assertEqual('c20fbr', properties['geohash_6'])
+        self.assertEqual(7, len(properties['geohash_7']))
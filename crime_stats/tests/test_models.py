@@ -1,14 +1,18 @@
+import time
+
+import geohash
 import haversine
+from django.test import SimpleTestCase
+from elasticsearch import ConnectionError, TransportError
 
 from crime_stats import models
 
-from . import BaseCrimeTestCase, TEST_INDEX
+from . import BaseCrimeTestCase
 
 
 class TestCrimes(BaseCrimeTestCase):
     def setUp(self):
-        self.crimes = models.Crimes(self.elasticsearch, precision=6,
-                                    index=TEST_INDEX)
+        self.crimes = self.make_crimes(precision=6)
 
     def test_get_cell_within_portland(self):
         """The Crimes wrapper should find a bounding box for a coordinate within Portland"""
@@ -29,6 +33,18 @@ class TestCrimes(BaseCrimeTestCase):
         expected = None
         self.assertEqual(expected, cell)
 
+    def test_locate_cell_within_portland(self):
+        """The Crimes wrapper should find the same cell as get_cell without querying ES"""
+        nw_4th_and_nw_couch = (-122.674417, 45.523813)
+        expected = self.crimes.get_cell(*nw_4th_and_nw_couch)
+        self.assertEqual(expected, self.crimes.locate_cell(*nw_4th_and_nw_couch))
+
+    def test_locate_cell_outside_portland(self):
+        """The Crimes wrapper should not locate a populated cell for a coordinate outside of Portland"""
+        far_away = (-122.674417, 48.523813)
+        self.assertIsNone(self.crimes.locate_cell(*far_away))
+        self.assertIsNotNone(self.crimes.locate_cell(*far_away, populated_only=False))
+
     def test_get_crimes_within_cell(self):
         """The Crimes wrapper should find crimes within a geohash cell within Portland
 
@@ -95,3 +111,113 @@ class TestCrimes(BaseCrimeTestCase):
         sums = self.crimes.get_cell_sums(self.data_year)
         expected = 647
         self.assertEqual(expected, len(sums))
+
+    def test_get_cell_sums_matches_sums_of_crimes_in_cells(self):
+        """The aggregated cell sums should match summing each cell's crimes"""
+        hashes = self.crimes.get_cell_hashes()[:5]
+        cells = [geohash.bbox(h) for h in hashes]
+        expected = self.crimes.sum_crimes_in_cells(cells, self.data_year)
+        sums = self.crimes.get_cell_sums(self.data_year)
+        self.assertEqual(expected, [sums[h] for h in hashes])
+
+    def test_get_sums_for_cells_matches_cell_sums(self):
+        """Sums for chosen cells from one msearch should match the aggregated cell sums"""
+        hashes = self.crimes.get_cell_hashes()[:5] + ['c21000']
+        sums = self.crimes.get_sums_for_cells(hashes, self.data_year)
+        cell_sums = self.crimes.get_cell_sums(self.data_year)
+        self.assertEqual(hashes, list(sums))
+        self.assertEqual([cell_sums[h] for h in hashes[:5]], list(sums.values())[:5])
+        self.assertEqual({}, sums['c21000']['by_type'])
+
+    def test_sum_crimes_in_cells_concurrently(self):
+        """Summing cells from several threads should give the same sums in the same order"""
+        cells = [geohash.bbox(h) for h in self.crimes.get_cell_hashes()[:20]]
+        expected = self.crimes.sum_crimes_in_cells(cells, self.data_year)
+        self.assertEqual(expected, self.crimes.sum_crimes_in_cells(
+            cells, self.data_year, concurrency=4))
+
+    def test_get_crimes_within_cell_pages_through_all_crimes(self):
+        """The Crimes wrapper should page through every crime in a cell rather than truncating"""
+        if self.backend != 'elasticsearch':
+            self.skipTest('Only Elasticsearch pages through crimes')
+        nw_4th_and_nw_couch = (-122.674417, 45.523813)
+        cell = self.crimes.get_cell(*nw_4th_and_nw_couch)
+        scroll = self.crimes.get_crimes_within_cell(cell, self.data_year,
+                                                    source=models.SUMMARY_FIELDS,
+                                                    page_size=100)
+        found_crimes = list(scroll)
+        expected = 2791
+        self.assertEqual(expected, len(found_crimes))
+        self.assertEqual(expected, scroll.hits)
+        self.assertGreater(scroll.pages, 1)
+
+        for crime in found_crimes:
+            self.assertNotIn('geometry', crime)
+            self.assertEqual({'crimeType', 'reportTime'},
+                             set(crime['properties'].keys()))
+
+    def test_get_crimes_within_cell_with_source(self):
+        """The Crimes wrapper should return only the fields asked for"""
+        nw_4th_and_nw_couch = (-122.674417, 45.523813)
+        cell = self.crimes.get_cell(*nw_4th_and_nw_couch)
+        found_crimes = list(self.crimes.get_crimes_within_cell(
+            cell, self.data_year, source=models.SUMMARY_FIELDS))
+        self.assertEqual(2791, len(found_crimes))
+
+        for crime in found_crimes:
+            self.assertEqual({'properties'}, set(crime.keys()))
+            self.assertEqual({'crimeType', 'reportTime'},
+                             set(crime['properties'].keys()))
+
+
+class TestLocalCrimes(TestCrimes):
+    backend = 'local'
+
+
+class FlakyCrimes(models.Crimes):
+    """Finds ``cell`` larcenies in each cell, after failing with ``error``
+    for the first ``failures`` searches."""
+    def __init__(self, failures=0, error=None):
+        super().__init__(None)
+        self.failures = failures
+        self.error = error
+        self.searches = 0
+
+    def get_crimes_within_cell(self, cell, year, source=None, page_size=None):
+        self.searches += 1
+        if self.failures:
+            self.failures -= 1
+            raise self.error
+        # Finish cells out of order.
+        time.sleep(0.001 * (cell % 3))
+        return [{'properties': {'crimeType': 'Larceny',
+                                'reportTime': '2013-01-07T10:15:00'}}] * cell
+
+
+class TestSumCrimesInCells(SimpleTestCase):
+    def test_concurrent_sums_keep_order(self):
+        """Sums from several threads should be returned in the order of the cells"""
+        sums = FlakyCrimes().sum_crimes_in_cells(range(1, 11), 2013, concurrency=3)
+        self.assertEqual([{'Larceny': i} for i in range(1, 11)],
+                         [summary['by_type'] for summary in sums])
+
+    def test_retries_unreachable_es(self):
+        """Cells should be searched again when ES is unreachable"""
+        crimes = FlakyCrimes(failures=2, error=ConnectionError('N/A', 'refused', None))
+        sums = crimes.sum_crimes_in_cells([1], 2013, backoff=0)
+        self.assertEqual({'Larceny': 1}, sums[0]['by_type'])
+        self.assertEqual(3, crimes.searches)
+
+    def test_raises_cell_error(self):
+        """A cell that can't be searched should raise CellError naming the cell"""
+        crimes = FlakyCrimes(failures=5, error=ConnectionError('N/A', 'refused', None))
+        with self.assertRaises(models.CellError) as cm:
+            crimes.sum_crimes_in_cells([1, 2], 2013, concurrency=2, max_retries=1, backoff=0)
+        self.assertIn(cm.exception.cell, (1, 2))
+
+    def test_does_not_retry_bad_requests(self):
+        """Errors that retrying won't fix should fail immediately"""
+        crimes = FlakyCrimes(failures=1, error=TransportError(400, 'SearchPhaseExecutionException'))
+        with self.assertRaises(models.CellError):
+            crimes.sum_crimes_in_cells([1], 2013, backoff=0)
+        self.assertEqual(1, crimes.searches)
@@ -0,0 +1,113 @@
+import json
+import tempfile
+
+import geohash
+from django.test import SimpleTestCase
+
+from crime_stats import load_crimes, models, store, util
+
+
+def make_crime(i, lon, lat, report_time, crime_type='Larceny'):
+    return load_crimes.add_derived_fields({
+        'type': 'Feature',
+        'id': i,
+        'geometry': {'type': 'Point', 'coordinates': [lon, lat]},
+        'properties': {'crimeType': crime_type, 'reportTime': report_time}
+    })
+
+
+# Two crimes near NW 4th and Couch in 2013, one there in 2014 and one in SE
+# Portland in 2013, out of order.
+CRIMES = [
+    make_crime(0, -122.674417, 45.523813, '2014-03-01T08:00:00'),
+    make_crime(1, -122.6478823, 45.476297, '2013-06-01T23:10:00', 'Burglary'),
+    make_crime(2, -122.674417, 45.523813, '2013-12-31T23:59:59', 'Vandalism'),
+    make_crime(3, -122.674420, 45.523810, '2013-01-07T10:15:00'),
+]
+
+
+class TestCrimeStore(SimpleTestCase):
+    def setUp(self):
+        self.store = store.CrimeStore(CRIMES)
+
+    def test_sorts_by_geohash_then_report_time(self):
+        """Crimes should be ordered by geohash and then by report time"""
+        keys = list(zip(self.store.geohashes.tolist(), self.store.seconds.tolist()))
+        self.assertEqual(sorted(keys), keys)
+        self.assertEqual(4, len(self.store))
+
+    def test_finds_cell_by_prefix(self):
+        """Crimes in a cell at any precision should be found by geohash prefix"""
+        self.assertEqual({0, 2, 3}, {self.store.ids[i] for i in self.store.find('c20fbr')})
+        self.assertEqual({0, 1, 2, 3}, {self.store.ids[i] for i in self.store.find('c20')})
+        self.assertEqual(0, len(self.store.find('9q8yyk')))
+
+    def test_finds_year_by_report_time(self):
+        """Only crimes reported during the year should be found"""
+        self.assertEqual({2, 3}, {self.store.ids[i] for i in self.store.find('c20fbr', 2013)})
+        self.assertEqual({0}, {self.store.ids[i] for i in self.store.find('c20fbr', 2014)})
+        self.assertEqual(0, len(self.store.find('c20fbr', 2012)))
+
+    def test_rebuilds_crimes(self):
+        """Crimes should come back as they were loaded, or only the fields asked for"""
+        crimes = {crime['id']: crime for crime in self.store.iter_crimes(range(4))}
+        self.assertEqual(CRIMES[1], crimes[1])
+        partial = list(self.store.iter_crimes(self.store.find('c20fbr', 2014),
+                                              source=models.SUMMARY_FIELDS))
+        self.assertEqual([{'properties': {'crimeType': 'Larceny',
+                                          'reportTime': '2014-03-01T08:00:00'}}], partial)
+
+    def test_loads_geojson(self):
+        """The store should load the GeoJSON files load_crimes reads"""
+        with tempfile.NamedTemporaryFile('w', suffix='.json') as f:
+            json.dump({'type': 'FeatureCollection', 'features': CRIMES}, f)
+            f.flush()
+            loaded = store.CrimeStore.load([f.name, f.name])
+        self.assertEqual(8, len(loaded))
+        self.assertEqual([2, 2, 3, 3], sorted(loaded.ids[i] for i in loaded.find('c20fbr', 2013)))
+
+
+class TestLocalCrimes(SimpleTestCase):
+    def setUp(self):
+        self.crimes = store.LocalCrimes(store.CrimeStore(CRIMES), precision=6)
+
+    def test_get_cell(self):
+        """The cell should be found from crimes near the coordinate"""
+        self.assertEqual(geohash.bbox('c20fbr'), self.crimes.get_cell(-122.674417, 45.523813))
+        self.assertIsNone(self.crimes.get_cell(-122.674417, 48.523813))
+
+    def test_get_cell_hashes_orders_by_count(self):
+        """Cells with the most crimes should come first"""
+        self.assertEqual(['c20fbr', 'c20f9n'], self.crimes.get_cell_hashes())
+
+    def test_get_cell_sums_match_crime_sums(self):
+        """Cell sums should match summing each cell's crimes"""
+        sums = self.crimes.get_cell_sums(2013)
+        self.assertEqual(util.get_crime_sums([CRIMES[2], CRIMES[3]]), sums['c20fbr'])
+        self.assertEqual(util.get_crime_sums([CRIMES[1]]), sums['c20f9n'])
+        self.assertEqual({}, self.crimes.get_cell_sums(2015)['c20fbr']['by_type'])
+
+    def test_get_cell_sums_for_a_month(self):
+        """Cell sums for a month should only count crimes reported during it"""
+        self.assertEqual({'Vandalism': 1}, self.crimes.get_cell_sums(2013, 12)['c20fbr']['by_type'])
+        self.assertEqual({'Larceny': 1}, self.crimes.get_cell_sums(2013, 1)['c20fbr']['by_type'])
+        self.assertEqual({}, self.crimes.get_cell_sums(2013, 1)['c20f9n']['by_type'])
+
+    def test_get_sums_for_cells(self):
+        """Sums for chosen cells should match the cell sums, and be empty for cells without crimes"""
+        sums = self.crimes.get_sums_for_cells(['c20f9n', 'c21000'], 2013)
+        self.assertEqual(['c20f9n', 'c21000'], list(sums))
+        self.assertEqual(self.crimes.get_cell_sums(2013)['c20f9n'], sums['c20f9n'])
+        self.assertEqual(util.empty_crime_sums(), sums['c21000'])
+
+    def test_sum_crimes_in_cell(self):
+        """Summing a cell from the arrays should match summing its crimes"""
+        cell = geohash.bbox('c20fbr')
+        crimes = self.crimes.get_crimes_within_cell(cell, 2013)
+        self.assertEqual(util.get_crime_sums(crimes),
+                         self.crimes.sum_crimes_in_cell(cell, 2013))
+
+    def test_rejects_precisions_not_stored(self):
+        """Precisions finer than the stored geohashes should be rejected"""
+        with self.assertRaises(ValueError):
+            store.LocalCrimes(store.CrimeStore(CRIMES), precision=8)
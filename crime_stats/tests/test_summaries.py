@@ -0,0 +1,150 @@
+import glob
+import os
+import shutil
+import tempfile
+
+from django.test import SimpleTestCase
+
+from crime_stats import summaries, util
+
+
+def make_summary(crimes):
+    """Build a crime summary from (crime type, ISO 8601 report time) pairs."""
+    return util.get_crime_sums(
+        {'properties': {'crimeType': crime_type, 'reportTime': report_time}}
+        for crime_type, report_time in crimes)
+
+
+CELL_SUMS = {
+    'c20fbr': make_summary([
+        ('Larceny', '2013-01-07T10:15:00'),
+        ('Larceny', '2013-01-07T10:45:00'),
+        ('Assault, Simple', '2013-03-09T23:00:00'),
+    ]),
+    'c20fbp': make_summary([
+        ('Drugs', '2013-06-02T04:30:00'),
+    ]),
+    'c20g00': util.empty_crime_sums(),
+}
+
+
+class TestCellSummaries(SimpleTestCase):
+    def setUp(self):
+        self.root_dir = tempfile.mkdtemp()
+        self.path = os.path.join(self.root_dir, 'crime_summaries_2013_6.json')
+
+    def tearDown(self):
+        shutil.rmtree(self.root_dir)
+
+    def test_from_summaries_keeps_summaries(self):
+        """Cell summaries should return the same summaries they were built from"""
+        cell_sums = summaries.CellSummaries.from_summaries(CELL_SUMS)
+        self.assertEqual(CELL_SUMS, dict(cell_sums.items()))
+        self.assertEqual(['Assault, Simple', 'Drugs', 'Larceny'],
+                         cell_sums.crime_types)
+        self.assertEqual((3, 3), cell_sums.by_type.shape)
+        self.assertEqual((3, 24, 3), cell_sums.by_hour.shape)
+        self.assertEqual((3, 7, 3), cell_sums.by_day.shape)
+
+    def test_save_and_load(self):
+        """Cell summaries should load the same summaries that were saved"""
+        summaries.CellSummaries.from_summaries(CELL_SUMS).save(self.path)
+        cell_sums = summaries.CellSummaries.load(self.path)
+        self.assertEqual(CELL_SUMS, dict(cell_sums.items()))
+        self.assertIn('c20fbr', cell_sums)
+        self.assertNotIn('c20fbq', cell_sums)
+
+    def test_add(self):
+        """Adding summaries should add counts to existing cells and add new cells and types"""
+        cell_sums = summaries.CellSummaries.from_summaries(CELL_SUMS)
+        cell_sums = cell_sums.add({
+            'c20fbr': make_summary([('Larceny', '2013-01-08T10:00:00')]),
+            'c20fbq': make_summary([('Arson', '2013-02-01T01:00:00')]),
+        })
+
+        self.assertEqual('c20fbq', cell_sums.cells[-1])
+        self.assertEqual(['Arson', 'Assault, Simple', 'Drugs', 'Larceny'],
+                         cell_sums.crime_types)
+        self.assertEqual({'Larceny': 3, 'Assault, Simple': 1},
+                         cell_sums['c20fbr']['by_type'])
+        self.assertEqual({'Larceny': 3}, cell_sums['c20fbr']['types_by_hour'][10])
+        self.assertEqual({'Larceny': 1}, cell_sums['c20fbr']['types_by_day'][1])
+        self.assertEqual(CELL_SUMS['c20fbp'], cell_sums['c20fbp'])
+        self.assertEqual({'Arson': 1}, cell_sums['c20fbq']['by_type'])
+
+    def test_rollup(self):
+        """Rolling up should sum each cell's counts into the cell its geohash prefix names"""
+        cell_sums = summaries.CellSummaries.from_summaries(CELL_SUMS).rollup(5)
+        self.assertEqual(['c20fb', 'c20g0'], sorted(cell_sums.cells))
+        self.assertEqual({'Larceny': 2, 'Assault, Simple': 1, 'Drugs': 1},
+                         cell_sums['c20fb']['by_type'])
+        self.assertEqual({'Drugs': 1}, cell_sums['c20fb']['types_by_hour'][4])
+        self.assertEqual(util.empty_crime_sums(), cell_sums['c20g0'])
+
+    def test_mean(self):
+        """The mean of some cells should average the counts of those that are populated"""
+        cell_sums = summaries.CellSummaries.from_summaries(CELL_SUMS)
+        mean = cell_sums.mean(['c20fbr', 'c20fbp', 'c20g00', 'c20fbx'])
+        self.assertEqual({'Larceny': 0.67, 'Assault, Simple': 0.33, 'Drugs': 0.33},
+                         mean['by_type'])
+        self.assertEqual({'Larceny': 0.67}, mean['types_by_hour'][10])
+
+        weighted = cell_sums.mean(['c20fbr', 'c20fbp', 'c20fbx'], weights=[3, 1, 4])
+        self.assertEqual({'Larceny': 1.5, 'Assault, Simple': 0.75, 'Drugs': 0.25},
+                         weighted['by_type'])
+        self.assertEqual({}, cell_sums.mean(['c20fbx'])['by_type'])
+        self.assertEqual(['c20fbp'], cell_sums.select(['c20fbx', 'c20fbp']).cells)
+
+    def test_monthly_windows(self):
+        """Summaries of a run of months should sum those months' counts"""
+        january = summaries.CellSummaries.from_summaries(CELL_SUMS)
+        march = summaries.CellSummaries.from_summaries({'c20fbq': CELL_SUMS['c20fbp']})
+        empty = summaries.CellSummaries.from_summaries({})
+        monthly = summaries.MonthlySummaries.from_months(
+            [january, empty, march] + [empty] * 9)
+        monthly.save(self.path)
+        monthly = summaries.MonthlySummaries.load(self.path)
+
+        self.assertEqual(CELL_SUMS['c20fbr'], monthly.window(1, 2)['c20fbr'])
+        self.assertEqual({}, monthly.window(2, 2)['c20fbr']['by_type'])
+        self.assertEqual({'Drugs': 1}, monthly.window(1, 12)['c20fbq']['by_type'])
+        self.assertEqual({'Larceny': 2, 'Assault, Simple': 1, 'Drugs': 2},
+                         monthly.window(1, 3).rollup(5)['c20fb']['by_type'])
+        self.assertEqual({'Drugs': 1}, monthly.rollup(5).month(3)['c20fb']['by_type'])
+        with self.assertRaises(ValueError):
+            monthly.window(3, 2)
+
+    def test_add_months(self):
+        """Counts added to a month should appear in windows covering it alone"""
+        empty = summaries.CellSummaries.from_summaries({})
+        monthly = summaries.MonthlySummaries.from_months([empty] * 12)
+        monthly = monthly.add({2: {'c20fbp': CELL_SUMS['c20fbp']}})
+        monthly = monthly.add({2: CELL_SUMS, 5: {'c20fbq': CELL_SUMS['c20fbp']}})
+
+        self.assertEqual({}, monthly.month(1)['c20fbp']['by_type'])
+        self.assertEqual({'Drugs': 2}, monthly.month(2)['c20fbp']['by_type'])
+        self.assertEqual(CELL_SUMS['c20fbr'], monthly.window(1, 4)['c20fbr'])
+        self.assertEqual({}, monthly.window(3, 4)['c20fbr']['by_type'])
+        self.assertEqual({'Drugs': 1}, monthly.window(3, 12)['c20fbq']['by_type'])
+
+    def test_load_missing_file(self):
+        """Loading cell summaries that don't exist should raise OSError"""
+        with self.assertRaises(OSError):
+            summaries.CellSummaries.load(self.path)
+
+    def test_load_pickled_summaries(self):
+        """Summaries pickled by older versions should load as missing and be replaced on save"""
+        util.write_pickled_file(CELL_SUMS, self.path)
+        with self.assertRaises(OSError):
+            summaries.CellSummaries.load(self.path)
+
+        summaries.CellSummaries.from_summaries(CELL_SUMS).save(self.path)
+        self.assertEqual(CELL_SUMS['c20fbr'], summaries.CellSummaries.load(self.path)['c20fbr'])
+
+    def test_save_keeps_previous_counts(self):
+        """Saving cell summaries should remove all but the current and previous counts files"""
+        cell_sums = summaries.CellSummaries.from_summaries(CELL_SUMS)
+        for _ in range(3):
+            cell_sums.save(self.path)
+        counts_files = glob.glob(self.path + '.*.npy')
+        self.assertEqual(2, len(counts_files))
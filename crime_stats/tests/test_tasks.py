@@ -0,0 +1,66 @@
+import os
+import shutil
+import tempfile
+
+from django.test import SimpleTestCase
+from django.test.utils import override_settings
+
+from crime_stats import crime_averager, summaries, tasks, util
+
+from . import BaseCrimeTestCase, TEST_INDEX
+
+
+class TestWarm(BaseCrimeTestCase):
+    def setUp(self):
+        crime_averager.cache.clear()
+        self.root_dir = tempfile.mkdtemp()
+        self.settings = override_settings(DATA_DIR=self.root_dir, CRIME_INDEX=TEST_INDEX,
+                                          CRIME_BACKEND=self.backend,
+                                          CRIME_DATA_FILES=[self.data_file],
+                                          CRIME_YEARS=(self.data_year,),
+                                          CRIME_PRECISIONS=(6,))
+        self.settings.enable()
+
+    def tearDown(self):
+        self.settings.disable()
+        shutil.rmtree(self.root_dir)
+
+    def test_builds_summaries_and_averages(self):
+        """Warming should build the summaries and averages for each configured year"""
+        averager = tasks.get_averager(self.data_year, 6)
+        self.assertFalse(averager.is_built())
+        tasks.warm_all.delay()
+        self.assertTrue(averager.is_built())
+
+    def test_rebuild_replaces_files(self):
+        """Rebuilding should recalculate summaries and averages that already exist"""
+        averager = tasks.get_averager(self.data_year, 6)
+        summaries.CellSummaries.from_summaries({}).save(averager.summaries_path)
+        util.write_pickled_file({}, averager.averages_path)
+
+        tasks.warm.delay(self.data_year, 6, rebuild=True)
+        self.assertEqual(averager.calculate_averages_for_cells(averager.get_cell_sums()),
+                         util.load_pickled_file(averager.averages_path))
+        self.assertNotEqual({}, util.load_pickled_file(averager.averages_path))
+        self.assertEqual(2, len([name for name in os.listdir(self.root_dir)
+                                 if name.startswith('crime_summaries_2013_6.')]))
+        self.assertTrue(averager.at_precision(7).is_built())
+
+
+class TestLocalWarm(TestWarm):
+    backend = 'local'
+
+
+class TestIterWarmJobs(SimpleTestCase):
+    @override_settings(CRIME_YEARS=(2013,), CRIME_PRECISIONS=(3, 5, 6))
+    def test_warms_each_precision(self):
+        """Each configured precision should be warmed"""
+        self.assertEqual([(2013, 3, False, False), (2013, 5, False, False),
+                          (2013, 6, False, False)],
+                         list(tasks.iter_warm_jobs()))
+
+    @override_settings(CRIME_YEARS=(2013,), CRIME_PRECISIONS=(3, 5, 6))
+    def test_rebuilds_pyramid_once(self):
+        """Rebuilding should rebuild the pyramid and its months once and other precisions separately"""
+        self.assertEqual([(2013, 7, True, False), (2013, 7, True, True), (2013, 3, True, False)],
+                         list(tasks.iter_warm_jobs(rebuild=True)))
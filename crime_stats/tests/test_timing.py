@@ -0,0 +1,60 @@
+import threading
+
+from django.test import SimpleTestCase
+
+from crime_stats import timing
+
+
+class TestTimings(SimpleTestCase):
+    def tearDown(self):
+        timing.finish()
+        timing.clear()
+
+    def test_records_nothing_outside_a_request(self):
+        """Timing phases outside of a request should do nothing"""
+        with timing.timed('search'):
+            timing.add('es_hits', 3)
+        self.assertIsNone(timing.current())
+
+    def test_records_phases_and_counts(self):
+        """Phases should add up their durations and counts their values"""
+        timings = timing.start()
+        with timing.timed('search'):
+            pass
+        with timing.timed('search'):
+            pass
+        timing.record_search({'took': 4, 'hits': {'total': 12}})
+        timing.record_scroll({'took': 3})
+
+        self.assertIs(timings, timing.finish())
+        self.assertEqual(['search', 'es'], list(timings.durations))
+        self.assertEqual(7, timings.durations['es'])
+        self.assertEqual({'es_searches': 1, 'es_hits': 12, 'es_scrolls': 1},
+                         dict(timings.counts))
+        self.assertIsNone(timing.current())
+
+    def test_bind_records_from_other_threads(self):
+        """Functions bound to a request should record into its timings from any thread"""
+        timings = timing.start()
+        thread = threading.Thread(target=timing.bind(lambda: timing.add('es_hits', 3)))
+        thread.start()
+        thread.join()
+        self.assertEqual({'es_hits': 3}, dict(timings.counts))
+
+        unbound = threading.Thread(target=lambda: timing.add('es_hits', 3))
+        unbound.start()
+        unbound.join()
+        self.assertEqual({'es_hits': 3}, dict(timings.counts))
+
+    def test_histogram(self):
+        """Histograms should count durations into cumulative buckets"""
+        for ms in (0.5, 3, 3, 20000):
+            timing.observe('CompareLocation.total', ms)
+
+        snapshot = timing.snapshot()['CompareLocation.total']
+        self.assertEqual(4, snapshot['count'])
+        self.assertEqual(20006.5, snapshot['sum'])
+        self.assertEqual(1, snapshot['buckets']['1'])
+        self.assertEqual(3, snapshot['buckets']['5'])
+        self.assertEqual(3, snapshot['buckets']['10000'])
+        self.assertEqual(4, snapshot['buckets']['+Inf'])
@@ -0,0 +1,73 @@
+import os
+import shutil
+import tempfile
+
+from django.test import SimpleTestCase
+
+from crime_stats import util
+
+
+class TestWritePickledFile(SimpleTestCase):
+    def setUp(self):
+        self.root_dir = tempfile.mkdtemp()
+        self.path = os.path.join(self.root_dir, 'data')
+
+    def tearDown(self):
+        shutil.rmtree(self.root_dir)
+
+    def test_replaces_existing_file(self):
+        """Writing a pickle should replace the file and leave no temporary files"""
+        util.write_pickled_file({'a': 1}, self.path)
+        util.write_pickled_file({'b': 2}, self.path)
+        self.assertEqual({'b': 2}, util.load_pickled_file(self.path))
+        self.assertEqual(['data'], os.listdir(self.root_dir))
+
+    def test_failed_write_keeps_existing_file(self):
+        """A failed write should leave the previous pickle in place"""
+        util.write_pickled_file({'a': 1}, self.path)
+        with self.assertRaises(Exception):
+            util.write_pickled_file(lambda: None, self.path)
+        self.assertEqual({'a': 1}, util.load_pickled_file(self.path))
+        self.assertEqual(['data'], os.listdir(self.root_dir))
+
+
+class TestParseReportTime(SimpleTestCase):
+    def test_iso_8601(self):
+        """ISO 8601 report times should parse to their weekday and hour"""
+        self.assertEqual((1, 13), util.parse_report_time('2013-01-01T13:30:00'))
+        self.assertEqual((6, 0), util.parse_report_time('2013-12-29T00:05:00.000-08:00'))
+
+    def test_other_formats(self):
+        """Report times in other formats should still parse"""
+        self.assertEqual((1, 13), util.parse_report_time('01/01/2013 1:30 PM'))
+        self.assertEqual((1, 0), util.parse_report_time('2013-01-01'))
+
+    def test_report_month(self):
+        """Report months should come from ISO 8601 and other report times"""
+        self.assertEqual(12, util.parse_report_month('2013-12-29T00:05:00.000-08:00'))
+        self.assertEqual(3, util.parse_report_month('03/01/2013 1:30 PM'))
+
+
+class TestGetCrimeSums(SimpleTestCase):
+    def setUp(self):
+        self.crimes = [
+            {'properties': {'crimeType': 'Larceny', 'reportTime': '2013-01-07T10:15:00'}},
+            {'properties': {'crimeType': 'Larceny', 'reportTime': '2013-01-07T10:45:00'}},
+            {'properties': {'crimeType': 'Larceny', 'reportTime': '2013-01-08T11:00:00'}},
+            {'properties': {'crimeType': 'Drugs', 'reportTime': '01/12/2013 4:30 AM'}},
+        ]
+
+    def test_sums_by_type_hour_and_day(self):
+        """Crimes should be summed by type, by hour and by day"""
+        summary = util.get_crime_sums(self.crimes)
+        self.assertEqual({'Larceny': 3, 'Drugs': 1}, summary['by_type'])
+        self.assertEqual({'Larceny': 2}, summary['types_by_hour'][10])
+        self.assertEqual({'Drugs': 1}, summary['types_by_hour'][4])
+        self.assertEqual({'Larceny': 2}, summary['types_by_day'][0])
+        self.assertEqual({'Drugs': 1}, summary['types_by_day'][5])
+
+    def test_batch_matches(self):
+        """Batch sums should match summing crimes one at a time"""
+        self.assertEqual(util.get_crime_sums(self.crimes),
+                         util.get_crime_sums_batch(self.crimes))
+        self.assertEqual(util.empty_crime_sums(), util.get_crime_sums_batch([]))
@@ -0,0 +1,186 @@
+"""
+Lightweight timing of the phases of a request.
+
+``api.middleware.TimingMiddleware`` starts a ``Timings`` for each request in
+a thread-local. Code that runs during the request times phases with
+``timed()`` and counts things with ``add()``; outside of a request both do
+next to nothing. Each finished request's durations are added to process-wide
+``histograms``. Functions run in other threads on a request's behalf can be
+wrapped with ``bind()`` to record into its timings.
+"""
+import bisect
+import collections
+import contextlib
+import threading
+import time
+
+
+# Upper bounds, in milliseconds, of the histogram buckets.
+BUCKETS = (1, 2.5, 5, 10, 25, 50, 100, 250, 500, 1000, 2500, 5000, 10000)
+
+_local = threading.local()
+
+
+class Timings(object):
+    """Durations in milliseconds and counts recorded during one request."""
+    def __init__(self):
+        self.start = time.perf_counter()
+        self.durations = collections.OrderedDict()
+        self.counts = collections.OrderedDict()
+        self._started = {}
+        self._lock = threading.Lock()
+
+    @property
+    def total(self):
+        return (time.perf_counter() - self.start) * 1000
+
+    def add_duration(self, name, ms):
+        with self._lock:
+            self.durations[name] = self.durations.get(name, 0.0) + ms
+
+    def add(self, name, value=1):
+        with self._lock:
+            self.counts[name] = self.counts.get(name, 0) + value
+
+    def begin(self, name):
+        self._started[name] = time.perf_counter()
+
+    def end(self, name):
+        start = self._started.pop(name, None)
+        if start is not None:
+            self.add_duration(name, (time.perf_counter() - start) * 1000)
+
+
+def start():
+    """Start recording timings for a request in this thread."""
+    _local.timings = Timings()
+    return _local.timings
+
+
+def finish():
+    """Stop recording timings in this thread and return them, if any."""
+    timings = current()
+    _local.timings = None
+    return timings
+
+
+def current():
+    """Return the timings being recorded in this thread, or None."""
+    return getattr(_local, 'timings', None)
+
+
+def bind(func):
+    """Return a function that calls ``func`` recording into the timings of
+    the calling thread's request, for running ``func`` in another thread.
+
+    Phases timed at the same time in different threads each add their own
+    duration, so together they may add up to more than the request took.
+    """
+    timings = current()
+
+    def call(*args, **kwargs):
+        previous = current()
+        _local.timings = timings
+        try:
+            return func(*args, **kwargs)
+        finally:
+            _local.timings = previous
+
+    return call
+
+
+@contextlib.contextmanager
+def timed(name):
+    """Add the time spent in the ``with`` block to the phase ``name``."""
+    timings = current()
+    if timings is None:
+        yield
+        return
+
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        timings.add_duration(name, (time.perf_counter() - start) * 1000)
+
+
+def add(name, value=1):
+    """Add ``value`` to the count ``name``."""
+    timings = current()
+    if timings is not None:
+        timings.add(name, value)
+
+
+def record_search(res):
+    """Record the time ES took for the search response ``res`` and how many
+    crimes matched."""
+    timings = current()
+    if timings is not None:
+        timings.add_duration('es', res.get('took', 0))
+        timings.add('es_searches')
+        timings.add('es_hits', res.get('hits', {}).get('total', 0))
+
+
+def record_scroll(res):
+    """Record the time ES took for the scroll response ``res``."""
+    timings = current()
+    if timings is not None:
+        timings.add_duration('es', res.get('took', 0))
+        timings.add('es_scrolls')
+
+
+class Histogram(object):
+    """A thread-safe histogram of durations in milliseconds."""
+    def __init__(self, buckets=BUCKETS):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)
+        self.count = 0
+        self.sum = 0.0
+        self._lock = threading.Lock()
+
+    def observe(self, ms):
+        i = bisect.bisect_left(self.buckets, ms)
+        with self._lock:
+            self.counts[i] += 1
+            self.count += 1
+            self.sum += ms
+
+    def snapshot(self):
+        """Return the count, sum and cumulative bucket counts."""
+        with self._lock:
+            counts = list(self.counts)
+            snapshot = {'count': self.count, 'sum': self.sum}
+
+        cumulative = 0
+        buckets = collections.OrderedDict()
+        for bound, count in zip(self.buckets + ('+Inf',), counts):
+            cumulative += count
+            buckets[str(bound)] = cumulative
+        snapshot['buckets'] = buckets
+        return snapshot
+
+
+histograms = {}
+_histograms_lock = threading.Lock()
+
+
+def observe(name, ms):
+    """Add ``ms`` to the process-wide histogram ``name``."""
+    histogram = histograms.get(name)
+    if histogram is None:
+        with _histograms_lock:
+            histogram = histograms.setdefault(name, Histogram())
+    histogram.observe(ms)
+
+
+def snapshot():
+    """Return snapshots of every histogram, keyed by name."""
+    with _histograms_lock:
+        names = sorted(histograms)
+    return collections.OrderedDict((name, histograms[name].snapshot()) for name in names)
+
+
+def clear():
+    """Forget every histogram."""
+    with _histograms_lock:
+        histograms.clear()
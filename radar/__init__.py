@@ -0,0 +1,2 @@
+# Load the Celery app whenever Django starts so tasks use it.
+from .celery import app as celery_app
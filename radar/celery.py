@@ -0,0 +1,31 @@
+"""
+Celery app for radar. Start a worker with:
+
+    $ celery -A radar worker
+"""
+import os
+
+from celery import Celery
+from celery.signals import worker_ready
+
+os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'radar.settings')
+
+from django.conf import settings
+
+app = Celery('radar')
+app.config_from_object('django.conf:settings')
+app.autodiscover_tasks(lambda: settings.INSTALLED_APPS)
+
+
+@worker_ready.connect
+def warm_on_startup(sender=None, **kwargs):
+    """Queue crime summaries and averages for warming once a worker is
+    ready, if CRIME_WARM_ON_STARTUP is set.
+
+    Only workers do this, rather than every process that starts Django.
+    Warming skips files that are already built, so restarting workers is
+    cheap.
+    """
+    if getattr(settings, 'CRIME_WARM_ON_STARTUP', False):
+        from crime_stats import tasks
+        tasks.warm_all.delay()
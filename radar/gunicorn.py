@@ -0,0 +1,21 @@
+"""
+gunicorn settings for radar.
+
+Run with ``gunicorn radar.wsgi -c radar/gunicorn.py``. Each worker serves
+THREADS requests at once from threads, so requests waiting on Elasticsearch
+don't block the others, and they share the worker's summaries, averages and
+Elasticsearch connections. Keep WORKERS x THREADS within what ES can serve
+and THREADS within ``ELASTICSEARCH['maxsize']`` in the Django settings.
+"""
+import multiprocessing
+import os
+
+
+bind = os.environ.get('RADAR_BIND', '0.0.0.0:8001')
+
+worker_class = 'gthread'
+workers = int(os.environ.get('RADAR_WORKERS', multiprocessing.cpu_count()))
+threads = int(os.environ.get('RADAR_THREADS', 8))
+
+# Slow searches still get an answer before the worker is restarted.
+timeout = 60
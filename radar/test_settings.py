@@ -1,3 +1,9 @@
 from .settings import *
 
-CRIME_INDEX = "test_crimes"
\ No newline at end of file
+CRIME_INDEX = "test_crimes"
+
+# Run tasks in the calling process instead of sending them to a broker.
+BROKER_URL = 'memory://'
+CELERY_ALWAYS_EAGER = True
+CELERY_EAGER_PROPAGATES_EXCEPTIONS = True
+CRIME_WARM_ON_STARTUP = False
@@ -21,6 +21,7 @@ sudo apt-get install python3.4 -y
 sudo apt-get install g++ -y
 sudo apt-get install vim -y
 sudo apt-get install nginx -y
+sudo apt-get install rabbitmq-server -y
 
 # Install setuptools (easy_install, pip)
 wget https://bitbucket.org/pypa/setuptools/raw/bootstrap/ez_setup.py -O /tmp/ez_setup.py
@@ -42,5 +43,6 @@ pip install gunicorn
 
 sudo ln -s /vagrant/conf/nginx/radar /etc/nginx/sites-enabled/radar
 sudo cp /vagrant/conf/init/radar.conf /etc/init/radar.conf
+sudo cp /vagrant/conf/init/celery.conf /etc/init/celery.conf
 sudo cp /vagrant/conf/init/nginx.conf /etc/init/nginx.conf
 sudo cp /vagrant/conf/init/elasticsearch.conf /etc/init/elasticsearch.conf